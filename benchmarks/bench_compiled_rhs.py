@@ -0,0 +1,114 @@
+"""
+Compare the dense right-hand side of CompartmentModel with the compiled sparse one
+(CompartmentModel.compile()) for SEIRD and a 50 compartment age-stratified structure with contacts
+across age groups, and check that simulate() and simulate_batch() agree.
+
+Usage: python bench_compiled_rhs.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from deterministic_models.model import generate_model
+
+
+SEIRD = {"name": "SEIRD",
+         "compartments": ["S", "E", "I", "R", "D"],
+         "connections": [
+             {"source": "S", "target": "E", "inhibitor": "I", "parameter": "beta"},
+             {"source": "E", "target": "I", "parameter": "a"},
+             {"source": "I", "target": "R", "parameter": "gamma"},
+             {"source": "I", "target": "D", "parameter": "delta"}
+         ]}
+
+
+def age_stratified_structure(groups=10):
+    """
+    SEIRD per age group, 5 * groups compartments. Each group is infected within the group and by the
+    next group, so S of every group is the source of two Q transitions.
+    """
+    compartments = []
+    connections = []
+    for g in range(groups):
+        S, E, I, R, D = ["{}{}".format(c, g) for c in "SEIRD"]
+        compartments.extend([S, E, I, R, D])
+        connections.extend([
+            {"source": S, "target": E, "inhibitor": I, "parameter": "beta{}".format(g)},
+            {"source": S, "target": E, "inhibitor": "I{}".format((g + 1) % groups),
+             "parameter": "contact{}".format(g)},
+            {"source": E, "target": I, "parameter": "a{}".format(g)},
+            {"source": I, "target": R, "parameter": "gamma{}".format(g)},
+            {"source": I, "target": D, "parameter": "delta{}".format(g)},
+        ])
+    return {"name": "SEIRD age-stratified", "compartments": compartments, "connections": connections}
+
+
+def setup(model_structure, compiled, N=83e6, I0=18000.):
+    model = generate_model(model_structure, compiled=compiled)
+    groups = len(model.compartments) // 5
+
+    para = dict(model.parameters)
+    para["N"] = N
+    for name in model.param_config:
+        value = {"beta": 0.3, "contact": 0.05, "a": 1/5.5, "gamma": 1/9., "delta": 0.05}[name.rstrip("0123456789")]
+        para[name] = value * (1 + 0.01 * len(name))
+    model.set_parameters(para)
+
+    y0 = np.zeros(len(model.compartments))
+    y0[0::5] = N / groups - I0 / groups
+    y0[2::5] = I0 / groups
+    return model, y0
+
+
+def time_call(fun, repeat=5):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print("{:<22} {:<6} {:>8} {:>14} {:>12} {:>12}".format(
+        "structure", "path", "method", "rhs eval [us]", "solve [ms]", "max rel diff"))
+
+    for structure in [SEIRD, age_stratified_structure(10)]:
+        reference = None
+        for compiled in [False, True]:
+            model, y0 = setup(structure, compiled)
+            rhs = model.rhs if compiled else model.dense_rhs
+
+            n_evals = 10000
+            rhs_time = time_call(lambda: [rhs(0., y0) for _ in range(n_evals)], repeat=3) / n_evals
+
+            for method in ["RK45", "LSODA", "BDF"]:
+                result = {}
+
+                def solve():
+                    result.update(model.simulate((0., 365.), y0, 365, method=method))
+
+                solve_time = time_call(solve)
+                final = np.array([result[c][-1] for c in model.compartments])
+                if reference is None:
+                    reference = final
+                diff = np.max(np.abs(final - reference) / np.maximum(np.abs(reference), 1e-6))
+
+                print("{:<22} {:<6} {:>8} {:>14.2f} {:>12.2f} {:>12.1e}".format(
+                    structure["name"][:22], "sparse" if compiled else "dense", method,
+                    rhs_time * 1e6, solve_time * 1e3, diff))
+
+        # the ensemble path uses the same transitions as simulate()
+        param_matrix = [[model.parameters[name] for name in model.param_config]]
+        batch = model.simulate_batch(param_matrix, [y0], np.linspace(0., 365., 366))[0, :, -1]
+        diff = np.max(np.abs(batch - reference) / np.maximum(np.abs(reference), 1e-6))
+        print("{:<22} {:<6} {:>8} {:>14} {:>12} {:>12.1e}".format(
+            structure["name"][:22], "batch", "RK45", "", "", diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Events per second of the Gillespie direct method and of the hybrid direct / tau-leaping simulator
+in stochastic_models/gillespie.py, and the time to estimate the extinction probability of a small
+outbreak (I0 = 10 as in simple.py).
+
+Usage: python bench_gillespie.py [runs]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from deterministic_models.model import generate_model
+from stochastic_models.gillespie import GillespieSimulator, extinction_probability
+
+
+SEIRD = {"name": "SEIRD",
+         "compartments": ["S", "E", "I", "R", "D"],
+         "connections": [
+             {"source": "S", "target": "E", "inhibitor": "I", "parameter": "beta"},
+             {"source": "E", "target": "I", "parameter": "a"},
+             {"source": "I", "target": "R", "parameter": "gamma"},
+             {"source": "I", "target": "D", "parameter": "delta"}
+         ]}
+
+
+def simulator(N, tau_threshold):
+    model = generate_model(SEIRD)
+    model.set_parameters({"N": N, "beta": 0.3, "a": 1. / 5.5, "gamma": 1. / 9., "delta": 0.01})
+    return GillespieSimulator(model, tau_threshold=tau_threshold)
+
+
+def main(runs=500):
+    print("{:<10} {:>12} {:>14} {:>10} {:>16}".format("mode", "N", "events", "seconds", "events / s"))
+    for mode, N, tau_threshold in [("direct", 1e5, np.inf), ("hybrid", 1e5, 100), ("hybrid", 83e6, 100)]:
+        sim = simulator(N, tau_threshold)
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        events = 0
+        # until the first major outbreak
+        while True:
+            res = sim.run([N - 10, 0, 10, 0, 0], 365., rng=rng)
+            events += res["events"]
+            if res["y"][0, 0] - res["y"][0, -1] > 1000:
+                break
+        seconds = time.perf_counter() - start
+        print("{:<10} {:>12.0f} {:>14} {:>10.3f} {:>16.0f}".format(mode, N, events, seconds, events / seconds))
+
+    # branching process approximation: (1 / R0) ** I0
+    R0 = 0.3 / (1. / 9. + 0.01)
+    for I0 in [1, 10]:
+        start = time.perf_counter()
+        p, error = extinction_probability(simulator(83e6, 100), [83e6 - I0, 0, I0, 0, 0], 365., runs, seed=0,
+                                          stop_size=200)
+        print("extinction probability of I0 = {}: {:.4f} +- {:.4f} (approx. {:.4f}) from {} runs in {:.1f} s".format(
+            I0, p, error, R0 ** -I0, runs, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
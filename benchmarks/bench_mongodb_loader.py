@@ -0,0 +1,83 @@
+"""
+Peak RSS and wall time of loading the cases collection with list(find({})) compared to the chunked,
+projected loader in utils/get_data_from_mongodb.py
+
+Every variant runs in a fresh process, so that the peak RSS values do not influence each other. By
+default the collection is filled with synthetic documents in mongomock, which is slow, so keep the
+number of documents small. Pass a MongoDB URL to use a local mongod instead (the database "bench" is
+overwritten).
+
+Usage: python bench_mongodb_loader.py [documents] [mongodb://localhost:27017/]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.get_data_from_mongodb import load_cases
+
+
+def fill(collection, documents, seed=0):
+    rng = np.random.default_rng(seed)
+    batch = 10000
+    for start in range(0, documents, batch):
+        size = min(batch, documents - start)
+        collection.insert_many([{
+            "date": 1577836800 + 86400 * int(day),
+            "area": [None, "country{}".format(region)],
+            "infected": int(infected), "dead": int(infected) // 50, "recovered": int(infected) // 3,
+            "source": "JHU" if region % 4 else "other",
+            "adm": 0, "gender": None, "ageRange": None, "comment": "x" * 100,
+        } for day, region, infected in zip(rng.integers(0, 400, size), rng.integers(0, 500, size),
+                                           rng.integers(0, 100000, size))])
+
+
+def open_db(documents, url):
+    if url is None:
+        import mongomock
+        db = mongomock.MongoClient()["bench"]
+    else:
+        import pymongo
+        db = pymongo.MongoClient(url)["bench"]
+        if db["cases"].estimated_document_count() == documents:
+            return db
+        db["cases"].drop()
+    fill(db["cases"], documents)
+    return db
+
+
+def run(variant, documents, url):
+    db = open_db(documents, url)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if variant == "list":
+        cases = pd.DataFrame(list(db["cases"].find({})))
+        cases = cases[cases["source"] == "JHU"]
+    else:
+        cases = load_cases(source="JHU", db=db)
+    seconds = time.perf_counter() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{:<8} {:>10} {:>10.2f} {:>14.1f} {:>14.1f}".format(
+        variant, len(cases), seconds, (rss - rss_before) / 1024., cases.memory_usage(deep=True).sum() / 2**20))
+
+
+def main(documents=20000, url=None):
+    print("{:<8} {:>10} {:>10} {:>14} {:>14}".format("variant", "rows", "seconds", "peak RSS [MB]", "frame [MB]"))
+    for variant in ["list", "chunked"]:
+        subprocess.run([sys.executable, __file__, "--run", variant, str(documents)] + ([url] if url else []),
+                       check=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["--run"]:
+        run(sys.argv[2], int(sys.argv[3]), sys.argv[4] if len(sys.argv) > 4 else None)
+    else:
+        main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
@@ -0,0 +1,105 @@
+"""
+Lag features of generate_ml_data.preprocess_data() on synthetic case data of increasing size
+
+Before timing, the vectorized engine is compared with a plain per row reference on a small fixture.
+
+Usage: python bench_preprocess_data.py [max_rows]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "data"))
+
+from generate_ml_data import LAGS, preprocess_data
+
+
+def synthetic_cases(rows, days=400, seed=0):
+    """About rows cumulative case counts of several regions, with gaps, zeros and missing values"""
+    rng = np.random.default_rng(seed)
+    # about 10% of the days are dropped below
+    regions = max(-(-rows * 10 // (9 * days)), 1)
+    growth = rng.uniform(1.0, 1.2, size=(regions, 1)) ** np.arange(days)
+    infected = np.floor(growth * rng.uniform(0, 3, size=(regions, 1))).ravel()
+    infected[rng.random(infected.shape) < 0.01] = np.nan
+
+    df = pd.DataFrame({
+        "area1": np.where(np.arange(regions) % 3 == 0, None, np.arange(regions).astype(str))[:, None]
+        .repeat(days, axis=1).ravel(),
+        "area2": ["country{}".format(r // 3) for r in range(regions) for _ in range(days)],
+        "date": np.tile(np.arange(days), regions),
+        "infected": infected,
+        "dead": 0.,
+        "recovered": 0.,
+        "source": "JHU",
+    })
+    # drop some days, so that the lags do not always hit an exact date
+    df = df[rng.random(len(df)) > 0.1].sample(frac=1., random_state=seed)
+    population = pd.DataFrame({"country": ["country{}".format(c) for c in range(regions // 3 + 1)],
+                               "year": 2018, "population": rng.uniform(1e6, 1e8, size=regions // 3 + 1)})
+    return df.iloc[:rows], population
+
+
+def reference_lag_features(df):
+    """Straightforward per row implementation of the lag features"""
+    res = {}
+    for time in LAGS:
+        res["inf_" + str(time)] = []
+        res["inf_" + str(time) + "_R0"] = []
+        res["inf_" + str(time) + "_R0_lin"] = []
+
+    for _, row in df.iterrows():
+        same_area1 = df["area1"].isna() if pd.isna(row["area1"]) else df["area1"] == row["area1"]
+        region = df[same_area1 & (df["area2"] == row["area2"])]
+        for time in LAGS:
+            if time > 0:
+                other = region[region["date"] >= row["date"] + time].sort_values("date")
+                other = other.iloc[:1]
+            else:
+                other = region[region["date"] <= row["date"] + time].sort_values("date", kind="mergesort")
+                other = other.iloc[-1:]
+            lagged = other["infected"].iloc[0] if len(other) else np.nan
+            res["inf_" + str(time)].append(lagged)
+
+            current = row["infected"]
+            if not (current > 0 and lagged > 0):
+                res["inf_" + str(time) + "_R0"].append(np.nan)
+                res["inf_" + str(time) + "_R0_lin"].append(np.nan)
+                continue
+            later, earlier = (lagged, current) if time > 0 else (current, lagged)
+            res["inf_" + str(time) + "_R0"].append(later / earlier)
+            res["inf_" + str(time) + "_R0_lin"].append((later - earlier) / abs(time) * 10)
+
+    return pd.DataFrame(res, index=df.index)
+
+
+def check(rows=2000):
+    df, population = synthetic_cases(rows, days=100)
+    result = preprocess_data(df, population)
+    reference = reference_lag_features(df)
+
+    for column in reference.columns:
+        np.testing.assert_allclose(result[column].to_numpy(dtype=float), reference[column].to_numpy(dtype=float),
+                                   rtol=1e-12, err_msg=column)
+    expected = df["area2"].map(population.set_index("country")["population"])
+    np.testing.assert_allclose(result["population"].to_numpy(dtype=float), expected.to_numpy(dtype=float))
+    print("matches the per row reference on {} rows".format(rows))
+
+
+def main(max_rows=1000000):
+    check()
+    print("{:>10} {:>12}".format("rows", "seconds"))
+    rows = 10000
+    while rows <= max_rows:
+        df, population = synthetic_cases(rows)
+        start = time.perf_counter()
+        preprocess_data(df, population)
+        print("{:>10} {:>12.2f}".format(len(df), time.perf_counter() - start))
+        rows *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,306 @@
+"""
+Benchmark suite of the simulation and data paths, with a history of results per git commit
+
+Every case runs on synthetic fixtures of increasing size, without network or MongoDB. For every
+case and size the suite records the best wall time of several runs, the number of right-hand side
+evaluations of the ODE solvers and the peak of the memory traced by tracemalloc (in a separate run,
+as tracing slows down the code). Results are appended to a JSONL history, and the current run is
+compared against the latest run of another commit.
+
+Usage: python suite.py [--quick] [--cases simulate,preprocess_data] [--history history.jsonl]
+                       [--baseline COMMIT] [--threshold 1.2] [--fail-on-regression]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(1, ROOT)
+sys.path.insert(1, os.path.join(ROOT, "resources", "data"))
+
+from scipy.integrate import solve_ivp
+
+from deterministic_models import model as model_module
+from deterministic_models import seir
+from deterministic_models.observation import ObservationModel, gamma_kernel, lognormal_kernel
+from stochastic_models.chain_binomial import SIR, SIR_REMOVAL_RATE, ChainBinomialModel
+from generate_ml_data import preprocess_data
+from ml_models.training import FEATURES, TARGET, get_data, prepare_data
+
+from bench_compiled_rhs import SEIRD, age_stratified_structure, setup as setup_model
+from bench_preprocess_data import synthetic_cases
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+CASES = {}
+
+
+def case(name, sizes, quick):
+    """Register setup(size) -> run as a benchmark, run() returns the number of RHS evaluations or None"""
+    def register(setup):
+        CASES[name] = {"setup": setup, "sizes": sizes, "quick": quick}
+        return setup
+    return register
+
+
+class SolverCounter:
+    """Replaces solve_ivp in a module and sums up nfev of all calls"""
+    def __init__(self, module):
+        self.module = module
+        self.nfev = 0
+
+    def __enter__(self):
+        self.original = self.module.solve_ivp
+
+        def counting(*args, **kwargs):
+            solution = self.original(*args, **kwargs)
+            self.nfev += solution.nfev
+            return solution
+
+        self.module.solve_ivp = counting
+        return self
+
+    def __exit__(self, *exc):
+        self.module.solve_ivp = self.original
+
+
+# modules that process pool workers and short-lived jobs import to build and solve models
+STARTUP_IMPORTS = ["deterministic_models.model", "deterministic_models.seir", "stochastic_models.chain_binomial",
+                   "ml_models.training"]
+
+
+@case("startup", sizes=[len(STARTUP_IMPORTS)], quick=[len(STARTUP_IMPORTS)])
+def bench_startup(modules):
+    # a fresh interpreter each run, the modules are cached in this one
+    command = [sys.executable, "-c", "; ".join("import " + name for name in STARTUP_IMPORTS[:modules])]
+
+    def run():
+        subprocess.run(command, cwd=ROOT, check=True)
+    return run
+
+
+@case("set_parameters", sizes=[1, 10, 50], quick=[1, 10])
+def bench_set_parameters(groups):
+    structure = SEIRD if groups == 1 else age_stratified_structure(groups)
+    model, _ = setup_model(structure, compiled=True)
+    parameters = dict(model.parameters)
+
+    def run():
+        for _ in range(100):
+            model.set_parameters(parameters)
+    return run
+
+
+@case("simulate", sizes=[1, 10, 50], quick=[1, 10])
+def bench_simulate(groups):
+    structure = SEIRD if groups == 1 else age_stratified_structure(groups)
+    model, y0 = setup_model(structure, compiled=True)
+
+    def run():
+        with SolverCounter(model_module) as counter:
+            model.simulate((0., 365.), y0, 365)
+        return counter.nfev
+    return run
+
+
+def _seir_parameters(samples, extended):
+    rng = np.random.default_rng(0)
+    parameters = {"N": 83e6, "R0": rng.uniform(1.5, 4., samples), "a": 1 / 5.5, "gamma": 1 / 9.}
+    if extended:
+        parameters.update(m=1e-4, theta_M=.8, theta_E=.0033, theta_I=.033)
+    return parameters
+
+
+@case("make_seir_ode", sizes=[1, 100, 1000], quick=[1, 100])
+def bench_seir(samples):
+    ode = seir.make_seir_ode(**_seir_parameters(samples, extended=False))
+    y0 = np.zeros(shape=(4, samples))
+    y0[0] = 83e6 - 50e3
+    y0[1] = 40e3
+    y0[2] = 10e3
+
+    def run():
+        return solve_ivp(ode, (0., 365.), y0.ravel(), rtol=1e-6).nfev
+    return run
+
+
+@case("make_extended_seir_ode", sizes=[1, 100, 1000], quick=[1, 100])
+def bench_extended_seir(samples):
+    ode = seir.make_extended_seir_ode(**_seir_parameters(samples, extended=True))
+    y0 = np.zeros(shape=(8, samples))
+    y0[0] = 83e6 - 1
+    y0[1] = 1
+
+    def run():
+        return solve_ivp(ode, (0., 365.), y0.ravel(), rtol=1e-6).nfev
+    return run
+
+
+@case("observation", sizes=[1, 100, 1000], quick=[1, 100])
+def bench_observation(samples):
+    # reported cumulative cases of a batch of simulations, as inside ModelFitter with the sensitivities
+    rng = np.random.default_rng(0)
+    t = np.arange(365.)
+    cumulative = np.cumsum(rng.uniform(0, 1e3, (samples, len(t))), axis=1)
+    observation = ObservationModel({"infected": gamma_kernel(5., 3.), "dead": lognormal_kernel(10., 5.)},
+                                   weekday_effects={"infected": [1.1, 1.1, 1.05, 1.05, 1., .8, .9]})
+
+    def run():
+        for _ in range(100):
+            observation.cumulative("infected", cumulative, t)
+            observation.cumulative("dead", cumulative, t)
+    return run
+
+
+@case("stochastic_sir", sizes=[100, 1000, 10000], quick=[100, 1000])
+def bench_stochastic(runs):
+    # the model of simple.py
+    N = 83e6
+    p = 0.33 / (97000 / 7290)
+    model = model_module.generate_model(SIR)
+    model.set_parameters({"N": N, "beta": 13.3 * p / 2, "L": SIR_REMOVAL_RATE})
+    engine = ChainBinomialModel(model)
+
+    def run():
+        engine.quantiles([N - 10, 10, 0], 300, runs=runs, q=(0.05, 0.5, 0.95), seed=0)
+    return run
+
+
+@case("preprocess_data", sizes=[1000, 10000, 100000], quick=[1000, 10000])
+def bench_preprocess_data(rows):
+    df, population = synthetic_cases(rows)
+
+    def run():
+        preprocess_data(df, population)
+    return run
+
+
+@case("get_data", sizes=[10000, 100000, 1000000], quick=[10000, 100000])
+def bench_get_data(rows):
+    # the columns of db_data_ml.csv used by ml_models/base_model.py
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({column: rng.uniform(0, 1e5, rows) for column in FEATURES})
+    df[TARGET] = np.where(rng.random(rows) < 0.2, np.nan, rng.uniform(0.5, 2., rows))
+    df["area1"] = np.where(rng.random(rows) < 0.3, None, "region")
+    df["area2"] = "country"
+    df["source"] = "JHU"
+
+    def run():
+        get_data(prepare_data(df))
+    return run
+
+
+def measure(name, size, repeat=3):
+    run = CASES[name]["setup"](size)
+    run()  # warm up caches and lazy imports
+
+    best = np.inf
+    rhs_evals = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rhs_evals = run()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"case": name, "size": size, "seconds": best, "rhs_evals": rhs_evals, "peak_bytes": peak}
+
+
+def git_commit():
+    """Current commit, with a -dirty suffix for uncommitted changes, or None outside of git"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(records, history, baseline=None, threshold=1.2):
+    """
+    Regressions of records against the baseline commit, by default the latest other commit in the
+    history: list of (record, baseline record) whose time or RHS evaluations grew by more than
+    threshold
+    """
+    commit = records[0]["commit"] if records else None
+    if baseline is None:
+        others = [r["commit"] for r in history if r["commit"] != commit]
+        if not others:
+            return []
+        baseline = others[-1]
+    reference = {(r["case"], r["size"]): r for r in history if r["commit"] == baseline}
+
+    regressions = []
+    for record in records:
+        old = reference.get((record["case"], record["size"]))
+        if old is None:
+            continue
+        slower = record["seconds"] > threshold * old["seconds"]
+        more_evals = record["rhs_evals"] is not None and old["rhs_evals"] is not None and \
+            record["rhs_evals"] > threshold * old["rhs_evals"]
+        if slower or more_evals:
+            regressions.append((record, old))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="only the small sizes")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated, default all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--history", default=HISTORY)
+    parser.add_argument("--baseline", default=None, help="commit to compare with, default the latest other one")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    run_info = {"commit": git_commit(), "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(), "numpy": np.__version__, "machine": platform.node()}
+
+    print("{:<24} {:>8} {:>12} {:>10} {:>12}".format("case", "size", "seconds", "rhs evals", "peak [MB]"))
+    records = []
+    for name in args.cases.split(","):
+        for size in CASES[name]["quick" if args.quick else "sizes"]:
+            record = dict(run_info, **measure(name, size, args.repeat))
+            records.append(record)
+            print("{:<24} {:>8} {:>12.4f} {:>10} {:>12.1f}".format(
+                name, size, record["seconds"], "-" if record["rhs_evals"] is None else record["rhs_evals"],
+                record["peak_bytes"] / 1e6))
+
+    history = load_history(args.history)
+    regressions = compare(records, history, args.baseline, args.threshold)
+    for record, old in regressions:
+        print("REGRESSION {} size {}: {:.4f}s -> {:.4f}s, rhs evals {} -> {} (baseline {})".format(
+            record["case"], record["size"], old["seconds"], record["seconds"], old["rhs_evals"],
+            record["rhs_evals"], old["commit"]))
+
+    with open(args.history, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+"""
+Deterministic compartment models: model.py (generate_model, CompartmentModel), seir.py and the
+fitting, forecasting and serving code built on them
+
+Nothing is imported here, so importing one module does not load the others.
+"""
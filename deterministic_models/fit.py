@@ -0,0 +1,328 @@
+import json
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import least_squares
+
+from .model import generate_model
+
+
+class FitResult:
+    """
+    Parameters of a CompartmentModel fitted to observed time series
+
+    The time-varying parameter holds one value per window. The windows start at t_start and at every
+    entry of windows.
+    """
+    def __init__(self, fit_parameters, varying, windows, t_start, x, cost=np.nan, nfev=0, success=True,
+                 message=""):
+        self.fit_parameters = list(fit_parameters)
+        self.varying = varying
+        self.windows = [float(w) for w in windows]
+        self.t_start = float(t_start)
+        self.x = np.asarray(x, dtype=float)
+        self.cost = float(cost)
+        self.nfev = int(nfev)
+        self.success = bool(success)
+        self.message = message
+
+    @property
+    def parameters(self):
+        res = {}
+        pos = 0
+        for name in self.fit_parameters:
+            if name == self.varying:
+                res[name] = self.x[pos:pos + len(self.windows) + 1].tolist()
+                pos += len(self.windows) + 1
+            else:
+                res[name] = float(self.x[pos])
+                pos += 1
+        return res
+
+    def segments(self):
+        """(t_switch, parameters) list for CompartmentModel.simulate_piecewise()"""
+        parameters = self.parameters
+        first = {name: (value[0] if name == self.varying else value) for name, value in parameters.items()}
+        res = [(self.t_start, first)]
+        if self.varying is not None:
+            res.extend((t, {self.varying: value}) for t, value in zip(self.windows, parameters[self.varying][1:]))
+        return res
+
+    def to_dict(self):
+        return {"fit_parameters": self.fit_parameters, "varying": self.varying, "windows": self.windows,
+                "t_start": self.t_start, "x": self.x.tolist(), "cost": self.cost, "nfev": self.nfev,
+                "success": self.success, "message": self.message}
+
+    @staticmethod
+    def from_dict(data):
+        return FitResult(**data)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return FitResult.from_dict(json.load(f))
+
+
+class ModelFitter:
+    """
+    Least squares calibration of a compiled CompartmentModel to observed time series
+
+    The gradient of the residuals is computed from the forward sensitivity equations
+    dS/dt = J(z) S + df/dp, which are integrated together with the model, so every evaluation of the
+    Jacobian costs one ODE solve instead of one solve per parameter.
+
+    Parameters
+    ----------
+    model
+        CompartmentModel with compile() applied (generate_model() does this by default)
+    observables
+        Maps the name of an observed series to the compartments that are summed up to obtain it, e.g.
+        {"infected": ["I", "R", "D"], "dead": ["D"]} for cumulative cases and deaths of SEIRD
+    fit_parameters
+        Names of the parameters in param_config that are calibrated. The others keep the values of
+        model.parameters
+    varying
+        Optional name of a parameter in fit_parameters that is piecewise constant in time
+    windows
+        Start times of the windows of the varying parameter after the first one
+    log
+        Compare log(1 + x) of model and data instead of the plain values, so that the early phase of
+        an outbreak is not dominated by the late one
+    observation
+        Optional ObservationModel (see observation.py) that maps the cumulative observables to reported
+        ones, by the names of observables. The model is then compared on every day from the first to the
+        last observation, days without data are skipped
+    """
+    def __init__(self, model, observables, fit_parameters=("beta", "gamma", "delta"), varying=None, windows=(),
+                 log=True, method="RK45", rtol=1e-6, observation=None):
+        assert model.compiled
+        assert varying is None or varying in fit_parameters
+
+        self.model = model
+        self.observables = observables
+        self.fit_parameters = list(fit_parameters)
+        self.varying = varying
+        self.windows = sorted(float(w) for w in windows) if varying is not None else []
+        self.log = log
+        self.method = method
+        self.rtol = rtol
+        self.observation = observation
+
+        names = list(model.param_config)
+        self._observable_index = [[model.compartments.index(c) for c in compartments]
+                                  for compartments in observables.values()]
+
+        # column of the parameter vector -> (transition, window or None for all windows)
+        self._columns = []
+        for name in self.fit_parameters:
+            r = names.index(name)
+            if name == varying:
+                self._columns.extend((r, w) for w in range(len(self.windows) + 1))
+            else:
+                self._columns.append((r, None))
+
+        self._cache_key = None
+        self._cache = None
+
+    def initial_guess(self):
+        x0 = []
+        for r, _ in self._columns:
+            x0.append(self.model.parameters[list(self.model.param_config)[r]])
+        return np.array(x0, dtype=float)
+
+    def _parameters_for_window(self, x, window):
+        parameters = dict(self.model.parameters)
+        names = list(self.model.param_config)
+        for value, (r, w) in zip(x, self._columns):
+            if w is None or w == window:
+                parameters[names[r]] = value
+        return parameters
+
+    def solve(self, x, t_obs, y0):
+        """
+        Integrate the model and its sensitivities with respect to the parameter vector x
+
+        Returns
+        -------
+        States of shape (n, len(t_obs)) and sensitivities of shape (n, len(x), len(t_obs))
+        """
+        model = self.model
+        n = len(model.compartments)
+        p = len(self._columns)
+        source, target = model._source, model._target
+
+        t_obs = np.asarray(t_obs, dtype=float)
+        Y = np.empty(shape=(n, len(t_obs)))
+        dY = np.empty(shape=(n, p, len(t_obs)))
+
+        starts = [t_obs[0]] + [w for w in self.windows if t_obs[0] < w < t_obs[-1]]
+        first_window = sum(w <= t_obs[0] for w in self.windows)
+        stops = starts[1:] + [t_obs[-1]]
+
+        state = np.zeros(n * (1 + p))
+        state[:n] = y0
+
+        base_parameters = model.parameters
+        try:
+            for segment, (t_start, t_stop) in enumerate(zip(starts, stops)):
+                window = first_window + segment
+                model.set_parameters(self._parameters_for_window(x, window))
+                active = [(c, r) for c, (r, w) in enumerate(self._columns) if w is None or w == window]
+
+                def augmented(t, s):
+                    z = s[:n]
+                    S = s[n:].reshape(n, p)
+                    u = model.transition_fluxes(z)
+
+                    dS = model.jacobian(t, z) @ S
+                    for c, r in active:
+                        dS[target[r], c] += u[r]
+                        dS[source[r], c] -= u[r]
+
+                    res = np.empty_like(s)
+                    res[:n] = model.rhs(t, z)
+                    res[n:] = dS.ravel()
+                    return res
+
+                solution = solve_ivp(augmented, (t_start, t_stop), state, method=self.method, rtol=self.rtol,
+                                     dense_output=True)
+
+                lo = np.searchsorted(t_obs, t_start)
+                hi = np.searchsorted(t_obs, t_stop) if t_stop < t_obs[-1] else len(t_obs)
+                values = solution.sol(t_obs[lo:hi])
+                Y[:, lo:hi] = values[:n]
+                dY[:, :, lo:hi] = values[n:].reshape(n, p, hi - lo)
+                state = solution.y[:, -1]
+        finally:
+            model.set_parameters(base_parameters)
+
+        return Y, dY
+
+    def _evaluate(self, x, t_obs, y0, observed, mask):
+        key = x.tobytes()
+        if key != self._cache_key:
+            Y, dY = self.solve(x, t_obs, y0)
+
+            residuals = []
+            jacobian = []
+            for name, index, data, valid in zip(self.observables, self._observable_index, observed, mask):
+                value = Y[index].sum(axis=0)
+                gradient = dY[index].sum(axis=0)
+                if self.observation is not None:
+                    # one batch for the series and its sensitivities
+                    reported = self.observation.cumulative(name, np.vstack([value, gradient]), t_obs)
+                    value, gradient = reported[0], reported[1:]
+                value = value[valid]
+                gradient = gradient[:, valid].T
+                if self.log:
+                    value = np.maximum(value, 0.)
+                    gradient = gradient / (1. + value)[:, None]
+                    residuals.append(np.log1p(value) - np.log1p(data[valid]))
+                else:
+                    residuals.append(value - data[valid])
+                jacobian.append(gradient)
+
+            self._cache_key = key
+            self._cache = np.concatenate(residuals), np.concatenate(jacobian)
+        return self._cache
+
+    def fit(self, t_obs, observations, y0, warm_start=None, **options):
+        """
+        Calibrate the parameters to the observations
+
+        Parameters
+        ----------
+        t_obs
+            Days of the observations, increasing. The integration starts at t_obs[0]
+        observations
+            Dict with one series of length len(t_obs) per key of observables, NaN entries are ignored
+        y0
+            Absolute state of the model at t_obs[0]
+        warm_start
+            FitResult of a previous run, e.g. of the day before, used as initial guess. Windows that
+            were added since then start at the value of the last known window
+        options
+            Passed on to scipy.optimize.least_squares
+
+        Returns
+        -------
+        FitResult
+        """
+        # the cache is keyed by x only, the residuals of a previous fit belong to other data
+        self._cache_key = None
+        t_obs = np.asarray(t_obs, dtype=float)
+        observed = [np.asarray(observations[name], dtype=float) for name in self.observables]
+        if self.observation is not None:
+            # the delays are convolved on a daily grid, missing days are NaN
+            days = np.round(t_obs - t_obs[0]).astype(int)
+            if not np.allclose(t_obs[0] + days, t_obs):
+                raise ValueError("observation models need observations on whole days")
+            daily = []
+            for data in observed:
+                values = np.full(days[-1] + 1, np.nan)
+                values[days] = data
+                daily.append(values)
+            observed = daily
+            t_obs = t_obs[0] + np.arange(days[-1] + 1.)
+        mask = [np.isfinite(data) for data in observed]
+
+        x0 = self.initial_guess() if warm_start is None else self._warm_start(warm_start)
+
+        options.setdefault("x_scale", "jac")
+        solution = least_squares(lambda x: self._evaluate(x, t_obs, y0, observed, mask)[0], x0,
+                                 jac=lambda x: self._evaluate(x, t_obs, y0, observed, mask)[1],
+                                 bounds=(0., np.inf), **options)
+
+        return FitResult(self.fit_parameters, self.varying, self.windows, t_obs[0], solution.x,
+                         cost=solution.cost, nfev=solution.nfev, success=solution.success,
+                         message=solution.message)
+
+    def _warm_start(self, previous):
+        x0 = self.initial_guess()
+        parameters = previous.parameters
+        pos = 0
+        for name in self.fit_parameters:
+            if name not in parameters:
+                pos += len(self.windows) + 1 if name == self.varying else 1
+            elif name == self.varying:
+                values = list(np.atleast_1d(parameters[name]))
+                values += values[-1:] * (len(self.windows) + 1 - len(values))
+                x0[pos:pos + len(self.windows) + 1] = values[:len(self.windows) + 1]
+                pos += len(self.windows) + 1
+            else:
+                x0[pos] = np.atleast_1d(parameters[name])[0]
+                pos += 1
+        # least_squares needs a strictly feasible starting point
+        return np.maximum(x0, 1e-8)
+
+
+def fit_seird(t_obs, infected, dead, N, I0=None, E0=0., windows=(), warm_start=None, observation=None):
+    """
+    Fit beta (piecewise constant in the given windows), gamma and delta of the SEIRD model to cumulative
+    confirmed cases and deaths. The incubation rate a stays fixed at 1/5.5 per day. observation is an
+    optional ObservationModel with the reporting delays of "infected" and "dead".
+    """
+    model = generate_model({"name": "SEIRD",
+                            "compartments": ["S", "E", "I", "R", "D"],
+                            "connections": [
+                                {"source": "S", "target": "E", "inhibitor": "I", "parameter": "beta"},
+                                {"source": "E", "target": "I", "parameter": "a"},
+                                {"source": "I", "target": "R", "parameter": "gamma"},
+                                {"source": "I", "target": "D", "parameter": "delta"}
+                            ]})
+    gamma = 1./9.
+    model.set_parameters({"N": N, "beta": 3.3 * gamma, "a": 1./5.5, "gamma": gamma, "delta": 0.005})
+
+    if I0 is None:
+        I0 = max(float(np.nan_to_num(infected[0])), 1.)
+    D0 = float(np.nan_to_num(dead[0]))
+    y0 = [N - (E0 + I0 + D0), E0, I0, 0., D0]
+
+    fitter = ModelFitter(model, {"infected": ["I", "R", "D"], "dead": ["D"]},
+                         fit_parameters=("beta", "gamma", "delta"), varying="beta", windows=windows,
+                         observation=observation)
+    return fitter.fit(t_obs, {"infected": infected, "dead": dead}, y0, warm_start=warm_start)
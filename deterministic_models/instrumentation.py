@@ -0,0 +1,328 @@
+"""
+Opt-in metrics of the ODE solves of CompartmentModel and seir.py
+
+Nothing is recorded unless a Recorder is enabled; disabled, every hook costs one attribute lookup.
+
+    from deterministic_models import instrumentation
+    with instrumentation.enable(sinks=[instrumentation.JSONLSink("solves.jsonl")]) as recorder:
+        model.simulate((0., 365.), y0, 365)
+    recorder.records[0].to_dict()
+
+Every instrumented call (CompartmentModel.simulate, simulate_piecewise, simulate_batch,
+seir.simulate_extended_seir, or a plain instrumentation.solve_ivp() call) gives one Metrics object
+with the RHS, Jacobian and LU counts, accepted steps, rejected steps (for the explicit Runge-Kutta
+methods), solver status and the wall time split into setup, solve and output phases. With
+trace_allocations=True, the memory allocated inside the right-hand side is traced with tracemalloc,
+which slows down the solve considerably.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+_recorder = None
+_local = threading.local()
+
+# right-hand side evaluations per step attempt of the explicit Runge-Kutta methods, and per accepted
+# step if dense output is requested
+RK_STAGES = {"RK23": (3, 0), "RK45": (6, 0), "DOP853": (12, 3)}
+
+
+def _scipy_solve_ivp(fun, t_span, y0, **options):
+    # scipy.integrate takes longer to import than all of model.py and seir.py, so it is only loaded
+    # by the first solve
+    from scipy.integrate import solve_ivp
+    return solve_ivp(fun, t_span, y0, **options)
+
+
+def _counting_method(method, counter):
+    # subclass of the solver class that counts the accepted steps in counter[0], without the cost of
+    # dense output
+    if isinstance(method, str):
+        import scipy.integrate
+        method = getattr(scipy.integrate, method)
+
+    class Counting(method):
+        def _step_impl(self):
+            success, message = super()._step_impl()
+            if success:
+                counter[0] += 1
+            return success, message
+
+    return Counting
+
+
+class Metrics:
+    """Solver statistics and timings of one instrumented call"""
+    def __init__(self, name):
+        self.name = name
+        self.solves = 0
+        self.nfev = 0
+        self.njev = 0
+        self.nlu = 0
+        self.accepted_steps = 0
+        self.rejected_steps = 0
+        self.status = 0
+        self.message = ""
+        self.setup_seconds = 0.
+        self.solve_seconds = 0.
+        self.output_seconds = 0.
+        self.rhs_seconds = 0.
+        self.rhs_alloc_bytes = None
+        self.rhs_alloc_peak = None
+
+    @property
+    def total_seconds(self):
+        return self.setup_seconds + self.solve_seconds + self.output_seconds
+
+    def to_dict(self):
+        res = dict(vars(self))
+        res["total_seconds"] = self.total_seconds
+        return res
+
+
+class Recorder:
+    """
+    Collects the Metrics of all instrumented calls and passes them on to the sinks
+
+    Parameters
+    ----------
+    sinks
+        Objects with emit(metrics) and close(), e.g. JSONLSink or PrometheusSink
+    trace_allocations
+        Trace the memory allocated inside the right-hand side
+    keep
+        Keep the Metrics in records, disable for long batch runs that only write to sinks
+    """
+    def __init__(self, sinks=(), trace_allocations=False, keep=True):
+        self.sinks = list(sinks)
+        self.trace_allocations = trace_allocations
+        self.keep = keep
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, metrics):
+        with self._lock:
+            if self.keep:
+                self.records.append(metrics)
+            for sink in self.sinks:
+                sink.emit(metrics)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        disable()
+
+
+def enable(sinks=(), trace_allocations=False, keep=True):
+    """Start recording, returns the Recorder, which can also be used as a context manager"""
+    global _recorder
+    disable()
+    _recorder = Recorder(sinks, trace_allocations, keep)
+    return _recorder
+
+
+def disable():
+    """Stop recording and close the sinks"""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+    return recorder
+
+
+class _Call:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.metrics = Metrics(name)
+        self.start = time.perf_counter()
+        self.first_solve = None
+
+    def solve(self, fun, t_span, y0, **options):
+        metrics = self.metrics
+        trace = self.recorder.trace_allocations
+
+        def counted(t, y, *args):
+            if trace:
+                before = tracemalloc.get_traced_memory()[0]
+                if reset_peak:
+                    tracemalloc.reset_peak()
+            start = time.perf_counter()
+            dy = fun(t, y, *args)
+            metrics.rhs_seconds += time.perf_counter() - start
+            if trace:
+                # without reset_peak() (Python < 3.9) only the memory still held after the call is seen
+                allocated = tracemalloc.get_traced_memory()[1 if reset_peak else 0] - before
+                metrics.rhs_alloc_bytes += allocated
+                metrics.rhs_alloc_peak = max(metrics.rhs_alloc_peak, allocated)
+            return dy
+
+        reset_peak = hasattr(tracemalloc, "reset_peak")
+        method = options.pop("method", "RK45")
+        steps = [0]
+        if trace and metrics.rhs_alloc_bytes is None:
+            metrics.rhs_alloc_bytes = 0
+            metrics.rhs_alloc_peak = 0
+        tracing = trace and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        if self.first_solve is None:
+            self.first_solve = start
+        try:
+            solution = _scipy_solve_ivp(counted, t_span, y0, method=_counting_method(method, steps), **options)
+        finally:
+            if tracing:
+                tracemalloc.stop()
+        metrics.solve_seconds += time.perf_counter() - start
+
+        accepted = steps[0]
+        metrics.solves += 1
+        metrics.nfev += solution.nfev
+        metrics.njev += solution.njev
+        metrics.nlu += solution.nlu
+        metrics.accepted_steps += accepted
+        if isinstance(method, str) and method in RK_STAGES and metrics.rejected_steps is not None:
+            stages, dense_stages = RK_STAGES[method]
+            if not options.get("dense_output", False):
+                dense_stages = 0
+            attempts = (solution.nfev - 2 - dense_stages * accepted) // stages
+            metrics.rejected_steps += max(attempts - accepted, 0)
+        else:
+            metrics.rejected_steps = None
+        metrics.status = solution.status
+        metrics.message = solution.message
+        return solution
+
+    def finish(self):
+        end = time.perf_counter()
+        metrics = self.metrics
+        if self.first_solve is None:
+            metrics.setup_seconds = end - self.start
+        else:
+            metrics.setup_seconds = self.first_solve - self.start
+            metrics.output_seconds = max(end - self.start - metrics.setup_seconds - metrics.solve_seconds, 0.)
+        self.recorder.emit(metrics)
+
+
+def instrumented(name=None):
+    """
+    Decorator that records one Metrics object per call of the decorated function, for all solves of
+    instrumentation.solve_ivp() inside it. name is a string, or a function of the call arguments,
+    by default the name of the function.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None or getattr(_local, "call", None) is not None:
+                return function(*args, **kwargs)
+            label = name(*args, **kwargs) if callable(name) else name or function.__name__
+            _local.call = call = _Call(recorder, label)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _local.call = None
+                call.finish()
+        return wrapper
+    return decorator
+
+
+def solve_ivp(fun, t_span, y0, **options):
+    """scipy.integrate.solve_ivp() that records its statistics while a Recorder is enabled"""
+    recorder = _recorder
+    if recorder is None:
+        return _scipy_solve_ivp(fun, t_span, y0, **options)
+
+    call = getattr(_local, "call", None)
+    if call is not None:
+        return call.solve(fun, t_span, y0, **options)
+
+    call = _Call(recorder, getattr(fun, "__name__", "solve_ivp"))
+    try:
+        return call.solve(fun, t_span, y0, **options)
+    finally:
+        call.finish()
+
+
+class JSONLSink:
+    """Appends one JSON line per Metrics to path"""
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def emit(self, metrics):
+        self.file.write(json.dumps(dict(metrics.to_dict(), time=time.time())) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PrometheusSink:
+    """
+    Counters per call name in the text format of the Prometheus node exporter textfile collector
+
+    The file is replaced atomically every flush_every emitted calls and on close().
+    """
+    COUNTERS = [("calls", "instrumented calls", None),
+                ("rhs_evaluations", "right-hand side evaluations", "nfev"),
+                ("jacobian_evaluations", "Jacobian evaluations", "njev"),
+                ("accepted_steps", "accepted solver steps", "accepted_steps"),
+                ("rejected_steps", "rejected solver steps of explicit Runge-Kutta methods", "rejected_steps"),
+                ("failed", "calls with a failed solve", None)]
+    PHASES = ["setup", "solve", "output"]
+
+    def __init__(self, path, prefix="challenge1757_ode", flush_every=100):
+        self.path = path
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self.values = {}
+        self._pending = 0
+
+    def emit(self, metrics):
+        values = self.values.setdefault(metrics.name, dict.fromkeys(
+            [c for c, _, _ in self.COUNTERS] + ["seconds_" + p for p in self.PHASES], 0))
+        values["calls"] += 1
+        values["failed"] += metrics.status < 0
+        for counter, _, attribute in self.COUNTERS:
+            if attribute is not None:
+                values[counter] += getattr(metrics, attribute) or 0
+        for phase in self.PHASES:
+            values["seconds_" + phase] += getattr(metrics, phase + "_seconds")
+
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        lines = []
+        for counter, description, _ in self.COUNTERS:
+            metric = "{}_{}_total".format(self.prefix, counter)
+            lines.extend(["# HELP {} Number of {}".format(metric, description), "# TYPE {} counter".format(metric)])
+            lines.extend('{}{{model="{}"}} {}'.format(metric, _label(name), values[counter])
+                         for name, values in self.values.items())
+        metric = "{}_seconds_total".format(self.prefix)
+        lines.extend(["# HELP {} Wall time by phase".format(metric), "# TYPE {} counter".format(metric)])
+        for name, values in self.values.items():
+            lines.extend('{}{{model="{}",phase="{}"}} {}'.format(metric, _label(name), phase, values["seconds_" + phase])
+                         for phase in self.PHASES)
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+        self._pending = 0
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,159 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.integrate import solve_ivp
+
+
+def combine_contacts(age_contact, mobility):
+    """
+    Contact matrix of age groups within districts, strata are ordered district by district
+
+    The entry for stratum (d, a) and (e, b) is mobility[d, e] * age_contact[a, b].
+    """
+    return sp.kron(sp.csr_matrix(mobility), sp.csr_matrix(age_contact), format="csr")
+
+
+class StratifiedModel:
+    """
+    Compartment structure of a CompartmentModel replicated for many strata (age groups, districts, ...)
+
+    L transitions act within every stratum. A Q transition from source to target with inhibitor I has
+    the flux beta_s * source_s * sum_r C[s, r] * I_r / N_r in stratum s, where C is the contact or
+    mobility matrix and N_r the population of stratum r. All operators are scipy.sparse, so one
+    evaluation of the right-hand side costs O(nnz).
+
+    The state is stored compartment by compartment, i.e. entry c * strata + s is compartment c in
+    stratum s.
+
+    Parameters
+    ----------
+    model
+        CompartmentModel defining compartments, transitions and default parameters, e.g. from
+        generate_model()
+    population
+        Population of every stratum
+    contact
+        Square matrix (dense or sparse) with one row and column per stratum
+    parameters
+        Overrides of model.parameters, every value is a scalar or one value per stratum
+    """
+    def __init__(self, model, population, contact, parameters=None):
+        self.name = model.name
+        self.compartments = list(model.compartments)
+        self.population = np.asarray(population, dtype=float)
+        self.strata = len(self.population)
+        self.contact = sp.csr_matrix(contact)
+        assert self.contact.shape == (self.strata, self.strata)
+
+        self.param_config = model.param_config
+        self.parameters = dict(model.parameters)
+        self.set_parameters(parameters or {})
+
+    def _rate(self, name):
+        return np.broadcast_to(np.asarray(self.parameters[name], dtype=float), (self.strata,))
+
+    def set_parameters(self, parameters):
+        self.parameters.update(parameters)
+
+        n = len(self.compartments)
+        S = self.strata
+        strata = np.arange(S)
+
+        rows, cols, values = [], [], []
+        self._quadratic = []
+        for name, param in self.param_config.items():
+            i = param['source']
+            j = param['target']
+            rate = self._rate(name)
+            if param['type'] == 'L':
+                rows.extend([i * S + strata, j * S + strata])
+                cols.extend([i * S + strata, i * S + strata])
+                values.extend([-rate, rate])
+            elif param['type'] == 'Q':
+                self._quadratic.append((i, j, param['inhibitor'], rate))
+
+        size = n * S
+        if rows:
+            self.L = sp.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(size, size))
+        else:
+            self.L = sp.csr_matrix((size, size))
+        # contact matrix weighted by the inverse population of the infecting stratum
+        self._C = self.contact @ sp.diags(1. / self.population)
+
+    def rhs(self, t, z):
+        Z = z.reshape(len(self.compartments), self.strata)
+        dz = self.L @ z
+        dZ = dz.reshape(Z.shape)
+        for i, j, k, rate in self._quadratic:
+            flux = rate * Z[i] * (self._C @ Z[k])
+            dZ[i] -= flux
+            dZ[j] += flux
+        return dz
+
+    def jacobian(self, t, z):
+        Z = z.reshape(len(self.compartments), self.strata)
+        n = len(self.compartments)
+        S = self.strata
+
+        blocks = [[None] * n for _ in range(n)]
+
+        def add(row, col, matrix):
+            blocks[row][col] = matrix if blocks[row][col] is None else blocks[row][col] + matrix
+
+        for i, j, k, rate in self._quadratic:
+            d_source = sp.diags(rate * (self._C @ Z[k]))
+            d_inhibitor = sp.diags(rate * Z[i]) @ self._C
+            add(i, i, -d_source)
+            add(j, i, d_source)
+            add(i, k, -d_inhibitor)
+            add(j, k, d_inhibitor)
+
+        for row in range(n):
+            if blocks[row][row] is None:
+                blocks[row][row] = sp.csr_matrix((S, S))
+        return (self.L + sp.bmat(blocks, format="csr")).tocsc()
+
+    def simulate(self, t_span, initial_value, output_nsteps=None, method='RK45'):
+        """
+        Integrate all strata together
+
+        Parameters
+        ----------
+        initial_value
+            Array of shape (compartments, strata) with absolute numbers
+
+        Returns
+        -------
+        Dict with an array of shape (strata, time) of absolute numbers per compartment, plus the
+        times, name, parameters and compartments as in CompartmentModel.simulate()
+        """
+        z0 = np.asarray(initial_value, dtype=float)
+        assert z0.shape == (len(self.compartments), self.strata)
+
+        # the sparse Jacobian helps for stiff problems with few strata; with dense coupling between many
+        # strata its LU factorization fills in, and the explicit methods are much faster
+        options = {}
+        if output_nsteps is not None:
+            options['t_eval'] = np.linspace(t_span[0], t_span[1], output_nsteps + 1)
+        if method in ('Radau', 'BDF'):
+            options['jac'] = self.jacobian
+
+        solution = solve_ivp(self.rhs, t_span, z0.ravel(), method=method, **options)
+
+        y = solution.y.reshape(len(self.compartments), self.strata, -1)
+        res = {c: y[i] for i, c in enumerate(self.compartments)}
+        res['t'] = solution.t
+        res['name'] = self.name
+        res['parameters'] = self.parameters
+        res['compartments'] = self.compartments
+
+        return res
+
+    def aggregate(self, result, groups):
+        """Sum the strata of a simulate() result by an integer group label per stratum"""
+        groups = np.asarray(groups)
+        indicator = sp.csr_matrix((np.ones(self.strata), (groups, np.arange(self.strata))))
+        res = dict(result)
+        for c in self.compartments:
+            res[c] = indicator @ result[c]
+        return res
@@ -1,6 +1,10 @@
 import numpy as np
-from scipy.integrate import solve_ivp
-from matplotlib import pyplot as plt
+
+from .instrumentation import instrumented, solve_ivp
+
+
+def _model_name(model, *args, **kwargs):
+    return model.name
 
 
 class CompartmentModel:
@@ -13,8 +17,10 @@ class CompartmentModel:
         self.MI = np.zeros(shape=(n, n))
 
         self.param_config = {}
+        self._quadratic_terms()
         self.N = 1.0
         self.parameters = {"N": self.N}
+        self.compiled = False
 
     def add_transition(self, source: str, target: str, parameter: str, inhibitor: str = None):
         i = self.compartments.index(source)
@@ -27,12 +33,16 @@ class CompartmentModel:
         else:
             k = self.compartments.index(inhibitor)
             self.param_config[parameter] = {'type': 'Q', 'source': i, 'target': j, 'inhibitor': k}
+            self.MI[i, k] += 1.0
+            self.MI[j, k] += 1.0
+            self._quadratic_terms()
 
     def set_parameters(self, parameters):
         n = len(self.compartments)
         self.R = np.zeros(shape=(n, n))
         self.MR = np.zeros(shape=(n, n))
         self.MI = np.zeros(shape=(n, n))
+        self.MQ = np.zeros(shape=(n, len(self._q_names)))
 
         self.parameters = parameters
         self.N = self.parameters["N"]
@@ -52,27 +62,250 @@ class CompartmentModel:
                 self.MI[i, k] += 1.0
                 self.MI[j, k] += 1.0
 
-    def simulate(self, t_span, initial_value, output_nsteps):
-        assert len(initial_value) == len(self.compartments)
-        z0 = np.array(initial_value)
+        for col, name in enumerate(self._q_names):
+            self.MQ[self._q_source[col], col] -= parameters[name]
+            self.MQ[self._q_target[col], col] += parameters[name]
+
+        if self.compiled:
+            self._rates = np.array([parameters[name] for name in self.param_config], dtype=float)
+
+    def _quadratic_terms(self):
+        # source, target and inhibitor of every Q transition in param_config order, MQ holds their rates
+        names = [name for name, param in self.param_config.items() if param['type'] == 'Q']
+        self._q_names = names
+        self._q_source = np.array([self.param_config[name]['source'] for name in names], dtype=int)
+        self._q_target = np.array([self.param_config[name]['target'] for name in names], dtype=int)
+        self._q_inhibitor = np.array([self.param_config[name]['inhibitor'] for name in names], dtype=int)
+        self.MQ = np.zeros(shape=(len(self.compartments), len(names)))
+
+    def dense_rhs(self, t, z):
+        """
+        Right-hand side from dense matrix products, used unless compile() was called
+
+        Every Q transition contributes rate * source * inhibitor / N on its own, so a compartment may
+        be infected through several inhibitors, e.g. by contacts across age groups. If every compartment
+        takes part in at most one Q transition this equals R z + (MI z) * (MR z / N).
+        """
+        return self.R @ z + self.MQ @ (z[self._q_source] * z[self._q_inhibitor] / self.N)
+
+    def compile(self):
+        """
+        Build index arrays of the transitions in param_config, so that rhs() and jacobian()
+        only evaluate the nonzero linear (L) and quadratic (Q) terms instead of dense
+        matrix products. The result is the same as dense_rhs().
+        """
+        config = list(self.param_config.values())
+        n = len(self.compartments)
 
-        def odefun(t, z):
-            res =  self.R @ z + (self.MI @ z) * (self.MR @ z/self.N)
-            return res
+        self._source = np.array([param['source'] for param in config], dtype=int)
+        self._target = np.array([param['target'] for param in config], dtype=int)
+        self._inhibitor = np.array([param.get('inhibitor', -1) for param in config], dtype=int)
+        self._quadratic = np.flatnonzero(self._inhibitor >= 0)
+
+        # flat (row * n + col) positions of the Jacobian entries, see jacobian()
+        src, tgt, inh = self._source, self._target, self._inhibitor
+        q = self._quadratic
+        self._jac_index = np.concatenate([tgt * n + src, src * n + src,
+                                          tgt[q] * n + inh[q], src[q] * n + inh[q]])
 
-        solution = solve_ivp(odefun, t_span, z0)
+        self._rates = np.array([self.parameters[name] for name in self.param_config], dtype=float)
+        self.compiled = True
 
+    def transition_fluxes(self, z):
+        """Flux of every transition per unit rate, in param_config order (requires compile())"""
+        u = z[self._source]
+        q = self._quadratic
+        u[q] *= z[self._inhibitor[q]] / self.N
+        return u
+
+    def rhs(self, t, z):
+        n = len(self.compartments)
+        flux = self._rates * self.transition_fluxes(z)
+        return np.bincount(self._target, flux, minlength=n) - np.bincount(self._source, flux, minlength=n)
+
+    def jacobian(self, t, z):
         n = len(self.compartments)
-        res = {self.compartments[i]: solution.y[i]/self.N*100 for i in range(0, n)}
-        res['t'] = solution.t
+        q = self._quadratic
+
+        d_source = self._rates.copy()
+        d_source[q] *= z[self._inhibitor[q]] / self.N
+        d_inhibitor = self._rates[q] * z[self._source[q]] / self.N
+
+        values = np.concatenate([d_source, -d_source, d_inhibitor, -d_inhibitor])
+        return np.bincount(self._jac_index, values, minlength=n * n).reshape(n, n)
+
+    def _solve(self, t_span, z0, method, **options):
+        odefun = self.rhs if self.compiled else self.dense_rhs
+
+        if self.compiled and method in ('Radau', 'BDF', 'LSODA'):
+            options['jac'] = self.jacobian
+
+        return solve_ivp(odefun, t_span, z0, method=method, **options)
+
+    def _result(self, t, y):
+        n = len(self.compartments)
+        res = {self.compartments[i]: y[i]/self.N*100 for i in range(0, n)}
+        res['t'] = t
         res['name'] = self.name
         res['parameters'] = self.parameters
         res['compartments'] = self.compartments
 
         return res
 
+    @instrumented(_model_name)
+    def simulate(self, t_span, initial_value, output_nsteps=None, method='RK45'):
+        """
+        Integrate the model over t_span. The result holds output_nsteps + 1 equidistant time points
+        including both ends of t_span, or the adaptive solver steps if output_nsteps is None.
+        """
+        assert len(initial_value) == len(self.compartments)
+        z0 = np.array(initial_value, dtype=float)
+
+        if output_nsteps is None:
+            solution = self._solve(t_span, z0, method)
+        else:
+            t = np.linspace(t_span[0], t_span[1], output_nsteps + 1)
+            solution = self._solve(t_span, z0, method, t_eval=t)
+
+        return self._result(solution.t, solution.y)
+
+    @instrumented(_model_name)
+    def simulate_piecewise(self, segments, t_end, initial_value, output_nsteps, method='RK45'):
+        """
+        Integrate across interventions with piecewise constant parameters in one call
+
+        Parameters
+        ----------
+        segments
+            List of (t_switch, parameters) sorted by time. The first t_switch is the start time. Each
+            parameters dict updates the parameters that were active before the switch, so it only needs
+            the changed entries.
+        t_end
+            End of the last segment
+        initial_value
+            State at the first t_switch
+        output_nsteps
+            Number of equidistant output steps between the first t_switch and t_end
+
+        Returns
+        -------
+        Same as simulate(), plus the segments. The parameters of the model are left unchanged.
+        """
+        assert len(initial_value) == len(self.compartments)
+        n = len(self.compartments)
+
+        t = np.linspace(segments[0][0], t_end, output_nsteps + 1)
+        y = np.empty(shape=(n, len(t)))
+        z = np.array(initial_value, dtype=float)
+
+        base_parameters = self.parameters
+        parameters = dict(base_parameters)
+        t_stops = [t_switch for t_switch, _ in segments[1:]] + [t_end]
+
+        try:
+            for (t_start, update), t_stop in zip(segments, t_stops):
+                parameters.update(update)
+                self.set_parameters(dict(parameters))
+
+                lo = np.searchsorted(t, t_start)
+                hi = np.searchsorted(t, t_stop) if t_stop < t_end else len(t)
+                if t_stop > t_start:
+                    solution = self._solve((t_start, t_stop), z, method, dense_output=True)
+                    y[:, lo:hi] = solution.sol(t[lo:hi])
+                    z = solution.y[:, -1]
+                else:
+                    y[:, lo:hi] = z[:, None]
+
+            res = self._result(t, y)
+        finally:
+            self.set_parameters(base_parameters)
+
+        res['parameters'] = base_parameters
+        res['segments'] = segments
+
+        return res
+
+    def stack_parameters(self, param_matrix):
+        """
+        Stack the linear and quadratic rate matrices of many parameter sets
+
+        Parameters
+        ----------
+        param_matrix
+            Array of shape (ensemble, len(param_config)); column j holds the values of the
+            j-th parameter in param_config order
 
-def generate_model(model_structure):
+        Returns
+        -------
+        Array of shape (ensemble, 2, n, n), where [:, 0] is R and [:, 1] is MR of every member
+        """
+        param_matrix = np.atleast_2d(np.asarray(param_matrix, dtype=float))
+        return np.stack([self._rate_layer(param_matrix, 'L'), self._rate_layer(param_matrix, 'Q')], axis=1)
+
+    def _rate_layer(self, param_matrix, kind):
+        # rate matrices of shape (ensemble, n, n) from the parameters of type kind ('L' or 'Q')
+        assert param_matrix.shape[1] == len(self.param_config)
+
+        n = len(self.compartments)
+        layer = np.zeros(shape=(param_matrix.shape[0], n, n))
+
+        for col, param in enumerate(self.param_config.values()):
+            if param['type'] != kind:
+                continue
+            i = param['source']
+            j = param['target']
+
+            layer[:, i, i] -= param_matrix[:, col]
+            layer[:, j, i] += param_matrix[:, col]
+
+        return layer
+
+    @instrumented(_model_name)
+    def simulate_batch(self, param_matrix, y0_matrix, t_eval):
+        """
+        Integrate an ensemble of parameter sets and initial values in a single solve_ivp call
+
+        Parameters
+        ----------
+        param_matrix
+            Array of shape (ensemble, len(param_config)), see stack_parameters()
+        y0_matrix
+            Array of shape (ensemble, len(compartments)) with the initial values
+        t_eval
+            Times at which the solution is stored, the first entry is the start time
+
+        Returns
+        -------
+        Array of shape (ensemble, compartment, time) in percent of N, like simulate()
+        """
+        param_matrix = np.atleast_2d(np.asarray(param_matrix, dtype=float))
+        R = self._rate_layer(param_matrix, 'L')
+        z0 = np.atleast_2d(np.asarray(y0_matrix, dtype=float))
+        assert z0.shape == (R.shape[0], len(self.compartments))
+
+        t_eval = np.asarray(t_eval, dtype=float)
+        shape = z0.shape
+        N = self.N
+
+        # Q transitions as in dense_rhs(): the rates of every member times the change of each compartment
+        columns = list(self.param_config)
+        rates = param_matrix[:, [columns.index(name) for name in self._q_names]]
+        change = np.zeros(shape=(len(self._q_names), shape[1]))
+        change[np.arange(len(self._q_names)), self._q_source] -= 1.
+        change[np.arange(len(self._q_names)), self._q_target] += 1.
+        source, inhibitor = self._q_source, self._q_inhibitor
+
+        def odefun(t, z):
+            z = z.reshape(shape)
+            res = np.einsum('kij,kj->ki', R, z) + (rates * z[:, source] * z[:, inhibitor] / N) @ change
+            return res.ravel()
+
+        solution = solve_ivp(odefun, (t_eval[0], t_eval[-1]), z0.ravel(), t_eval=t_eval)
+
+        return solution.y.reshape(shape + (len(t_eval),)) / N * 100
+
+
+def generate_model(model_structure, compiled=True):
     compartments = model_structure["compartments"]
     connections = model_structure["connections"]
     name = model_structure["name"]
@@ -87,10 +320,14 @@ def generate_model(model_structure):
             model.add_transition(source=connection["source"], target=connection["target"],
                                  parameter=connection["parameter"])
 
+    if compiled:
+        model.compile()
+
     return model
 
 
-if __name__ == '__main__':
+def main():
+    from matplotlib import pyplot as plt
 
     seird = {"name": "SEIRD 1",
              "compartments": ["S", "E", "I", "R", "D"],
@@ -128,40 +365,11 @@ if __name__ == '__main__':
     print(model.R)
     print(model.MR)
     print(model.MI)
-    data0 = model.simulate(t_span=(t0, t1), initial_value=y0, output_nsteps=8*int(t1-t0))
-
-    S = data0["S"].tolist()
-    E = data0["E"].tolist()
-    I = data0["I"].tolist()
-    R = data0["R"].tolist()
-    D = data0["D"].tolist()
-
-    time = data0["t"].tolist()
-
-    scale = model.N / 100.0
-    y1 = [S[-1]*scale, E[-1]*scale, I[-1]*scale, R[-1]*scale, D[-1]*scale]
-    print(y1)
-    para2 = model.parameters
-    R0 = 1.0
-    para2["beta"] = gamma * R0
-    model.set_parameters(para2)
-
-    data1 = model.simulate(t_span=(t1, t2), initial_value=y1, output_nsteps=8*int(t2-t1))
-
-    S.extend(data1["S"].tolist()[1:])
-    E.extend(data1["E"].tolist()[1:])
-    I.extend(data1["I"].tolist()[1:])
-    R.extend(data1["R"].tolist()[1:])
-    D.extend(data1["D"].tolist()[1:])
-    time.extend(data1["t"].tolist()[1:])
-
-    plot_data = {
-        "S": S,
-        "E": E,
-        "I": I,
-        "R": R,
-        "D": D
-    }
+    segments = [(t0, {"beta": gamma * R0}),
+                (t1, {"beta": gamma * 1.0})]
+    plot_data = model.simulate_piecewise(segments, t_end=t2, initial_value=y0, output_nsteps=8*int(t2-t0))
+    time = plot_data["t"]
+
     plot_opts = {"S": None, "E": "b-", "I": "m-", "R": "g", "D": "r-"}
 
 
@@ -174,3 +382,6 @@ if __name__ == '__main__':
     plt.legend()
     plt.show()
 
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Observation model: from simulated to reported counts
+
+Reports lag behind the simulated compartments by the time it takes to test, evaluate and report a case.
+Instead of shifting the simulation by a fixed number of days, the delay is a distribution: simulated
+series are convolved with a discretized gamma or lognormal kernel, and the daily reported counts are
+scaled by weekday effects (fewer reports on weekends, catch-up on Mondays).
+
+All functions work on whole batches, i.e. on arrays of shape (..., time), and convolve by FFT, so one
+call maps e.g. a model solution together with all its parameter sensitivities:
+
+    observation = ObservationModel({"infected": gamma_kernel(4., 2.), "dead": lognormal_kernel(10., 5.)},
+                                   weekday_effects={"infected": [1.1, 1.1, 1.05, 1.05, 1., .8, .9]})
+    reported = observation.cumulative("infected", simulated, t)
+
+Days t are counted from 2020-01-01 as the date column of db_data_ml.csv, which fixes the weekdays.
+"""
+import numpy as np
+
+# weekday of t = 0 (2020-01-01 was a Wednesday), Monday is 0
+EPOCH_WEEKDAY = 2
+
+
+def _discretize(cdf, max_delay, dt):
+    # probability of a delay that rounds to k dt, truncated at max_delay and normalized
+    steps = int(np.ceil(np.max(max_delay) / dt))
+    edges = (np.arange(steps + 2) - .5) * dt
+    edges[0] = 0.
+    probabilities = np.diff(cdf(edges), axis=-1)
+    return probabilities / probabilities.sum(axis=-1, keepdims=True)
+
+
+def gamma_kernel(mean, sd, dt=1., max_delay=None):
+    """
+    Discretized gamma distributed delay
+
+    Parameters
+    ----------
+    mean, sd
+        Mean and standard deviation of the delay in days, numbers or arrays with one value per sample
+    dt
+        Step of the series the kernel is applied to, in days
+    max_delay
+        Longest delay in days, by default mean + 6 sd (of the largest sample)
+
+    Returns
+    -------
+    Array of shape (..., delays) with the probability of a delay of k dt in column k
+    """
+    from scipy.special import gammainc
+
+    mean = np.asarray(mean, dtype=float)[..., None]
+    sd = np.asarray(sd, dtype=float)[..., None]
+    shape = (mean / sd) ** 2
+    scale = sd ** 2 / mean
+    return _discretize(lambda x: gammainc(shape, x / scale), mean + 6 * sd if max_delay is None else max_delay, dt)
+
+
+def lognormal_kernel(mean, sd, dt=1., max_delay=None):
+    """Discretized lognormal distributed delay with the given mean and standard deviation, see gamma_kernel()"""
+    from scipy.special import ndtr
+
+    mean = np.asarray(mean, dtype=float)[..., None]
+    sd = np.asarray(sd, dtype=float)[..., None]
+    sigma = np.sqrt(np.log1p((sd / mean) ** 2))
+    mu = np.log(mean) - sigma ** 2 / 2
+
+    def cdf(x):
+        with np.errstate(divide="ignore"):
+            return ndtr((np.log(x) - mu) / sigma)
+    return _discretize(cdf, mean + 6 * sd if max_delay is None else max_delay, dt)
+
+
+def fast_length(n):
+    """Smallest 2^a 3^b 5^c >= n, FFTs of these lengths are the fastest"""
+    best = 1 << max(n - 1, 0).bit_length()
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            length = power35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+def convolve(x, kernel, spectrum=None):
+    """
+    Causal convolution along the last axis, out[..., t] = sum_k kernel[..., k] x[..., t - k]
+
+    x and kernel broadcast over the leading axes. spectrum is an optional precomputed
+    np.fft.rfft(kernel, fast_length(x.shape[-1] + kernel.shape[-1] - 1)).
+    """
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
+    size = fast_length(n + np.shape(kernel)[-1] - 1)
+    if spectrum is None:
+        spectrum = np.fft.rfft(kernel, size)
+    return np.fft.irfft(np.fft.rfft(x, size) * spectrum, size)[..., :n]
+
+
+def weekdays(t):
+    """Weekday (Monday is 0) of the days t since 2020-01-01"""
+    return (np.floor(np.asarray(t)).astype(int) + EPOCH_WEEKDAY) % 7
+
+
+def estimate_weekday_effects(counts, t):
+    """
+    Weekday effects of daily reported counts: the geometric mean per weekday of the ratio to the
+    centered 7 day mean, normalized to a mean of 1. Days without reports or with an incomplete
+    window are ignored.
+    """
+    counts = np.asarray(counts, dtype=float)
+    window = np.convolve(counts, np.ones(7) / 7, mode="same")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.log(counts / window)
+    valid = np.isfinite(ratio)
+    valid[:3] = valid[-3:] = False
+    day = weekdays(t)
+    effects = np.array([np.exp(ratio[valid & (day == d)].mean()) if (valid & (day == d)).any() else 1.
+                        for d in range(7)])
+    return effects / effects.mean()
+
+
+class ObservationModel:
+    """
+    Delays and weekday effects per observed series
+
+    Parameters
+    ----------
+    kernels
+        Dict series name -> delay kernel on the time step dt, e.g. from gamma_kernel(); series without
+        a kernel are reported without delay
+    weekday_effects
+        Dict series name -> 7 factors on the reported daily counts from Monday to Sunday, with a mean
+        of 1 so that weekly totals are kept. Only for dt = 1
+    dt
+        Time step of the series in days
+    """
+    def __init__(self, kernels=None, weekday_effects=None, dt=1.):
+        self.kernels = {name: np.asarray(kernel, dtype=float) for name, kernel in (kernels or {}).items()}
+        self.weekday_effects = {name: np.asarray(effects, dtype=float)
+                                for name, effects in (weekday_effects or {}).items()}
+        assert not self.weekday_effects or dt == 1., "weekday effects need daily series"
+        assert all(len(effects) == 7 for effects in self.weekday_effects.values())
+        self.dt = dt
+        self._spectra = {}
+
+    def delay(self, name, x):
+        """Series x of shape (..., time) convolved with the kernel of name, e.g. compartment sizes"""
+        kernel = self.kernels.get(name)
+        if kernel is None:
+            return np.asarray(x, dtype=float)
+        # the fitting loop convolves series of the same length again and again
+        size = fast_length(np.shape(x)[-1] + kernel.shape[-1] - 1)
+        spectrum = self._spectra.get((name, size))
+        if spectrum is None:
+            spectrum = self._spectra[(name, size)] = np.fft.rfft(kernel, size)
+        return convolve(x, kernel, spectrum)
+
+    def incidence(self, name, x, t=None):
+        """
+        Reported counts per time step of the simulated new cases x of shape (..., time), t are the days
+        of the columns of x, needed for weekday effects
+        """
+        reported = self.delay(name, x)
+        effects = self.weekday_effects.get(name)
+        if effects is not None:
+            if t is None:
+                raise ValueError("weekday effects of {} need the days t".format(name))
+            reported = reported * effects[weekdays(t)]
+        return reported
+
+    def cumulative(self, name, x, t=None):
+        """
+        Reported cumulative counts of the simulated cumulative counts x of shape (..., time)
+
+        Cases up to the first column count as reported, only the new cases after it are delayed. The
+        map is linear, so it also applies to the sensitivities of x.
+        """
+        x = np.asarray(x, dtype=float)
+        new = np.diff(x, axis=-1, prepend=x[..., :1])
+        return x[..., :1] + np.cumsum(self.incidence(name, new, t), axis=-1)
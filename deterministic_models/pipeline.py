@@ -0,0 +1,196 @@
+"""
+Nightly fit and forecast of all countries in a process pool
+
+The prepared cases frame of resources/data/generate_ml_data.py is copied once into shared memory. Every
+worker builds the model once in its initializer and attaches to the shared arrays, so a task only
+carries the country name and its row range.
+
+Usage: python -m deterministic_models.pipeline db_data_ml.csv forecast.parquet [--stats stats.csv] [--fits fits/] [--workers 8]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from .fit import FitResult, ModelFitter
+from .model import generate_model
+
+
+SEIRD = {"name": "SEIRD",
+         "compartments": ["S", "E", "I", "R", "D"],
+         "connections": [
+             {"source": "S", "target": "E", "inhibitor": "I", "parameter": "beta"},
+             {"source": "E", "target": "I", "parameter": "a"},
+             {"source": "I", "target": "R", "parameter": "gamma"},
+             {"source": "I", "target": "D", "parameter": "delta"}
+         ]}
+
+SEIRD_PARAMETERS = {"beta": 3.3 / 9., "a": 1. / 5.5, "gamma": 1. / 9., "delta": 0.005}
+
+COLUMNS = ["date", "infected", "dead", "population"]
+
+_worker = {}
+
+
+def partition_cases(cases):
+    """
+    Country level rows (area1 is missing) sorted by area2 and date as one float array with COLUMNS,
+    plus the row range of every country
+    """
+    countries = cases[cases["area1"].isna() & cases["area2"].notna()]
+    countries = countries.sort_values(["area2", "date"], kind="mergesort")
+
+    data = countries[COLUMNS].to_numpy(dtype=np.float64)
+    names, starts = np.unique(countries["area2"].to_numpy(dtype=str), return_index=True)
+    stops = np.append(starts[1:], len(countries))
+    return data, list(zip(names.tolist(), starts.tolist(), stops.tolist()))
+
+
+def _init_worker(shm_name, shape, model_structure, fit_dir, horizon, window_length, min_cases):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    model = generate_model(model_structure)
+    model.set_parameters(dict(model.parameters, **SEIRD_PARAMETERS))
+
+    _worker.update(shm=shm, data=np.ndarray(shape, dtype=np.float64, buffer=shm.buf), model=model,
+                   fit_dir=fit_dir, horizon=horizon, window_length=window_length, min_cases=min_cases)
+
+
+def _fit_path(country):
+    return os.path.join(_worker["fit_dir"], "".join(c if c.isalnum() else "_" for c in country) + ".json")
+
+
+def fit_and_forecast(country, start, stop):
+    """
+    Fit SEIRD to one country and forecast horizon days past its last observation (runs in a worker)
+
+    A country whose fit or forecast raises gets a failed stats row without forecast, so it does not
+    abort the other countries.
+    """
+    stats = {"area2": country, "rows": stop - start, "fit_seconds": 0., "forecast_seconds": 0., "nfev": 0,
+             "success": False, "message": ""}
+    try:
+        return _fit_and_forecast(country, start, stop, stats)
+    except Exception as e:
+        stats.update(success=False, message="{}: {}".format(type(e).__name__, e))
+        return stats, None
+
+
+def _fit_and_forecast(country, start, stop, stats):
+    date, infected, dead, population = _worker["data"][start:stop].T
+    valid = np.isfinite(infected) & (infected >= _worker["min_cases"])
+    if not np.isfinite(population).any() or not valid.any():
+        stats["message"] = "no population or too few cases"
+        return stats, None
+
+    first = np.argmax(valid)
+    t_obs = date[first:]
+    infected = infected[first:]
+    dead = dead[first:]
+    N = float(population[np.isfinite(population)][0])
+
+    model = _worker["model"]
+    model.set_parameters(dict(model.parameters, N=N))
+
+    D0 = float(np.nan_to_num(dead[0]))
+    I0 = max(float(infected[0]) - D0, 1.)
+    y0 = [N - I0 - D0, 0., I0, 0., D0]
+
+    windows = np.arange(t_obs[0] + _worker["window_length"], t_obs[-1], _worker["window_length"])
+    fitter = ModelFitter(model, {"infected": ["I", "R", "D"], "dead": ["D"]}, varying="beta", windows=windows)
+
+    warm_start = None
+    if _worker["fit_dir"] is not None and os.path.exists(_fit_path(country)):
+        warm_start = FitResult.load(_fit_path(country))
+
+    tic = time.perf_counter()
+    result = fitter.fit(t_obs, {"infected": infected, "dead": dead}, y0, warm_start=warm_start)
+    stats["fit_seconds"] = time.perf_counter() - tic
+    stats.update(nfev=result.nfev, success=result.success, message=result.message)
+
+    if _worker["fit_dir"] is not None:
+        result.save(_fit_path(country))
+
+    tic = time.perf_counter()
+    t_end = t_obs[-1] + _worker["horizon"]
+    forecast = model.simulate_piecewise(result.segments(), t_end, y0, output_nsteps=int(t_end - t_obs[0]))
+    stats["forecast_seconds"] = time.perf_counter() - tic
+
+    scale = N / 100.
+    columns = {"area2": np.full(len(forecast["t"]), country), "date": forecast["t"]}
+    columns.update((c, forecast[c] * scale) for c in model.compartments)
+    return stats, columns
+
+
+def run(cases, output, stats_output=None, fit_dir=None, workers=None, horizon=30, window_length=14,
+        min_cases=20, model_structure=SEIRD):
+    """
+    Fit and forecast every country of the cases frame in a process pool
+
+    The forecasts are appended to the Parquet file output as soon as a country is done, one row group per
+    country with one row per day and the columns area2, date and the compartments. Per country timings go
+    to stats_output. Fits are stored in fit_dir and used as warm start
+    by the next run.
+
+    Returns
+    -------
+    DataFrame with the per country timings
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("area2", pa.string()), ("date", pa.float64())] +
+                       [(c, pa.float64()) for c in model_structure["compartments"]])
+    data, tasks = partition_cases(cases)
+    if fit_dir is not None:
+        os.makedirs(fit_dir, exist_ok=True)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        np.ndarray(data.shape, dtype=np.float64, buffer=shm.buf)[:] = data
+
+        all_stats = []
+        writer = pq.ParquetWriter(output, schema)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(shm.name, data.shape, model_structure, fit_dir, horizon,
+                                               window_length, min_cases)) as pool:
+                # longest countries first, so that no long task is left over at the end
+                futures = [pool.submit(fit_and_forecast, *task)
+                           for task in sorted(tasks, key=lambda task: task[1] - task[2])]
+
+                for future in as_completed(futures):
+                    stats, columns = future.result()
+                    all_stats.append(stats)
+                    if columns is not None:
+                        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        finally:
+            writer.close()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    all_stats = pd.DataFrame(all_stats)
+    if stats_output is not None:
+        all_stats.to_csv(stats_output, index=False)
+    return all_stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cases", help="CSV written by generate_ml_data.save_data()")
+    parser.add_argument("output", help="Parquet file for the forecasts")
+    parser.add_argument("--stats", default=None, help="CSV file for per country timings")
+    parser.add_argument("--fits", default=None, help="directory for the fits used as warm start")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--horizon", type=int, default=30)
+    args = parser.parse_args()
+
+    tic = time.perf_counter()
+    stats = run(pd.read_csv(args.cases), args.output, stats_output=args.stats, fit_dir=args.fits,
+                workers=args.workers, horizon=args.horizon)
+    print(stats[["fit_seconds", "forecast_seconds", "nfev"]].describe())
+    print("total {:.1f} s for {} countries".format(time.perf_counter() - tic, len(stats)))
@@ -0,0 +1,183 @@
+"""
+Precompute the curves of simulation.html on a grid of intervention scenarios
+
+The grid spans R0, InterventionTime, InterventionDuration and InterventionR0, with
+AfterInterventionR0, I0 and the model parameters fixed. It is written to a directory with
+header.json and one little endian float32 file per R0 value, so the page only downloads the chunks
+it interpolates between. Chunk i holds the curves without intervention for R0[i], shape
+(curves, days), followed by the intervention curves of shape
+(InterventionTime, InterventionDuration, InterventionR0, curves, days). Values are stored as
+log(1 + x): the curves grow exponentially, and interpolating their logarithms keeps the early phase
+and the tails of the curves in shape.
+
+simulation.html interpolates multilinearly between the grid points as an instant preview and
+replaces it with the exact curves from prediction.js, run in a Web Worker. The same interpolation
+is implemented in Grid.interpolate() below, --check compares it against predict() at random points
+of the grid.
+
+Usage: python -m deterministic_models.precompute_grid [--output grid] [--every 3] [--check 200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from .prediction import predict
+
+CURVES = ["Infectious", "Hospitalized", "Recovered", "Deceased"]
+
+# same defaults as simulation.html
+MODEL_PARAMETERS = {"D_infectious": 10, "D_incubation": 2, "cfr": 0.0056, "D_recovery_mild": 9,
+                    "D_recovery_severe": 14, "D_hospital_lag": 4, "D_death": 10, "p_severe": 0.039}
+SIMULATION_PARAMETERS = {"dt": 1.0, "t_final": 2 * 365.0}
+POPULATION_PARAMETERS = {"N": 86.0e6, "I0": 1.}
+AFTER_INTERVENTION_R0 = 1.4
+
+# R0 is denser where the curves change fastest
+AXES = {"R0": np.unique(np.round(np.concatenate([np.arange(0., 10.01, 0.5), np.arange(1., 4., 0.25)]), 6)).tolist(),
+        "InterventionTime": np.arange(0., 181., 20.).tolist(),
+        "InterventionDuration": np.arange(0., 361., 40.).tolist(),
+        "InterventionR0": np.round(np.arange(0., 2.51, 0.25), 6).tolist()}
+
+
+def simulate_chunk(R0, axes, after_intervention_R0, days):
+    """Curves without intervention and for all intervention scenarios of one R0, as float32 log(1 + x)"""
+    IT, ID, IR0 = np.meshgrid(axes["InterventionTime"], axes["InterventionDuration"], axes["InterventionR0"],
+                              indexing="ij")
+    # the last scenario is the one without intervention
+    res = predict(dict(MODEL_PARAMETERS, R0=R0), SIMULATION_PARAMETERS, POPULATION_PARAMETERS,
+                  np.append(IT.ravel(), 0.), np.append(ID.ravel(), 0.), np.append(IR0.ravel(), R0),
+                  np.append(np.full(IT.size, after_intervention_R0), R0))
+    curves = np.stack([res[c][:, days] for c in CURVES], axis=1)
+    baseline = curves[-1]
+    grid = curves[:-1].reshape(IT.shape + curves.shape[1:])
+    return np.log1p(baseline).astype("<f4"), np.log1p(grid).astype("<f4")
+
+
+def write_grid(output, axes=AXES, after_intervention_R0=AFTER_INTERVENTION_R0, every=3):
+    """Simulate all chunks and write them to the directory output, returns the header"""
+    fullsteps = int(np.ceil(SIMULATION_PARAMETERS["t_final"] / SIMULATION_PARAMETERS["dt"]))
+    days = np.arange(0, fullsteps, every)
+    if days[-1] != fullsteps - 1:
+        days = np.append(days, fullsteps - 1)
+
+    os.makedirs(output, exist_ok=True)
+    header = {"axes": axes,
+              "fixed": {"AfterInterventionR0": after_intervention_R0, "I0": POPULATION_PARAMETERS["I0"],
+                        "N": POPULATION_PARAMETERS["N"]},
+              "model_parameters": MODEL_PARAMETERS,
+              "simulation_parameters": SIMULATION_PARAMETERS,
+              "curves": CURVES,
+              "days": days.tolist(),
+              "dtype": "float32",
+              "encoding": "log1p",
+              "chunks": []}
+
+    for i, R0 in enumerate(axes["R0"]):
+        start = time.perf_counter()
+        baseline, grid = simulate_chunk(R0, axes, after_intervention_R0, days)
+        name = "chunk_{:03d}.bin".format(i)
+        with open(os.path.join(output, name), "wb") as f:
+            f.write(baseline.tobytes())
+            f.write(grid.tobytes())
+        header["chunks"].append(name)
+        print("R0 = {}: {} scenarios in {:.1f}s".format(R0, grid.shape[0] * grid.shape[1] * grid.shape[2] + 1,
+                                                        time.perf_counter() - start))
+
+    # the header is written last, so the page never sees an incomplete grid
+    with open(os.path.join(output, "header.json"), "w") as f:
+        json.dump(header, f)
+    return header
+
+
+class Grid:
+    """Read access to a grid directory written by write_grid()"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "header.json")) as f:
+            self.header = json.load(f)
+        self.axes = [np.asarray(self.header["axes"][name]) for name in
+                     ["R0", "InterventionTime", "InterventionDuration", "InterventionR0"]]
+        self.days = np.asarray(self.header["days"])
+        self.shape = tuple(len(axis) for axis in self.axes[1:]) + (len(self.header["curves"]), len(self.days))
+        self._chunks = {}
+
+    def chunk(self, i):
+        if i not in self._chunks:
+            data = np.fromfile(os.path.join(self.path, self.header["chunks"][i]), dtype="<f4")
+            size = self.shape[-2] * self.shape[-1]
+            self._chunks[i] = (data[:size].reshape(self.shape[-2:]), data[size:].reshape(self.shape))
+        return self._chunks[i]
+
+    def interpolate(self, R0, InterventionTime, InterventionDuration, InterventionR0):
+        """
+        Multilinear interpolation of the daily curves with and without intervention, shape
+        (curves, days) each, or None if the point lies outside the grid
+        """
+        corners = [[]]
+        for axis, value in zip(self.axes, (R0, InterventionTime, InterventionDuration, InterventionR0)):
+            if not axis[0] <= value <= axis[-1]:
+                return None
+            i = min(int(np.searchsorted(axis, value, side="right")) - 1, len(axis) - 2) if len(axis) > 1 else 0
+            w = (value - axis[i]) / (axis[i + 1] - axis[i]) if len(axis) > 1 else 0.
+            corners = [c + [(i, 1 - w)] for c in corners] + [c + [(i + 1, w)] for c in corners if w > 0]
+
+        # interpolation of log(1 + x), the chunks hold the logarithms
+        baseline = 0.
+        intervention = 0.
+        for (r, w0), *rest in corners:
+            base, grid = self.chunk(r)
+            w = w0 * np.prod([w for _, w in rest])
+            intervention = intervention + w * grid[tuple(i for i, _ in rest)]
+        for r, w in {c[0] for c in corners}:
+            baseline = baseline + w * self.chunk(r)[0]
+
+        full = np.arange(self.days[-1] + 1)
+        daily = [np.stack([np.interp(full, self.days, curve) for curve in curves])
+                 for curves in (np.expm1(baseline), np.expm1(intervention))]
+        return daily[0], daily[1]
+
+
+def check(grid, samples, seed=None):
+    """
+    Relative interpolation error at random points of the grid, per curve the largest absolute
+    deviation from predict() divided by the peak of the exact curve, but at least by 1e-5 N
+    """
+    rng = np.random.default_rng(seed)
+    point = np.stack([rng.uniform(axis[0], axis[-1], samples) for axis in grid.axes])
+    fixed = grid.header["fixed"]
+    exact = predict(dict(grid.header["model_parameters"], R0=point[0]), grid.header["simulation_parameters"],
+                    {"N": fixed["N"], "I0": fixed["I0"]}, point[1], point[2], point[3],
+                    fixed["AfterInterventionR0"])
+
+    errors = np.zeros(shape=(samples, len(CURVES)))
+    for k in range(samples):
+        _, interpolated = grid.interpolate(*point[:, k])
+        for c, curve in enumerate(CURVES):
+            reference = exact[curve][k]
+            errors[k, c] = np.abs(interpolated[c] - reference).max() / max(reference.max(), 1e-5 * fixed["N"])
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "grid"))
+    parser.add_argument("--every", type=int, default=3, help="store every n-th day")
+    parser.add_argument("--check", type=int, default=0, metavar="SAMPLES",
+                        help="only compare the interpolation of an existing grid against predict()")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="largest accepted median relative error of --check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.check:
+        errors = check(Grid(args.output), args.check, args.seed)
+        for c, curve in enumerate(CURVES):
+            print("{:>13}: median {:.4f}  95% {:.4f}  max {:.4f}".format(
+                curve, np.median(errors[:, c]), np.quantile(errors[:, c], 0.95), errors[:, c].max()))
+        sys.exit(0 if np.median(errors) <= args.tolerance else 1)
+
+    write_grid(args.output, every=args.every)
@@ -0,0 +1,213 @@
+"""
+Python port of prediction.js: the hospital SEIR model behind simulation.html
+
+predict() takes the same arguments as its JavaScript counterpart and returns the same daily curves,
+but every parameter may also be an array with one value per scenario, in which case all scenarios
+are integrated together and the curves have the shape (scenarios, days).
+
+    from deterministic_models.prediction import predict
+    res = predict(model_parameters, {"dt": 1., "t_final": 730.}, {"N": 86e6, "I0": 1.},
+                  30., 180., [0.8, 1.0, 1.2], 1.4)
+    res["Hospitalized"]  # shape (3, 730)
+"""
+import numpy as np
+
+# Butcher tableaus in the layout of prediction.js: row i < last is [c_i+1, a_i+1,0, ..., a_i+1,i],
+# the last row holds the weights b
+INTEGRATORS = {
+    "Euler": [[1]],
+    "Midpoint": [[.5, .5], [0, 1]],
+    "Heun2": [[1, 1], [.5, .5]],
+    "Heun3": [[1/3, 1/3], [2/3, 0, 2/3], [1/4, 0, 3/4]],
+    "Simpson": [[1/2, 1/2], [1, -1, 2], [1/6, 2/3, 1/6]],
+    "RK4": [[.5, .5], [.5, 0, .5], [1, 0, 0, 1], [1/6, 1/3, 1/3, 1/6]],
+}
+
+COMPARTMENTS = ["S", "E", "I", "Mild", "Severe", "Severe_H", "Fatal", "R", "D"]
+
+# (source, target) of every transition, the first one is the infection S -> E driven by I
+TRANSITIONS = [(0, 1), (1, 2), (2, 3), (2, 4), (2, 6), (3, 7), (4, 5), (5, 7), (6, 8)]
+
+
+class RungeKutta:
+    """
+    Explicit fixed step Runge-Kutta scheme that updates a state of fixed shape in place
+
+    All stage derivatives and intermediate states are allocated once, so a step does not allocate
+    anything besides what f does.
+
+    Parameters
+    ----------
+    tableau
+        Name of an entry of INTEGRATORS or a tableau in the same layout
+    shape
+        Shape of the state
+    """
+    def __init__(self, tableau, shape):
+        tableau = INTEGRATORS[tableau] if isinstance(tableau, str) else tableau
+        self.c = [0.] + [float(row[0]) for row in tableau[:-1]]
+        self.a = [[]] + [[float(v) for v in row[1:]] for row in tableau[:-1]]
+        self.b = [float(v) for v in tableau[-1]]
+
+        self.k = np.zeros(shape=(len(self.b),) + tuple(shape))
+        self._stage = np.zeros(shape)
+        self._tmp = np.zeros(shape)
+
+    def _add(self, y, coefficients, h):
+        for j, a in enumerate(coefficients):
+            if a:
+                np.multiply(self.k[j], h * a, out=self._tmp)
+                y += self._tmp
+
+    def step(self, f, y, t, h):
+        """Advance y from t to t + h in place, f(t, y, out) writes the derivative into out"""
+        for i in range(len(self.b)):
+            np.copyto(self._stage, y)
+            self._add(self._stage, self.a[i], h)
+            f(t + self.c[i] * h, self._stage, self.k[i])
+        self._add(y, self.b, h)
+        return y
+
+
+class HospitalModel:
+    """
+    Right-hand side of the model of prediction.js for many scenarios at once
+
+    The state has the shape (9, scenarios) and holds fractions of the population in the order of
+    COMPARTMENTS. Every parameter is a scalar or an array with one value per scenario. beta is
+    R0 / D_infectious before InterventionTime, InterventionR0 / D_infectious during the intervention
+    and AfterInterventionR0 / D_infectious afterwards.
+    """
+    def __init__(self, model_para, InterventionTime, InterventionDuration, InterventionR0, AfterInterventionR0):
+        p = {key: np.asarray(value, dtype=float) for key, value in model_para.items()}
+        InterventionTime = np.asarray(InterventionTime, dtype=float)
+        InterventionDuration = np.asarray(InterventionDuration, dtype=float)
+        InterventionR0 = np.asarray(InterventionR0, dtype=float)
+        AfterInterventionR0 = np.asarray(AfterInterventionR0, dtype=float)
+        shape = np.broadcast(InterventionTime, InterventionDuration, InterventionR0, AfterInterventionR0,
+                             *p.values()).shape
+        self.scenarios = int(np.prod(shape))
+
+        def flat(value):
+            return np.broadcast_to(value, shape).ravel().astype(float)
+
+        gamma = 1 / p["D_infectious"]
+        p_severe = p["p_severe"]
+        p_fatal = p["cfr"]
+        p_mild = 1 - p_severe - p_fatal
+
+        self.start = flat(InterventionTime)
+        self.stop = flat(InterventionTime + InterventionDuration)
+        self.beta = [flat(p["R0"] * gamma), flat(InterventionR0 * gamma), flat(AfterInterventionR0 * gamma)]
+
+        self.rates = np.stack([flat(rate) for rate in [
+            0., 1 / p["D_incubation"], p_mild * gamma, p_severe * gamma, p_fatal * gamma,
+            1 / p["D_recovery_mild"], 1 / p["D_hospital_lag"], 1 / p["D_recovery_severe"], 1 / p["D_death"]]])
+
+        n = len(COMPARTMENTS)
+        self.source = np.array([s for s, _ in TRANSITIONS])
+        self.stoichiometry = np.zeros(shape=(n, len(TRANSITIONS)))
+        for r, (s, t) in enumerate(TRANSITIONS):
+            self.stoichiometry[s, r] -= 1
+            self.stoichiometry[t, r] += 1
+        self._flux = np.zeros(shape=(len(TRANSITIONS), self.scenarios))
+
+    def set_beta(self, t):
+        rate = self.rates[0]
+        np.copyto(rate, self.beta[0])
+        np.copyto(rate, self.beta[1], where=(t > self.start) & (t < self.stop))
+        np.copyto(rate, self.beta[2], where=t >= self.stop)
+
+    def rhs(self, t, x, out):
+        self.set_beta(t)
+        flux = self._flux
+        np.take(x, self.source, axis=0, out=flux)
+        flux *= self.rates
+        flux[0] *= x[2]
+        np.matmul(self.stoichiometry, flux, out=out)
+        return out
+
+
+def predict(model_para, simulation_para, population_para, InterventionTime, InterventionDuration, InterventionR0,
+            AfterInterventionR0, method="RK4", interpolation_steps=48):
+    """
+    Daily curves of the hospital model, same inputs and outputs as predict() in prediction.js
+
+    Parameters
+    ----------
+    model_para
+        Dict with R0, D_infectious, D_incubation, cfr, D_recovery_mild, D_recovery_severe,
+        D_hospital_lag, D_death and p_severe
+    simulation_para
+        Dict with the output step dt and the final time t_final, both scalars
+    population_para
+        Dict with the population N and the initially infectious I0
+    InterventionTime, InterventionDuration, InterventionR0, AfterInterventionR0
+        Intervention scenario
+    method
+        Key of INTEGRATORS
+    interpolation_steps
+        Integration steps per output step
+
+    All parameters besides simulation_para, method and interpolation_steps may be arrays of one shape
+    (or broadcastable to it), one entry per scenario.
+
+    Returns
+    -------
+    Dict with the absolute numbers Infectious, Hospitalized, Recovered, Deceased and
+    cumulative_infected at the start of every output step, arrays of the broadcast shape of the
+    inputs plus one axis for the steps, and the final Deceased fraction total_deaths
+    """
+    fullsteps = int(np.ceil(simulation_para["t_final"] / simulation_para["dt"]))
+    dt = simulation_para["dt"] / interpolation_steps
+
+    N = np.asarray(population_para["N"], dtype=float)
+    I0 = np.asarray(population_para["I0"], dtype=float)
+    scenario = [InterventionTime, InterventionDuration, InterventionR0, AfterInterventionR0]
+    shape = np.broadcast(N, I0, *scenario, *[np.asarray(x) for x in model_para.values()]).shape
+
+    def flat(value):
+        return np.broadcast_to(value, shape).ravel()
+
+    model = HospitalModel({key: flat(value) for key, value in model_para.items()}, *[flat(x) for x in scenario])
+    v = np.zeros(shape=(len(COMPARTMENTS), model.scenarios))
+    v[0] = 1
+    v[2] = flat(I0 / (N - I0))
+    N = flat(N)
+
+    integrator = RungeKutta(method, v.shape)
+    out = np.empty(shape=(5, model.scenarios, fullsteps))
+    sampled = [2, 5, 7, 8]
+
+    # t is accumulated like in prediction.js, so the intervention switches at the same substep
+    t = 0.
+    for day in range(fullsteps):
+        np.multiply(N, v[sampled], out=out[:4, :, day])
+        np.multiply(N, 1 - v[0], out=out[4, :, day])
+        for _ in range(interpolation_steps):
+            integrator.step(model.rhs, v, t, dt)
+            t += dt
+
+    out = out.reshape((5,) + shape + (fullsteps,))
+    return {"Infectious": out[0],
+            "Hospitalized": out[1],
+            "Recovered": out[2],
+            "Deceased": out[3],
+            "total_deaths": v[8].reshape(shape) if shape else v[8, 0],
+            "cumulative_infected": out[4]}
+
+
+if __name__ == '__main__':
+    import time
+
+    model_parameters = {"R0": 3.8, "D_infectious": 10, "D_incubation": 2, "cfr": 0.0056, "D_recovery_mild": 9,
+                        "D_recovery_severe": 14, "D_hospital_lag": 4, "D_death": 10, "p_severe": 0.039}
+    simulation_parameters = {"dt": 1.0, "t_final": 2 * 365.0}
+    population_parameters = {"N": 86.0e6, "I0": 1}
+
+    intervention_R0 = np.linspace(0.5, 2., 64)
+    start = time.perf_counter()
+    res = predict(model_parameters, simulation_parameters, population_parameters, 30, 180, intervention_R0, 1.4)
+    print("{} scenarios in {:.2f}s".format(len(intervention_R0), time.perf_counter() - start))
+    for R0, peak in zip(intervention_R0[::8], res["Hospitalized"].max(axis=1)[::8]):
+        print("R0 during intervention {:.2f}: hospital peak {:.0f}".format(R0, peak))
@@ -0,0 +1,97 @@
+// Lazy access to the scenario grid written by precompute_grid.py, see there for the file layout.
+// The chunks are little endian float32, which is the byte order of Float32Array on all common platforms.
+
+class PredictionGrid {
+    constructor(url, header) {
+        this.url = url;
+        this.header = header;
+        this.axes = ["R0", "InterventionTime", "InterventionDuration", "InterventionR0"].map(a => header.axes[a]);
+        this.curves = header.curves.length;
+        this.days = header.days;
+        this.chunks = {};
+    }
+
+    // the grid in the directory url, or null if there is none
+    static async load(url) {
+        try {
+            const response = await fetch(url + "/header.json");
+            return response.ok ? new PredictionGrid(url, await response.json()) : null;
+        } catch (e) {
+            return null;
+        }
+    }
+
+    // whether the grid was computed with these fixed parameters
+    matches(model_parameters, simulation_parameters, population_parameters, AfterInterventionR0) {
+        const h = this.header;
+        const close = (a, b) => Math.abs(a - b) <= 1e-9 * Math.max(1, Math.abs(b));
+        return close(AfterInterventionR0, h.fixed.AfterInterventionR0)
+            && close(population_parameters.I0, h.fixed.I0)
+            && close(population_parameters.N, h.fixed.N)
+            && Object.keys(h.model_parameters).every(k => close(model_parameters[k], h.model_parameters[k]))
+            && Object.keys(h.simulation_parameters).every(k => close(simulation_parameters[k], h.simulation_parameters[k]));
+    }
+
+    chunk(i) {
+        if (!(i in this.chunks)) {
+            this.chunks[i] = fetch(this.url + "/" + this.header.chunks[i])
+                .then(response => response.arrayBuffer())
+                .then(buffer => new Float32Array(buffer));
+        }
+        return this.chunks[i];
+    }
+
+    // [[index, weight], ...] of the neighbouring grid points, or null outside the grid
+    static locate(axis, value) {
+        if (!(value >= axis[0] && value <= axis[axis.length - 1])) return null;
+        if (axis.length === 1) return [[0, 1]];
+        let i = 0;
+        while (i < axis.length - 2 && axis[i + 1] <= value) i++;
+        const w = (value - axis[i]) / (axis[i + 1] - axis[i]);
+        return w > 0 ? [[i, 1 - w], [i + 1, w]] : [[i, 1]];
+    }
+
+    // {prediction, prediction_intervention} with daily curves like predict(), or null outside the grid
+    async interpolate(R0, InterventionTime, InterventionDuration, InterventionR0) {
+        const points = [R0, InterventionTime, InterventionDuration, InterventionR0]
+            .map((v, k) => PredictionGrid.locate(this.axes[k], v));
+        if (points.some(p => p === null)) return null;
+
+        const C = this.curves;
+        const T = this.days.length;
+        const block = C * T;
+        const [nT, nD, nR] = this.axes.slice(1).map(a => a.length);
+        const chunks = await Promise.all(points[0].map(([r]) => this.chunk(r)));
+
+        // interpolation of log(1 + x), the chunks hold the logarithms
+        const baseline = new Float64Array(block);
+        const intervention = new Float64Array(block);
+        points[0].forEach(([, w0], c) => {
+            const data = chunks[c];
+            for (let l = 0; l < block; l++) baseline[l] += w0 * data[l];
+            for (const [i, w1] of points[1]) for (const [j, w2] of points[2]) for (const [k, w3] of points[3]) {
+                const w = w0 * w1 * w2 * w3;
+                const offset = block * (1 + (i * nD + j) * nR + k);
+                for (let l = 0; l < block; l++) intervention[l] += w * data[offset + l];
+            }
+        });
+
+        // back from log(1 + x) and linearly in time to every day
+        const daily = (values) => {
+            const res = {};
+            this.header.curves.forEach((name, c) => {
+                const curve = [];
+                for (let s = 0; s < T - 1; s++) {
+                    const a = Math.expm1(values[c * T + s]);
+                    const b = Math.expm1(values[c * T + s + 1]);
+                    const length = this.days[s + 1] - this.days[s];
+                    for (let d = 0; d < length; d++) curve.push(a + (b - a) * d / length);
+                }
+                curve.push(Math.expm1(values[c * T + T - 1]));
+                res[name] = curve;
+            });
+            return res;
+        };
+        return {prediction: daily(baseline), prediction_intervention: daily(intervention)};
+    }
+}
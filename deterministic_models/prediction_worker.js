@@ -0,0 +1,14 @@
+// Runs predict() of prediction.js off the main thread for simulation.html
+importScripts("prediction.js");
+
+onmessage = function (e) {
+    const s = e.data;
+    const model_parameters = Object.assign({}, s.model_parameters, {R0: s.R0});
+    postMessage({
+        id: s.id,
+        prediction: predict(model_parameters, s.simulation_parameters, s.population_parameters,
+            s.InterventionTime, s.InterventionDuration, s.R0, s.R0),
+        prediction_intervention: predict(model_parameters, s.simulation_parameters, s.population_parameters,
+            s.InterventionTime, s.InterventionDuration, s.InterventionR0, s.AfterInterventionR0)
+    });
+};
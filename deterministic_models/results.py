@@ -0,0 +1,215 @@
+"""
+Compact storage of simulation results
+
+SimulationResult keeps all compartments of one simulation in one contiguous (compartment, time)
+array instead of a dict of separate arrays. ResultStore appends results to a directory on disk and
+reads them back as views into a memory map, so nightly sweeps can be reloaded without copying or
+re-simulating:
+
+    store = ResultStore("sweep", dtype="float32")
+    for beta in betas:
+        model.set_parameters(dict(model.parameters, beta=beta))
+        store.append(model.simulate((0., 365.), y0, 365), scenario={"beta": beta})
+
+    for result in ResultStore("sweep").query(compartments=["I"], t_range=(0., 90.), beta=0.3):
+        result["I"]
+
+A store directory holds one raw file per dtype (data.float32, data.float64) with the records back
+to back, and index.jsonl with one line per record: offset and shape in the data file,
+compartments, name, parameters and scenario metadata. Every record is a (1 + compartments, time)
+block whose first row holds the times. Data is written before its index line, so a crashed writer
+never leaves an index entry without data.
+"""
+import json
+import os
+
+import numpy as np
+
+
+def _json_value(value):
+    if isinstance(value, dict):
+        return {str(k): _json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_json_value(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class SimulationResult:
+    """
+    Parameters
+    ----------
+    data
+        Array of shape (compartments, time)
+    t
+        Times of the columns of data
+    compartments
+        Names of the rows of data
+    metadata
+        Dict with e.g. name, parameters and scenario
+    """
+    def __init__(self, data, t, compartments, metadata=None):
+        self.data = data
+        self.t = t
+        self.compartments = list(compartments)
+        self.metadata = metadata if metadata is not None else {}
+        assert self.data.shape == (len(self.compartments), len(self.t))
+
+    @classmethod
+    def from_simulation(cls, result, dtype=float, scenario=None):
+        """Container for a result dict of CompartmentModel.simulate() (values in percent of N)"""
+        compartments = result["compartments"]
+        data = np.empty(shape=(len(compartments), len(result["t"])), dtype=dtype)
+        for i, c in enumerate(compartments):
+            data[i] = result[c]
+        metadata = {"name": result.get("name"), "parameters": dict(result.get("parameters", {}))}
+        if scenario is not None:
+            metadata["scenario"] = scenario
+        return cls(data, np.asarray(result["t"], dtype=dtype), compartments, metadata)
+
+    def __getitem__(self, compartment):
+        return self.data[self.compartments.index(compartment)]
+
+    def __len__(self):
+        return len(self.t)
+
+    def to_dict(self):
+        """Same layout as the result of CompartmentModel.simulate(), the arrays are views into data"""
+        res = {c: self.data[i] for i, c in enumerate(self.compartments)}
+        res["t"] = self.t
+        res["name"] = self.metadata.get("name")
+        res["parameters"] = self.metadata.get("parameters", {})
+        res["compartments"] = self.compartments
+        return res
+
+    def select(self, compartments=None, t_range=None):
+        """Result restricted to some compartments and times t_range[0] <= t <= t_range[1], as views if possible"""
+        rows = slice(None) if compartments is None else [self.compartments.index(c) for c in compartments]
+        if t_range is None:
+            columns = slice(None)
+        else:
+            columns = slice(np.searchsorted(self.t, t_range[0], side="left"),
+                            np.searchsorted(self.t, t_range[1], side="right"))
+        return SimulationResult(self.data[rows, columns], self.t[columns],
+                                self.compartments if compartments is None else compartments, self.metadata)
+
+
+class ResultStore:
+    """
+    Append-only directory of SimulationResults, see the module docstring for the format
+
+    Parameters
+    ----------
+    path
+        Directory, created if it does not exist
+    dtype
+        dtype of appended records, existing records keep theirs
+    """
+    def __init__(self, path, dtype="float32"):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, "index.jsonl")
+        self._maps = {}
+        self.index = []
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                self.index = [json.loads(line) for line in f if line.strip()]
+
+    def __len__(self):
+        return len(self.index)
+
+    def _data_path(self, dtype):
+        return os.path.join(self.path, "data." + np.dtype(dtype).name)
+
+    def append(self, result, scenario=None):
+        """Append a SimulationResult or a result dict of CompartmentModel.simulate(), returns its index"""
+        if not isinstance(result, SimulationResult):
+            result = SimulationResult.from_simulation(result, scenario=scenario)
+        elif scenario is not None:
+            result = SimulationResult(result.data, result.t, result.compartments,
+                                      dict(result.metadata, scenario=scenario))
+        block = np.empty(shape=(1 + len(result.compartments), len(result.t)), dtype=self.dtype)
+        block[0] = result.t
+        block[1:] = result.data
+        return self._write([block], [dict(result.metadata, compartments=result.compartments)])[0]
+
+    def append_batch(self, data, t, compartments, metadata=None):
+        """
+        Append an ensemble, e.g. the result of CompartmentModel.simulate_batch()
+
+        Parameters
+        ----------
+        data
+            Array of shape (ensemble, compartments, time)
+        metadata
+            List with one dict per member, e.g. {"parameters": ..., "scenario": ...}
+        """
+        data = np.asarray(data)
+        metadata = metadata if metadata is not None else [{} for _ in range(len(data))]
+        assert len(metadata) == len(data)
+        blocks = np.empty(shape=(len(data), 1 + data.shape[1], data.shape[2]), dtype=self.dtype)
+        blocks[:, 0] = t
+        blocks[:, 1:] = data
+        return self._write(blocks, [dict(m, compartments=list(compartments)) for m in metadata])
+
+    def _write(self, blocks, metadata):
+        path = self._data_path(self.dtype)
+        with open(path, "ab") as f:
+            offset = f.tell() // self.dtype.itemsize
+            entries = []
+            for block, meta in zip(blocks, metadata):
+                f.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+                entries.append(_json_value(dict(meta, dtype=self.dtype.name, offset=offset, shape=list(block.shape))))
+                offset += block.size
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(self._index_path, "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+        first = len(self.index)
+        self.index.extend(entries)
+        return list(range(first, len(self.index)))
+
+    def _map(self, dtype, end):
+        """Memory map of a data file that covers at least end elements"""
+        data = self._maps.get(dtype)
+        if data is None or len(data) < end:
+            data = np.memmap(self._data_path(dtype), dtype=dtype, mode="r")
+            self._maps[dtype] = data
+        return data
+
+    def load(self, i):
+        """Record i as a SimulationResult whose arrays are views into the memory map"""
+        entry = self.index[i]
+        rows, columns = entry["shape"]
+        block = self._map(entry["dtype"], entry["offset"] + rows * columns)[
+            entry["offset"]:entry["offset"] + rows * columns].reshape(rows, columns)
+        metadata = {k: v for k, v in entry.items() if k not in ("dtype", "offset", "shape", "compartments")}
+        return SimulationResult(block[1:], block[0], entry["compartments"], metadata)
+
+    def find(self, where=None, **filters):
+        """
+        Indices of the records whose scenario (or parameters) match all filters, and for which where(entry)
+        is true if given
+        """
+        def match(entry):
+            for key, value in filters.items():
+                scope = entry.get("scenario") or {}
+                if key not in scope:
+                    scope = entry.get("parameters") or {}
+                if key in scope:
+                    if scope[key] != value:
+                        return False
+                elif entry.get(key) != value:
+                    return False
+            return where is None or where(entry)
+        return [i for i, entry in enumerate(self.index) if match(entry)]
+
+    def query(self, compartments=None, t_range=None, where=None, **filters):
+        """Lazily yield the matching records, restricted to compartments and t_range (see SimulationResult.select())"""
+        for i in self.find(where, **filters):
+            yield self.load(i).select(compartments, t_range)
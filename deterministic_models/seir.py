@@ -1,7 +1,8 @@
 from typing import Callable
 
 import numpy as np
-from scipy.integrate import solve_ivp
+
+from .instrumentation import instrumented, solve_ivp
 
 
 def make_seir_ode(N: float, R0: float, a: float, gamma: float) -> Callable:
@@ -10,6 +11,9 @@ def make_seir_ode(N: float, R0: float, a: float, gamma: float) -> Callable:
 
     Note: Normal population birth- and death rates are ignored (i.e. assumed to be zero)
 
+    All parameters may also be arrays with one value per sample. Then y holds the states of all
+    samples compartment by compartment, i.e. y.reshape(4, samples).
+
     Parameters
     ----------
     N
@@ -25,9 +29,11 @@ def make_seir_ode(N: float, R0: float, a: float, gamma: float) -> Callable:
     -------
     Function that can be used as input to scipy.integrate.solve_ivp()
     """
+    N = np.asarray(N, dtype=float)
     beta = gamma * R0
 
     def seir_ode(t, y, *f_args):
+        y = y.reshape(4, -1)
         S = y[0]
         E = y[1]
         I = y[2]
@@ -35,11 +41,11 @@ def make_seir_ode(N: float, R0: float, a: float, gamma: float) -> Callable:
 
         dy = np.zeros_like(y)
 
-        dy[0] = -beta * S * I / float(N)
-        dy[1] = beta * S * I / float(N) - a * E
+        dy[0] = -beta * S * I / N
+        dy[1] = beta * S * I / N - a * E
         dy[2] = a * E - gamma * I
         dy[3] = gamma * I
-        return dy
+        return dy.ravel()
 
     return seir_ode
 
@@ -55,6 +61,9 @@ def make_extended_seir_ode(N: float, R0: float, a: float, gamma: float, \
     persons, and that persons who have been tested positively are quarantined and
     cannot infect any further people.
 
+    All parameters may also be arrays with one value per sample. Then y holds the states of all
+    samples compartment by compartment, i.e. y.reshape(8, samples).
+
     Parameters
     ----------
     N
@@ -75,13 +84,20 @@ def make_extended_seir_ode(N: float, R0: float, a: float, gamma: float, \
     theta_I
         Chance that an infectious person will be tested per day
 
+    R0 may also be a function of time, e.g. an R0Schedule. To integrate across the jumps of a
+    schedule, use simulate_extended_seir().
+
     Returns
     -------
     Function that can be used as input to scipy.integrate.solve_ivp()
     """
-    beta = gamma * R0
+    N = np.asarray(N, dtype=float)
+    schedule = R0 if callable(R0) else None
+    beta = None if callable(R0) else gamma * R0
 
     def extended_seir_ode(t, y, *f_args):
+        beta_t = beta if schedule is None else gamma * schedule(t)
+        y = y.reshape(8, -1)
         S  = y[0] # susceptible
         EU = y[1] # exposed and not tested
         IU = y[2] # infectious and not tested
@@ -94,43 +110,225 @@ def make_extended_seir_ode(N: float, R0: float, a: float, gamma: float, \
 
         dy = np.zeros_like(y)
 
-        dy[0] = -beta * S * IU / float(N)
-        dy[1] = beta * S * IU / float(N) - a * EU - theta_E * EU
+        dy[0] = -beta_t * S * IU / N
+        dy[1] = beta_t * S * IU / N - a * EU - theta_E * EU
         dy[2] = a * EU - gamma * IU - m * IU - theta_I * IU
         dy[3] = gamma * IU
         dy[4] = m * theta_M * IU + m * ID
         dy[5] = EU * theta_E + IU * theta_I - m * ID - gamma * ID
         dy[6] = gamma * ID
         dy[7] = m * (1-theta_M) * IU
-        return dy
+        return dy.ravel()
 
     return extended_seir_ode
 
 
-N = 83e6   # Total number of people
-E0 = 40e3  # Initial number of Exposed people
-I0 = 10e3  # Initial number of Infectious people
+COMPARTMENTS = ["S", "EU", "IU", "RU", "MD", "ID", "RD", "MU"]
+
+# measures of the mesures collection, see ml_models/R0_simple.R
+MEASURES = ["schools_closed", "traveller_quarantine", "border_control", "closure_leisureandbars", "lockdown",
+            "home_office", "primary_residence", "test_limitations"]
+
+
+class R0Schedule:
+    """
+    Piecewise constant R0: values[i] holds from times[i] on, values[0] also before times[0]
+
+    Values may be arrays with one entry per sample, see make_extended_seir_ode().
+    """
+    def __init__(self, times, values):
+        assert len(times) == len(values) > 0
+        order = np.argsort(times, kind="stable")
+        self.times = np.asarray(times, dtype=float)[order]
+        self.values = [values[i] for i in order]
+
+    def __call__(self, t):
+        return self.values[max(int(np.searchsorted(self.times, t, side="right")) - 1, 0)]
+
+    def next_breakpoint(self, t):
+        """First time after t at which R0 changes, inf if there is none"""
+        i = int(np.searchsorted(self.times, t, side="right"))
+        return self.times[i] if i < len(self.times) else np.inf
+
+    @classmethod
+    def from_measures(cls, measures, R0, effects, start):
+        """
+        Schedule from the documents of the mesures collection for one region
+
+        Parameters
+        ----------
+        measures
+            Documents with a date (seconds since 1970 or anything np.datetime64 accepts) and a flag
+            per measure in MEASURES, every document holds from its date on; missing flags count as
+            False
+        R0
+            R0 without any measure
+        effects
+            Factor on R0 per measure, e.g. {"lockdown": 0.3}, measures without an effect are ignored
+        start
+            Date of t = 0
+        """
+        def day(date):
+            date = np.datetime64(int(date), "s") if isinstance(date, (int, float, np.number)) else np.datetime64(date)
+            return (date - np.datetime64(start)) / np.timedelta64(1, "D")
+
+        times = [-np.inf]
+        values = [R0]
+        for document in sorted(measures, key=lambda d: day(d["date"])):
+            value = R0 * np.prod([effect for measure, effect in effects.items() if document.get(measure)])
+            if not np.array_equal(value, values[-1]):
+                times.append(day(document["date"]))
+                values.append(value)
+        return cls(times, values)
+
+
+class Trigger:
+    """
+    Change R0 once compartments cross a threshold
+
+    A trigger changes R0 of the whole run, so simulate_extended_seir() only accepts triggers for a
+    single sample.
+
+    Parameters
+    ----------
+    compartments
+        Name or list of names of COMPARTMENTS, their sum is compared to threshold
+    threshold
+        Number of people
+    R0
+        R0 from the crossing on, None to return to the schedule
+    duration
+        Days until R0 returns to the schedule, None to keep it until the next trigger
+    direction
+        1 for crossing from below, -1 for crossing from above
+    name
+        Label in the events of simulate_extended_seir()
+    """
+    def __init__(self, compartments, threshold, R0=None, duration=None, direction=1, name=None):
+        compartments = [compartments] if isinstance(compartments, str) else list(compartments)
+        self.index = [COMPARTMENTS.index(c) for c in compartments]
+        self.threshold = threshold
+        self.R0 = R0
+        self.duration = duration
+        self.direction = direction
+        self.name = name if name is not None else "{} {} {}".format(
+            "+".join(compartments), ">" if direction > 0 else "<", threshold)
+
+    def event(self):
+        """Terminal event function for solve_ivp()"""
+        def crossing(t, y):
+            return y.reshape(8, -1)[self.index].sum() - self.threshold
+        crossing.terminal = True
+        crossing.direction = self.direction
+        return crossing
+
+
+@instrumented("extended_seir")
+def simulate_extended_seir(N, R0, a, gamma, m, theta_M, theta_E, theta_I, y0, t_eval, triggers=(), method="RK45",
+                           **options):
+    """
+    Integrate the extended SEIR model across all breakpoints of an R0 schedule and all triggers
+
+    The integration restarts at every jump of R0, so the solver never steps across a discontinuity,
+    and the solution is written into one preallocated array.
+
+    Parameters
+    ----------
+    R0
+        Number, array of one value per sample or R0Schedule
+    y0
+        Initial state in the order of COMPARTMENTS (all samples compartment by compartment)
+    t_eval
+        Increasing output times, the integration runs from t_eval[0] to t_eval[-1]
+    triggers
+        Trigger objects, armed one after another: a trigger is only watched once the previous one
+        fired, e.g. lockdown above a threshold, lifting below a lower one, lockdown again. Only for a
+        single sample
+    options
+        Passed on to scipy.integrate.solve_ivp()
+
+    Returns
+    -------
+    Dict with the times t, the states y of shape (8 * samples, len(t_eval)) and the list of fired
+    events as (time, name)
+    """
+    t_eval = np.asarray(t_eval, dtype=float)
+    schedule = R0 if isinstance(R0, R0Schedule) else R0Schedule([t_eval[0]], [R0])
+    triggers = list(triggers)
+    if triggers and len(y0) != 8:
+        raise ValueError("triggers need a single sample, got {} samples".format(len(y0) // 8))
+
+    level = [schedule(t_eval[0])]
+    ode = make_extended_seir_ode(N, lambda t: level[0], a, gamma, m, theta_M, theta_E, theta_I)
+
+    y = np.empty(shape=(len(y0), len(t_eval)))
+    state = np.asarray(y0, dtype=float)
+    t0 = t_eval[0]
+    t_end = t_eval[-1]
+    override = None
+    until = -np.inf
+    events = []
+
+    while True:
+        if t0 >= until:
+            override = None
+        level[0] = schedule(t0) if override is None else override
+        t1 = min(schedule.next_breakpoint(t0) if override is None else until, t_end)
+
+        trigger = triggers[0] if triggers else None
+        solution = solve_ivp(ode, (t0, t1), state, method=method, dense_output=True,
+                             events=None if trigger is None else trigger.event(), **options)
+        if solution.status < 0:
+            raise RuntimeError(solution.message)
+
+        t_reached = solution.t[-1]
+        done = (t_eval >= t0) & (t_eval <= t_reached)
+        y[:, done] = solution.sol(t_eval[done])
+        state = solution.y[:, -1]
+        t0 = t_reached
+
+        if solution.status == 1:
+            triggers.pop(0)
+            events.append((t_reached, trigger.name))
+            override = trigger.R0
+            until = t_reached + trigger.duration if trigger.R0 is not None and trigger.duration is not None else np.inf
+        if t0 >= t_end:
+            break
+
+    return {"t": t_eval, "y": y, "events": events}
+
+
+def main(argv=None):
+    """Example solutions: a plain SEIR run, and with --extended a time series with a change in R0 at day X"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--extended", action="store_true", help="plot the extended model with a curfew")
+    args = parser.parse_args(argv)
+
+    N = 83e6   # Total number of people
+    E0 = 40e3  # Initial number of Exposed people
+    I0 = 10e3  # Initial number of Infectious people
+
+    solution = solve_ivp(
+        fun= make_seir_ode(
+            N=N,
+            R0=2.0,
+            a=1/5.5,
+            gamma=1/3.
+        ),
+        t_span=(0.0, 365.0),  # Integration time range (days)
+        y0=[
+            N - (E0 + I0),  # Initial number of Susceptible people
+            E0,
+            I0,
+            0.,  # Initial number of Recovered people
+        ],
+    )
+    print(solution.message, solution.y[:, -1])
+    if not args.extended:
+        return solution
 
-solution = solve_ivp(
-    fun= make_seir_ode(
-        N=N,
-        R0=2.0,
-        a=1/5.5,
-        gamma=1/3.
-    ),
-    t_span=(0.0, 365.0),  # Integration time range (days)
-    y0=[
-        N - (E0 + I0),  # Initial number of Susceptible people
-        E0,
-        I0,
-        0.,  # Initial number of Recovered people
-    ],
-)
-
-# TODO: This is just an example code block of how a time series with a change in R0
-#       at day X can be modelled. This does not belong here and should be moved!
-test_extended_seir = False
-if test_extended_seir:
     # The following parameters very roughly reproduce the development in Germany.
     # Handfitted voodoo, DO NOT USE THESE NUMBERS!
     N = 83e6
@@ -147,18 +345,16 @@ if test_extended_seir:
     day_X = 65. # start curfew on day 65 after first person got exposed
     R0_other = .3 # actual estimate goes here
 
-    solution1 = solve_ivp(
-        fun= make_extended_seir_ode(
-            N=N,
-            R0=R0,
-            a=a,
-            gamma=gamma,
-            m = m,
-            theta_M = theta_M,
-            theta_E = theta_E,
-            theta_I = theta_I,
-        ),
-        t_span=(0.0, day_X),
+    schedule = R0Schedule([0., day_X], [R0, R0_other])
+    result = simulate_extended_seir(
+        N=N,
+        R0=schedule,
+        a=a,
+        gamma=gamma,
+        m = m,
+        theta_M = theta_M,
+        theta_E = theta_E,
+        theta_I = theta_I,
         y0=[
             N - (E0 + I0),
             E0,
@@ -169,57 +365,44 @@ if test_extended_seir:
             0.,
             0.,
         ],
+        t_eval=np.linspace(0., 365., 1461), # run for a year
     )
-
-    solution2 = solve_ivp(
-        fun= make_extended_seir_ode(
-            N=N,
-            R0=R0_other,
-            a=a,
-            gamma=gamma,
-            m = m,
-            theta_M = theta_M,
-            theta_E = theta_E,
-            theta_I = theta_I,
-        ),
-        t_span=(day_X, 365.0), # run for a year
-        y0=solution1.y[:,-1] # start from solution of uncontained spread
-        ,
-    )
-
-    # mend arrays together
-    y = np.zeros((8,solution1.y.shape[1]+solution2.y.shape[1]))
-    y[:,:solution1.y.shape[1]] = solution1.y
-    y[:,solution1.y.shape[1]:] = solution2.y
-
-    t = np.zeros((solution1.t.shape[0]+solution2.t.shape[0]))
-    t[:solution1.y.shape[1]] = solution1.t
-    t[solution1.y.shape[1]:] = solution2.t
+    t = result["t"]
+    y = result["y"]
 
     # Plot all the stuff. Dashed lines are 'hidden' magnitudes which do not appear in any statistics.
     # Solid lines are reported numbers of deceased and infected people.
-    # Detected magnitudes are shifted 4 days back to account for the time it takes to evaluate a test
+    # Detected magnitudes are delayed by about 4 days to account for the time it takes to evaluate a test
     # (again, actual estimate goes here!). The reasoning behind this is the following: If a person gets
     # tested on day x, they will get quarantined at that same day and cannot infect any more people, so
     # they are part of ID already. Because it takes time to evaluate the test, however, they show up in
-    # reports only some days later.
+    # reports only some days later. The delay is gamma distributed, see observation.py.
     import matplotlib.pyplot as plt
 
-    delay_test = 4.
+    from .observation import ObservationModel, gamma_kernel
+
+    dt = t[1] - t[0]
+    observation = ObservationModel({"detected": gamma_kernel(4., 2., dt=dt)}, dt=dt)
+    MD, ID, RD = observation.delay("detected", y[4:7])
     plt.plot(t, y[1], '--', label='EU')
     plt.plot(t, y[2], '--', label='IU')
     plt.plot(t, y[3], '--', label='RU')
-    plt.plot(t+delay_test, y[4]*100, '-', label='MD x 100') # inflate number of deceased by a factor of
-                                                            # 100, because they would otherwise be
-                                                            # too few to see. Two y axis labels would be
-                                                            # more elegant here, admittedly.
-    plt.plot(t+delay_test, y[5], '--', label='ID')
-    plt.plot(t+delay_test, y[6], '--', label='RD')
+    plt.plot(t, MD*100, '-', label='MD x 100') # inflate number of deceased by a factor of
+                                               # 100, because they would otherwise be
+                                               # too few to see. Two y axis labels would be
+                                               # more elegant here, admittedly.
+    plt.plot(t, ID, '--', label='ID')
+    plt.plot(t, RD, '--', label='RD')
     plt.plot(t, y[7]*100, '--', label='MU x 100')
-    D_total = y[4] + y[5] + y[6]
-    plt.plot(t+delay_test, D_total, label='D (total)')
+    D_total = MD + ID + RD
+    plt.plot(t, D_total, label='D (total)')
     plt.ylim(0.,200000.) # adjust to personal taste
     plt.xlim(30.,80.)
     plt.plot([day_X, day_X],[0.,200000],color='k') # visually mark begin of curfew
     plt.legend(loc=2)
     plt.show()
+    return result
+
+
+if __name__ == '__main__':
+    main()
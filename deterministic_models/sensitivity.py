@@ -0,0 +1,261 @@
+"""
+Global sensitivity analysis and uncertainty propagation for the extended SEIR model of seir.py
+
+Parameters are drawn in blocks of Latin hypercube samples. Every block holds the two independent
+base matrices A and B of the Saltelli scheme, and the model is evaluated for A, B and for A with
+column i taken from B, for every parameter i. First order and total Sobol indices follow from the
+estimators of Saltelli et al. (2010) and Jansen (1999), with bootstrap confidence intervals.
+
+Evaluations are stored in a .npz file per analysis setup, so a later run with more samples only
+simulates the missing blocks:
+
+    analysis = SensitivityAnalysis(BOUNDS, cache_dir="sensitivity_cache")
+    analysis.extend(4096)
+    analysis.indices()["total_MD"]["ST"]
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.stats import norm
+
+from .seir import make_extended_seir_ode
+
+PARAMETERS = ["R0", "a", "gamma", "m", "theta_M", "theta_E", "theta_I"]
+
+# plausible ranges around the hand tuned values in seir.py
+BOUNDS = {"R0": (1.5, 6.),
+          "a": (1 / 7., 1 / 2.),
+          "gamma": (1 / 14., 1 / 5.),
+          "m": (5e-5, 5e-4),
+          "theta_M": (.5, 1.),
+          "theta_E": (0., .01),
+          "theta_I": (.01, .1)}
+
+FIXED = {"N": 83e6, "E0": 1., "I0": 0.}
+
+OUTPUTS = ["peak_I", "peak_time", "total_MD"]
+
+
+def latin_hypercube(n, d, rng):
+    """n points in [0, 1)^d, with exactly one point in every interval [k/n, (k+1)/n) of every axis"""
+    u = (np.arange(n)[:, None] + rng.random((n, d))) / n
+    for j in range(d):
+        u[:, j] = u[rng.permutation(n), j]
+    return u
+
+
+def evaluate_extended_seir(parameters, fixed=FIXED, t_end=365., rtol=1e-6):
+    """
+    Outputs of the extended SEIR model for all samples at once
+
+    Parameters
+    ----------
+    parameters
+        Dict with one array of samples per parameter of make_extended_seir_ode(), missing ones are
+        taken from fixed
+    fixed
+        Scalar values for N, E0 (exposed at t=0), I0 (infectious at t=0) and all parameters not
+        sampled
+
+    Returns
+    -------
+    Array of shape (samples, len(OUTPUTS)): the peak of IU + ID, its day, and MD at t_end. Rows of
+    samples whose integration fails are NaN
+    """
+    n = len(next(iter(parameters.values())))
+    values = {name: np.broadcast_to(parameters[name] if name in parameters else fixed[name], (n,))
+              for name in ["N"] + PARAMETERS}
+    N = values.pop("N")
+    t_eval = np.arange(0., t_end + 1.)
+
+    y0 = np.zeros(shape=(8, n))
+    y0[0] = N - fixed["E0"] - fixed["I0"]
+    y0[1] = fixed["E0"]
+    y0[2] = fixed["I0"]
+
+    # all samples are integrated as one system, the daily output is enough for the peak day
+    solution = solve_ivp(make_extended_seir_ode(N, **values), (0., t_end), y0.ravel(), t_eval=t_eval, rtol=rtol,
+                         atol=1e-6)
+    if solution.status != 0:
+        if n == 1:
+            return np.full(shape=(1, len(OUTPUTS)), fill_value=np.nan)
+        # one sample spoils the whole system, so only the failing samples are left as NaN
+        return np.concatenate([evaluate_extended_seir({name: parameters[name][i:i + 1] for name in parameters},
+                                                      fixed, t_end, rtol) for i in range(n)])
+    y = solution.y.reshape(8, n, -1)
+
+    infected = y[2] + y[5]
+    peak = infected.argmax(axis=1)
+    return np.stack([infected[np.arange(n), peak], t_eval[peak], y[4, :, -1]], axis=1)
+
+
+def _evaluate(arguments):
+    return evaluate_extended_seir(*arguments)
+
+
+class SensitivityAnalysis:
+    """
+    Parameters
+    ----------
+    bounds
+        Dict of the sampled parameters with their (lower, upper) bounds, the samples are uniform
+    fixed
+        N, E0, I0 and the values of all parameters that are not sampled
+    t_end
+        Simulated days
+    seed
+        Seed of the sample blocks, block k is drawn from SeedSequence(seed, spawn_key=(k,))
+    block_size
+        Rows of A and B per block
+    cache_dir
+        Directory of the .npz caches, None to keep evaluations in memory only
+    chunk_size
+        Samples that are integrated together in one solve_ivp call
+    workers
+        Processes for the chunks, 1 evaluates in this process
+    """
+    def __init__(self, bounds=BOUNDS, fixed=FIXED, t_end=365., seed=0, block_size=512, cache_dir=None,
+                 chunk_size=2048, workers=1):
+        self.names = list(bounds)
+        self.lower = np.array([bounds[name][0] for name in self.names], dtype=float)
+        self.upper = np.array([bounds[name][1] for name in self.names], dtype=float)
+        self.fixed = dict(fixed)
+        self.t_end = t_end
+        self.seed = seed
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+        d = len(self.names)
+        # evaluations of A, B and the d mixed matrices, shape (d + 2, rows, outputs)
+        self.Y = np.empty(shape=(d + 2, 0, len(OUTPUTS)))
+
+        self.cache = None
+        if cache_dir is not None:
+            setup = json.dumps({"bounds": {k: list(map(float, v)) for k, v in bounds.items()},
+                                "fixed": {k: float(v) for k, v in fixed.items()}, "t_end": float(t_end),
+                                "seed": seed, "block_size": block_size, "outputs": OUTPUTS}, sort_keys=True)
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache = os.path.join(cache_dir, hashlib.sha1(setup.encode("utf-8")).hexdigest()[:16] + ".npz")
+            if os.path.exists(self.cache):
+                self.Y = np.load(self.cache)["Y"]
+
+    @property
+    def n(self):
+        """Number of evaluated rows of A and B"""
+        return self.Y.shape[1]
+
+    def failed(self, n=None):
+        """Rows among the first n whose A, B or mixed evaluations failed, see evaluate_extended_seir()"""
+        return np.flatnonzero(np.isnan(self.Y[:, :n]).any(axis=(0, 2)))
+
+    def block(self, k):
+        """Base matrices A and B of block k in parameter space, shape (block_size, parameters) each"""
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(k,)))
+        d = len(self.names)
+        u = latin_hypercube(self.block_size, 2 * d, rng)
+        return self.lower + (self.upper - self.lower) * u[:, :d], self.lower + (self.upper - self.lower) * u[:, d:]
+
+    def _design(self, k):
+        A, B = self.block(k)
+        matrices = [A, B]
+        for i in range(len(self.names)):
+            AB = A.copy()
+            AB[:, i] = B[:, i]
+            matrices.append(AB)
+        return np.concatenate(matrices)
+
+    def evaluate(self, x):
+        """Outputs for the parameter rows x, shape (rows, len(OUTPUTS))"""
+        chunks = [({name: x[i:i + self.chunk_size, j] for j, name in enumerate(self.names)}, self.fixed, self.t_end)
+                  for i in range(0, len(x), self.chunk_size)]
+        if self.workers == 1:
+            results = [_evaluate(chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(_evaluate, chunks))
+        return np.concatenate(results)
+
+    def extend(self, n):
+        """Evaluate blocks until A and B have at least n rows, and update the cache"""
+        blocks = -(-n // self.block_size)
+        for k in range(self.n // self.block_size, blocks):
+            Y = self.evaluate(self._design(k)).reshape(len(self.names) + 2, self.block_size, len(OUTPUTS))
+            self.Y = np.concatenate([self.Y, Y], axis=1)
+            if self.cache is not None:
+                # write and rename, so an interrupted run does not leave a broken cache behind
+                tmp = self.cache + ".tmp.npz"
+                np.savez(tmp, Y=self.Y)
+                os.replace(tmp, self.cache)
+        return self
+
+    def indices(self, n=None, resamples=200, confidence=0.95, seed=None):
+        """
+        First order (S1) and total (ST) Sobol indices per output, from the first n rows without
+        failed() evaluations
+
+        Returns
+        -------
+        Dict output -> {"S1": {parameter: value}, "ST": ..., "S1_conf": ..., "ST_conf": ...} where the
+        _conf entries are the half widths of the bootstrap confidence intervals
+        """
+        Y = np.delete(self.Y[:, :n], self.failed(n), axis=1)
+        rng = np.random.default_rng(seed)
+        z = norm.ppf(.5 + confidence / 2)
+
+        def estimate(rows):
+            fA = Y[0, rows]
+            fB = Y[1, rows]
+            fAB = Y[2:, rows]
+            var = np.concatenate([fA, fB]).var(axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                S1 = (fB * (fAB - fA)).mean(axis=1) / var
+                ST = .5 * ((fA - fAB) ** 2).mean(axis=1) / var
+            return S1, ST
+
+        S1, ST = estimate(np.arange(Y.shape[1]))
+        samples = [estimate(rng.integers(0, Y.shape[1], Y.shape[1])) for _ in range(resamples)]
+        S1_conf = z * np.std([s for s, _ in samples], axis=0)
+        ST_conf = z * np.std([s for _, s in samples], axis=0)
+
+        return {output: {key: dict(zip(self.names, values[:, o]))
+                         for key, values in [("S1", S1), ("ST", ST), ("S1_conf", S1_conf), ("ST_conf", ST_conf)]}
+                for o, output in enumerate(OUTPUTS)}
+
+    def uncertainty(self, q=(0.05, 0.5, 0.95), n=None):
+        """
+        Quantiles of the outputs under the sampled parameter distribution, from the rows of A and B
+        without failed evaluations
+        """
+        Y = np.concatenate([self.Y[0, :n], self.Y[1, :n]])
+        quantiles = np.quantile(Y[~np.isnan(Y).any(axis=1)], q, axis=0)
+        return {output: dict(zip(q, quantiles[:, o])) for o, output in enumerate(OUTPUTS)}
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--samples", type=int, default=1024)
+    parser.add_argument("--cache-dir", default="sensitivity_cache")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    analysis = SensitivityAnalysis(cache_dir=args.cache_dir, workers=args.workers).extend(args.samples)
+    print("{} rows of A and B ({} simulations) in {:.1f}s, {} rows failed".format(
+        analysis.n, analysis.n * (len(analysis.names) + 2), time.perf_counter() - start,
+        len(analysis.failed(args.samples))))
+
+    for output, result in analysis.indices(args.samples).items():
+        print(output)
+        for name in analysis.names:
+            print("  {:>8}: S1 {:6.3f} +- {:.3f}   ST {:6.3f} +- {:.3f}".format(
+                name, result["S1"][name], result["S1_conf"][name], result["ST"][name], result["ST_conf"][name]))
+    for output, quantiles in analysis.uncertainty().items():
+        print(output, {q: round(float(v), 1) for q, v in quantiles.items()})
@@ -0,0 +1,142 @@
+"""
+Local HTTP/JSON service for batches of scenario simulations
+
+POST / with a body like
+
+    {"model": {"name": ..., "compartments": [...], "connections": [...]},
+     "scenarios": [{"parameters": {"N": 83e6, "beta": 0.36, ...},
+                    "initial_value": [...],
+                    "t_span": [0, 365],
+                    "output_nsteps": 365,
+                    "interventions": [[80, {"beta": 0.11}]]}]}
+
+returns {"results": [...]} with one dict of compartment curves (percent of N, see
+CompartmentModel.simulate()) and times per scenario. Compiled models stay in memory across requests
+and results are kept in an LRU cache keyed by the canonical JSON of model and scenario.
+
+Usage: python -m deterministic_models.service [--host 127.0.0.1] [--port 8050] [--cache-size 4096]
+"""
+import argparse
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .model import generate_model
+
+
+def canonical(value, digits=10):
+    """JSON string with sorted keys and floats rounded to digits significant digits"""
+    def normalize(v):
+        if isinstance(v, dict):
+            return {str(k): normalize(x) for k, x in v.items()}
+        if isinstance(v, (list, tuple)):
+            return [normalize(x) for x in v]
+        if isinstance(v, float):
+            return float("{:.{}g}".format(v, digits))
+        return v
+    return json.dumps(normalize(value), sort_keys=True, separators=(",", ":"))
+
+
+class SimulationService:
+    def __init__(self, cache_size=4096, max_models=64):
+        self.cache_size = cache_size
+        self.max_models = max_models
+        self._models = OrderedDict()
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _model(self, structure):
+        key = canonical(structure)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+        # simulate() changes the parameters of the model, so every model has its own lock, and the default
+        # parameters are kept to reset it for every scenario
+        model = generate_model(structure)
+        entry = (model, dict(model.parameters), threading.Lock())
+        with self._lock:
+            entry = self._models.setdefault(key, entry)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        return entry
+
+    def simulate(self, structure, scenario):
+        key = canonical([structure, scenario])
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+
+        model, defaults, model_lock = self._model(structure)
+        t_span = scenario.get("t_span", [0., 365.])
+        output_nsteps = scenario.get("output_nsteps", int(t_span[1] - t_span[0]))
+        segments = [(t_span[0], scenario.get("parameters", {}))]
+        segments.extend((t, parameters) for t, parameters in scenario.get("interventions", []))
+
+        with model_lock:
+            model.set_parameters(dict(defaults, **scenario.get("parameters", {})))
+            data = model.simulate_piecewise(segments, t_span[1], scenario["initial_value"], output_nsteps)
+
+        result = {c: data[c].tolist() for c in model.compartments}
+        result["t"] = data["t"].tolist()
+
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return result
+
+    def handle(self, request):
+        structure = request["model"]
+        return {"results": [self.simulate(structure, scenario) for scenario in request["scenarios"]]}
+
+
+def make_server(host="127.0.0.1", port=8050, service=None):
+    service = SimulationService() if service is None else service
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._send(200, {"models": len(service._models), "cached": len(service._results),
+                             "hits": service.hits, "misses": service.misses})
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                self._send(200, service.handle(request))
+            except (ValueError, KeyError, TypeError, AssertionError) as e:
+                self._send(400, {"error": "{}: {}".format(type(e).__name__, e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.service = service
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--cache-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, SimulationService(cache_size=args.cache_size))
+    print("serving on http://{}:{}/".format(args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1 @@
+"""Ensemble forecasts that combine the deterministic, stochastic and machine learning models"""
@@ -0,0 +1,561 @@
+"""
+Ensemble forecast of the cumulative confirmed cases and deaths of one region
+
+Every member turns the observations of a region into a forecast of the next horizon days:
+
+- SEIRDMember: SEIRD CompartmentModel with beta piecewise constant in windows, fitted as in pipeline.py
+- ExtendedSEIRMember: extended SEIR model of seir.py with R0 in windows and the mortality fitted
+- StochasticMember: chain binomial simulation of the SIR model of simple.py (chain_binomial.SIR) from the current state
+- MLMember: growth rate model of ml_models/training.py, the predicted growth is continued
+
+The members run concurrently in a thread or process pool. Their results are interpolated to the days
+after the last observation and combined into a linear pool: the ensemble distribution is the weighted
+mixture of the member distributions, so members that only give a point forecast widen the intervals by
+their disagreement with the others. The weights are the inverse of the recent errors of the members:
+once the first score_days days after a forecast are observed, the mean absolute error of log(1 + x) of
+its median updates an exponential moving average per member and region.
+
+Member results are cached under a hash of the member configuration, the horizon and the observations,
+so a rerun only recomputes the members whose input or configuration changed:
+
+    ensemble = EnsembleForecaster([SEIRDMember(), ExtendedSEIRMember(), StochasticMember(),
+                                   MLMember(train(df))], cache_dir="ensemble_cache")
+    result = ensemble.forecast("Germany", df[df["area2"] == "Germany"])
+    result["infected"]  # shape (len(QUANTILES), horizon)
+
+Usage: python -m ensemble_models.ensemble db_data_ml.csv Germany [--horizon 28] [--ml-model model.joblib]
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from deterministic_models.fit import ModelFitter
+from deterministic_models.model import generate_model
+from deterministic_models.pipeline import SEIRD, SEIRD_PARAMETERS
+from deterministic_models.seir import R0Schedule, simulate_extended_seir
+from ml_models.training import FEATURES, predict
+from stochastic_models.chain_binomial import SIR, SIR_REMOVAL_RATE, ChainBinomialModel
+
+QUANTILES = (0.025, 0.1, 0.25, 0.5, 0.75, 0.9, 0.975)
+
+# cumulative confirmed cases and deaths, as in db_data_ml.csv
+QUANTITIES = ["infected", "dead"]
+
+
+def observations(cases):
+    """FEATURES of the rows of one region with known cases, sorted by date with one row per date"""
+    df = cases[FEATURES].apply(pd.to_numeric, errors="coerce")
+    df = df[np.isfinite(df["date"]) & np.isfinite(df["infected"])]
+    df = df.sort_values("date", kind="mergesort").drop_duplicates("date", keep="last")
+    return df.reset_index(drop=True).astype(float)
+
+
+def _population(observed):
+    population = observed["population"].to_numpy()
+    population = population[np.isfinite(population)]
+    if not len(population):
+        raise ValueError("no population")
+    return float(population[-1])
+
+
+def _start(observed, min_cases):
+    """Observations from the first day with at least min_cases confirmed cases on"""
+    valid = observed["infected"].to_numpy() >= min_cases
+    if not valid.any():
+        raise ValueError("fewer than {} cases".format(min_cases))
+    return observed.iloc[np.argmax(valid):]
+
+
+class SEIRDMember:
+    """
+    SEIRD CompartmentModel, beta is constant in windows of window_length days (see pipeline.py)
+
+    Parameters
+    ----------
+    window_length
+        Days per window of beta
+    min_cases
+        The fit starts at the first day with at least min_cases confirmed cases
+    """
+    def __init__(self, window_length=14, min_cases=20, name="seird"):
+        self.window_length = window_length
+        self.min_cases = min_cases
+        self.name = name
+
+    def config(self):
+        return {"window_length": self.window_length, "min_cases": self.min_cases}
+
+    def forecast(self, observed, horizon):
+        N = _population(observed)
+        observed = _start(observed, self.min_cases)
+        t_obs = observed["date"].to_numpy()
+        infected = observed["infected"].to_numpy()
+        dead = observed["dead"].to_numpy()
+
+        model = generate_model(SEIRD)
+        model.set_parameters(dict(model.parameters, N=N, **SEIRD_PARAMETERS))
+
+        D0 = float(np.nan_to_num(dead[0]))
+        I0 = max(float(infected[0]) - D0, 1.)
+        y0 = [N - I0 - D0, 0., I0, 0., D0]
+
+        windows = np.arange(t_obs[0] + self.window_length, t_obs[-1], self.window_length)
+        fitter = ModelFitter(model, {"infected": ["I", "R", "D"], "dead": ["D"]}, varying="beta", windows=windows)
+        result = fitter.fit(t_obs, {"infected": infected, "dead": dead}, y0)
+
+        t_end = t_obs[-1] + horizon
+        res = model.simulate_piecewise(result.segments(), t_end, y0, output_nsteps=int(t_end - t_obs[0]))
+        scale = N / 100.
+        return {"t": res["t"], "infected": (res["I"] + res["R"] + res["D"]) * scale, "dead": res["D"] * scale}
+
+
+class ExtendedSEIRMember:
+    """
+    Extended SEIR model of seir.py
+
+    R0 in windows of window_length days (as beta of SEIRDMember) and the mortality m are fitted to
+    log(1 + x) of the confirmed cases (MD + ID + RD) and deaths (MD), the other rates keep the values of
+    parameters. Undetected exposed and undetected infectious people start at undetected times the
+    confirmed cases each. All finite difference steps of the Jacobian are integrated together with the
+    current parameters as one batch.
+    """
+    PARAMETERS = {"a": 1 / 2.5, "gamma": 1 / 10., "theta_M": .8, "theta_E": .0033, "theta_I": .033}
+
+    def __init__(self, window_length=14, min_cases=20, undetected=2., parameters=None, name="extended_seir"):
+        self.window_length = window_length
+        self.min_cases = min_cases
+        self.undetected = undetected
+        self.parameters = dict(self.PARAMETERS, **(parameters or {}))
+        self.name = name
+
+    def config(self):
+        return {"window_length": self.window_length, "min_cases": self.min_cases, "undetected": self.undetected,
+                "parameters": self.parameters}
+
+    def _simulate(self, x, N, y0, t_eval, windows):
+        """Confirmed cases and deaths for the rows (R0 per window, m) of x, shape (len(x), len(t_eval))"""
+        samples = len(x)
+        schedule = R0Schedule([-np.inf] + list(windows), list(x[:, :-1].T))
+        y = simulate_extended_seir(N, schedule, m=x[:, -1], y0=np.repeat(y0, samples), t_eval=t_eval, rtol=1e-6,
+                                   **self.parameters)["y"].reshape(8, samples, -1)
+        return y[4] + y[5] + y[6], y[4]
+
+    def forecast(self, observed, horizon):
+        from scipy.optimize import least_squares
+
+        N = _population(observed)
+        observed = _start(observed, self.min_cases)
+        t_obs = observed["date"].to_numpy()
+        infected = observed["infected"].to_numpy()
+        dead = observed["dead"].to_numpy()
+        recovered = np.nan_to_num(observed["recovered"].to_numpy())
+        known = np.isfinite(dead)
+
+        D0 = float(np.nan_to_num(dead[0]))
+        RD0 = float(recovered[0])
+        U0 = self.undetected * infected[0]
+        y0 = np.array([N - infected[0] - 2 * U0, U0, U0, 0., D0, max(infected[0] - D0 - RD0, 0.), RD0, 0.])
+        # the last window is at least window_length days long, as the confirmed cases lag behind R0
+        windows = np.arange(t_obs[0] + self.window_length, t_obs[-1] - self.window_length + 1, self.window_length)
+
+        def residuals(x):
+            confirmed, deaths = self._simulate(x, N, y0, t_obs, windows)
+            return np.concatenate([np.log1p(np.maximum(confirmed, 0.)) - np.log1p(infected),
+                                   np.log1p(np.maximum(deaths[:, known], 0.)) - np.log1p(dead[known])], axis=1)
+
+        def jacobian(x):
+            h = 1e-4 * x
+            r = residuals(np.vstack([x, x + np.diag(h)]))
+            return ((r[1:] - r[0]) / h[:, None]).T
+
+        x0 = np.append(np.full(len(windows) + 1, 2.), 1e-4)
+        lower = np.append(np.full(len(windows) + 1, .05), 1e-7)
+        upper = np.append(np.full(len(windows) + 1, 15.), .05)
+        solution = least_squares(lambda x: residuals(x[None])[0], x0, jac=jacobian, bounds=(lower, upper),
+                                 x_scale="jac")
+
+        t_eval = np.concatenate([t_obs, t_obs[-1] + np.arange(1., horizon + 1)])
+        confirmed, deaths = self._simulate(solution.x[None], N, y0, t_eval, windows)
+        return {"t": t_eval, "infected": confirmed[0], "dead": deaths[0]}
+
+
+class StochasticMember:
+    """
+    Chain binomial simulation of the SIR model of simple.py (chain_binomial.SIR), started from the last
+    observation
+
+    Active cases are the confirmed cases minus the recovered and the dead. beta follows from the new cases
+    of the last window days and the force of infection in between, L is SIR_REMOVAL_RATE as in simple.py.
+    Deaths are the confirmed cases times the current case fatality ratio.
+    """
+    def __init__(self, runs=1000, window=7, seed=0, name="stochastic"):
+        self.runs = runs
+        self.window = window
+        self.seed = seed
+        self.name = name
+
+    def config(self):
+        return {"runs": self.runs, "window": self.window, "seed": self.seed, "L": SIR_REMOVAL_RATE, "structure": SIR}
+
+    def forecast(self, observed, horizon):
+        N = _population(observed)
+        date = observed["date"].to_numpy()
+        infected = observed["infected"].to_numpy()
+        dead = np.nan_to_num(observed["dead"].to_numpy())
+        active = np.maximum(infected - np.nan_to_num(observed["recovered"].to_numpy()) - dead, 1.)
+        susceptible = N - infected
+
+        recent = date[1:] > date[-1] - self.window
+        new_cases = np.diff(infected)[recent].sum()
+        exposure = (active[:-1] * susceptible[:-1] / N * np.diff(date))[recent].sum()
+        beta = max(new_cases, 0.) / exposure if exposure > 0 else 0.
+
+        model = generate_model(SIR)
+        model.set_parameters({"N": N, "beta": beta, "L": SIR_REMOVAL_RATE})
+        S = int(round(susceptible[-1]))
+        I = int(round(active[-1]))
+        y0 = [S, I, int(round(N)) - S - I]
+
+        # quantiles of the runs instead of ChainBinomialModel.quantiles(), whose logarithmic bins of S are
+        # much wider than the new cases N - S while S is close to N
+        paths = ChainBinomialModel(model).trajectories(y0, horizon, self.runs, seed=self.seed)
+        confirmed = np.quantile(N - paths[:, 0], QUANTILES, axis=0)
+        fatality = dead[-1] / infected[-1] if infected[-1] > 0 else 0.
+        return {"t": date[-1] + np.arange(horizon + 1.), "infected": confirmed,
+                "dead": dead[-1] + fatality * (confirmed - infected[-1])}
+
+
+class MLMember:
+    """
+    Growth rate model of ml_models/training.py
+
+    The pipeline predicts the ratio of the confirmed cases to those 10 days before (TARGET) for the last
+    observation. This growth is continued as constant daily growth, deaths follow with the current case
+    fatality ratio.
+    """
+    def __init__(self, pipeline, name="ml"):
+        self.pipeline = pipeline
+        self.name = name
+
+    def config(self):
+        return {"pipeline": hashlib.sha1(pickle.dumps(self.pipeline)).hexdigest()}
+
+    def forecast(self, observed, horizon):
+        last = observed.iloc[-1]
+        ratio = float(predict(self.pipeline, observed.iloc[-1:])[0])
+        days = np.arange(horizon + 1.)
+        confirmed = last["infected"] * max(ratio, 1.) ** (days / 10.)
+        dead = np.nan_to_num(last["dead"])
+        fatality = dead / last["infected"] if last["infected"] > 0 else 0.
+        return {"t": last["date"] + days, "infected": confirmed, "dead": dead + fatality * (confirmed - last["infected"])}
+
+
+def _run(member, observed, horizon):
+    return member.forecast(observed, horizon)
+
+
+def _outcome(function, *args):
+    """(result, None) or (None, error message) of function(*args)"""
+    try:
+        return function(*args), None
+    except Exception as error:
+        return None, "{}: {}".format(type(error).__name__, error)
+
+
+def align(result, days):
+    """
+    Member result on the given days, one array of shape (len(QUANTILES), len(days)) per quantity
+
+    A quantity of a result is either a point forecast of shape (len(t),) or quantiles of shape
+    (len(QUANTILES), len(t)), point forecasts are repeated for every level.
+    """
+    aligned = {}
+    for quantity in QUANTITIES:
+        values = np.atleast_2d(result[quantity])
+        values = np.stack([np.interp(days, result["t"], v) for v in values])
+        aligned[quantity] = np.repeat(values, len(QUANTILES), axis=0) if len(values) == 1 else values
+    return aligned
+
+
+def linear_pool(quantiles, weights, levels=QUANTILES, resolution=200):
+    """
+    Quantiles of the weighted mixture of the member distributions
+
+    Parameters
+    ----------
+    quantiles
+        Array of shape (members, len(levels), days). The quantile function of every member is linear
+        between the levels and constant beyond them
+    weights
+        Weight per member
+    resolution
+        Number of equally likely values that represent every member distribution
+
+    Returns
+    -------
+    Array of shape (len(levels), days)
+    """
+    quantiles = np.asarray(quantiles, dtype=float)
+    levels = np.asarray(levels, dtype=float)
+    members, _, days = quantiles.shape
+
+    u = (np.arange(resolution) + .5) / resolution
+    upper = np.clip(np.searchsorted(levels, u), 1, len(levels) - 1)
+    fraction = np.clip((u - levels[upper - 1]) / (levels[upper] - levels[upper - 1]), 0., 1.)
+    values = quantiles[:, upper - 1] + fraction[:, None] * (quantiles[:, upper] - quantiles[:, upper - 1])
+    values = values.reshape(members * resolution, days)
+    mass = np.repeat(np.asarray(weights, dtype=float) / np.sum(weights) / resolution, resolution)
+
+    order = np.argsort(values, axis=0, kind="stable")
+    values = np.take_along_axis(values, order, axis=0)
+    cumulative = np.cumsum(mass[order], axis=0)
+
+    res = np.empty(shape=(len(levels), days))
+    for day in range(days):
+        res[:, day] = values[np.minimum(np.searchsorted(cumulative[:, day], levels), len(values) - 1), day]
+    return res
+
+
+class EnsembleForecaster:
+    """
+    Parameters
+    ----------
+    members
+        Objects with a unique name, config() (a JSON serializable dict that identifies the results) and
+        forecast(observed, horizon), which returns a dict with the days 't' and per quantity in QUANTITIES
+        a point forecast or quantiles at QUANTILES, see align()
+    horizon
+        Forecast days after the last observation
+    prior
+        Weight per member name before the skill scores, default 1 each
+    cache_dir
+        Directory of the member results and of the skill scores, None to keep them in memory only
+    executor
+        "thread" or "process", process pools need picklable members
+    workers
+        Size of the pool, by default one worker per member to run
+    score_days
+        Days after the origin of a forecast that are scored
+    decay
+        Weight of the previous skill in the moving average
+    """
+    def __init__(self, members, horizon=28, prior=None, cache_dir=None, executor="thread", workers=None,
+                 score_days=7, decay=.7):
+        assert len({member.name for member in members}) == len(members), "member names must be unique"
+        assert executor in ("thread", "process")
+        self.members = list(members)
+        self.horizon = horizon
+        self.prior = dict(prior or {})
+        self.cache_dir = cache_dir
+        self.executor = executor
+        self.workers = workers
+        self.score_days = score_days
+        self.decay = decay
+
+        self._results = {}
+        # error per region and member, and the unscored forecasts as region, member, origin and key
+        self.skill = {}
+        self.issued = []
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            if os.path.exists(self._state_path()):
+                with open(self._state_path()) as f:
+                    state = json.load(f)
+                self.skill = state["skill"]
+                self.issued = state["issued"]
+
+    def _state_path(self):
+        return os.path.join(self.cache_dir, "state.json")
+
+    def _save_state(self):
+        if self.cache_dir is None:
+            return
+        tmp = self._state_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"skill": self.skill, "issued": self.issued}, f)
+        os.replace(tmp, self._state_path())
+
+    def key(self, member, observed):
+        """Cache key of the result of member for the observations"""
+        setup = json.dumps({"member": member.name, "class": type(member).__name__, "config": member.config(),
+                            "horizon": self.horizon}, sort_keys=True)
+        digest = hashlib.sha1(setup.encode("utf-8"))
+        digest.update(np.ascontiguousarray(observed[FEATURES].to_numpy(dtype=float)).tobytes())
+        return digest.hexdigest()[:16]
+
+    def _load(self, key):
+        result = self._results.get(key)
+        if result is None and self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + ".npz")
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    result = {name: data[name] for name in data.files}
+                self._results[key] = result
+        return result
+
+    def _store(self, key, result):
+        self._results[key] = result
+        if self.cache_dir is not None:
+            # write and rename, so an interrupted run does not leave a broken result behind
+            tmp = os.path.join(self.cache_dir, key + ".tmp.npz")
+            np.savez(tmp, **result)
+            os.replace(tmp, os.path.join(self.cache_dir, key + ".npz"))
+
+    def run_members(self, observed):
+        """
+        Results of all members, the cached ones are not recomputed
+
+        Returns
+        -------
+        Dicts of the results, of the cache keys and of the errors of failed members per member name, and
+        the names of the members taken from the cache
+        """
+        keys = {member.name: self.key(member, observed) for member in self.members}
+        results = {}
+        missing = []
+        for member in self.members:
+            result = self._load(keys[member.name])
+            if result is not None:
+                results[member.name] = result
+            else:
+                missing.append(member)
+        cached = list(results)
+
+        errors = {}
+        if len(missing) == 1:
+            outcomes = {missing[0].name: _outcome(_run, missing[0], observed, self.horizon)}
+        elif missing:
+            pool = ThreadPoolExecutor if self.executor == "thread" else ProcessPoolExecutor
+            with pool(max_workers=self.workers or len(missing)) as executor:
+                futures = {member.name: executor.submit(_run, member, observed, self.horizon) for member in missing}
+                outcomes = {name: _outcome(future.result) for name, future in futures.items()}
+        else:
+            outcomes = {}
+
+        for name, (result, error) in outcomes.items():
+            if error is not None:
+                errors[name] = error
+                continue
+            result = {quantity: np.asarray(values, dtype=float) for quantity, values in result.items()}
+            self._store(keys[name], result)
+            results[name] = result
+        return results, keys, errors, cached
+
+    def update_skill(self, region, observed):
+        """Score the forecasts of the region whose first score_days days are observed now"""
+        date = observed["date"].to_numpy()
+        median = QUANTILES.index(0.5)
+        remaining = []
+        for record in self.issued:
+            if record["region"] != region or record["origin"] + self.score_days > date[-1]:
+                remaining.append(record)
+                continue
+            result = self._load(record["key"])
+            if result is None:
+                continue
+            days = date[(date > record["origin"]) & (date <= record["origin"] + self.score_days)]
+            rows = np.searchsorted(date, days)
+            aligned = align(result, days)
+            errors = [np.abs(np.log1p(np.maximum(aligned[quantity][median], 0.)) -
+                             np.log1p(observed[quantity].to_numpy()[rows])) for quantity in QUANTITIES]
+            errors = np.concatenate(errors)
+            errors = errors[np.isfinite(errors)]
+            if not len(errors):
+                continue
+
+            skill = self.skill.setdefault(region, {})
+            previous = skill.get(record["member"])
+            error = float(errors.mean())
+            skill[record["member"]] = error if previous is None else self.decay * previous + (1 - self.decay) * error
+        self.issued = remaining
+
+    def weights(self, region, names):
+        """Normalized prior / (error + 0.001) per member, members without a score get the median error"""
+        skill = self.skill.get(region, {})
+        known = [skill[name] for name in names if name in skill]
+        default = float(np.median(known)) if known else 1.
+        weights = {name: self.prior.get(name, 1.) / (skill.get(name, default) + 1e-3) for name in names}
+        total = sum(weights.values())
+        return {name: weight / total for name, weight in weights.items()}
+
+    def forecast(self, region, cases):
+        """
+        Ensemble forecast of the region for the days after its last observation
+
+        Parameters
+        ----------
+        region
+            Name under which the skill scores are kept
+        cases
+            Rows of the region with the FEATURES columns, e.g. of db_data_ml.csv after prepare_data()
+
+        Returns
+        -------
+        Dict with the days 't', the levels 'quantiles', per quantity in QUANTITIES the ensemble
+        quantiles of shape (len(QUANTILES), horizon), and the aligned member forecasts ('members'), the
+        'weights', the 'errors' of failed members and the names of the 'cached' members
+        """
+        observed = observations(cases)
+        if not len(observed):
+            raise ValueError("no observations of {}".format(region))
+        self.update_skill(region, observed)
+
+        results, keys, errors, cached = self.run_members(observed)
+        if not results:
+            raise RuntimeError("all members failed: {}".format(errors))
+
+        origin = float(observed["date"].iloc[-1])
+        days = origin + np.arange(1., self.horizon + 1)
+        members = {name: align(result, days) for name, result in results.items()}
+        weights = self.weights(region, list(members))
+
+        res = {"region": region, "origin": origin, "t": days, "quantiles": QUANTILES, "members": members,
+               "weights": weights, "errors": errors, "cached": cached}
+        for quantity in QUANTITIES:
+            res[quantity] = linear_pool([members[name][quantity] for name in members],
+                                        [weights[name] for name in members])
+
+        issued = {(record["region"], record["key"]) for record in self.issued}
+        self.issued.extend({"region": region, "member": name, "origin": origin, "key": keys[name]}
+                           for name in results if (region, keys[name]) not in issued)
+        self._save_state()
+        return res
+
+
+def main(argv=None):
+    from ml_models.training import load_model, prepare_data
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cases", help="CSV written by generate_ml_data.save_data()")
+    parser.add_argument("region", help="area2 of the region")
+    parser.add_argument("--horizon", type=int, default=28)
+    parser.add_argument("--ml-model", default=None, help="pipeline stored by ml_models.training.train()")
+    parser.add_argument("--cache-dir", default="ensemble_cache")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    args = parser.parse_args(argv)
+
+    cases = pd.read_csv(args.cases)
+    members = [SEIRDMember(), ExtendedSEIRMember(), StochasticMember()]
+    if args.ml_model is not None:
+        members.append(MLMember(load_model(args.ml_model)))
+    ensemble = EnsembleForecaster(members, horizon=args.horizon, cache_dir=args.cache_dir, executor=args.executor)
+    result = ensemble.forecast(args.region, prepare_data(cases[cases["area2"] == args.region]))
+
+    print("weights", {name: round(weight, 3) for name, weight in result["weights"].items()})
+    for name, error in result["errors"].items():
+        print("failed", name, error)
+    lower, median, upper = QUANTILES.index(0.025), QUANTILES.index(0.5), QUANTILES.index(0.975)
+    for i, day in enumerate(result["t"]):
+        print("{:>6.0f} {:>12.0f} [{:>12.0f}, {:>12.0f}] {:>10.0f} [{:>10.0f}, {:>10.0f}]".format(
+            day, *(result[quantity][level, i] for quantity in QUANTITIES for level in (median, lower, upper))))
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Machine learning models of the growth rate, see training.py"""
@@ -0,0 +1,107 @@
+"""
+Training and batch prediction of the growth rate models on db_data_ml.csv
+
+Features are taken column-wise from the DataFrame and fed into a sklearn Pipeline of imputation,
+scaling and a regressor that scales linearly with the number of samples. Cross validation splits
+by date, so a model is always validated on days after the ones it was trained on.
+
+sklearn and joblib are imported by the functions that need them, so the data preparation can be used
+without loading them.
+"""
+import numpy as np
+
+FEATURES = ["date", "infected", "dead", "recovered", "population"]
+TARGET = "inf_-10_R0"
+
+
+def prepare_data(df, rm_col=["adm", "gender", "ageRange", "area1", "area2", "_id", "source", "Unnamed: 0"]):
+    # get only countries
+    df = df[df["area1"].isna() | (df["area1"].astype(str) == 'nan')]
+
+    # remove not needed cols
+    return df.drop(columns=rm_col, errors="ignore")
+
+
+def get_data(df, get_col=FEATURES, y_col=TARGET):
+    """Feature matrix and target of all rows with a known target"""
+    y = df[y_col].to_numpy(dtype=float)
+    valid = np.isfinite(y)
+    X = df[get_col].to_numpy(dtype=float)[valid]
+    return X, y[valid]
+
+
+def build_pipeline(regressor="hgb", **options):
+    """
+    Pipeline of mean imputation, standard scaling and a regressor
+
+    regressor is "hgb" (HistGradientBoostingRegressor) or "sgd" (SGDRegressor), options are passed on
+    to the regressor
+    """
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import SGDRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    if regressor == "hgb":
+        model = HistGradientBoostingRegressor(**options)
+    elif regressor == "sgd":
+        model = SGDRegressor(**options)
+    else:
+        raise ValueError("unknown regressor {}".format(regressor))
+
+    return Pipeline([
+        ("impute", SimpleImputer(missing_values=np.nan, strategy="mean")),
+        ("scale", StandardScaler()),
+        ("model", model),
+    ])
+
+
+class GroupedTimeSeriesSplit:
+    """
+    TimeSeriesSplit over the sorted unique groups (e.g. dates): all rows of a group are either in the
+    training or in the test set, and every test set comes after its training set
+    """
+    def __init__(self, n_splits=5):
+        self.n_splits = n_splits
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits
+
+    def split(self, X, y=None, groups=None):
+        from sklearn.model_selection import TimeSeriesSplit
+
+        groups = np.asarray(groups)
+        unique = np.unique(groups)
+        for train, test in TimeSeriesSplit(n_splits=self.n_splits).split(unique):
+            yield np.flatnonzero(groups <= unique[train[-1]]), np.flatnonzero(np.isin(groups, unique[test]))
+
+
+def evaluate(pipeline, X, y, dates, n_splits=5, n_jobs=-1):
+    """Cross validation scores of the pipeline, the folds are fitted in parallel"""
+    from sklearn.model_selection import cross_validate
+
+    return cross_validate(pipeline, X, y, groups=dates, cv=GroupedTimeSeriesSplit(n_splits), n_jobs=n_jobs,
+                          scoring=("neg_mean_absolute_error", "r2"))
+
+
+def train(df, regressor="hgb", path=None, **options):
+    """Fit a pipeline on all rows with a known target and store it in path if given"""
+    X, y = get_data(df)
+    pipeline = build_pipeline(regressor, **options).fit(X, y)
+    if path is not None:
+        import joblib
+        joblib.dump(pipeline, path)
+    return pipeline
+
+
+def load_model(path):
+    import joblib
+    return joblib.load(path)
+
+
+def predict(pipeline, df, get_col=FEATURES, batch_size=100000):
+    """Predictions for all rows of df, computed in batches without retraining"""
+    X = df[get_col].to_numpy(dtype=float)
+    return np.concatenate([pipeline.predict(X[i:i + batch_size]) for i in range(0, len(X), batch_size)]) \
+        if len(X) else np.empty(0)
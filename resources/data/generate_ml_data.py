@@ -1,113 +1,95 @@
+import hashlib
+import json
+import os
 import sys
-sys.path.insert(1, "../../")
 
-from utils.get_data_from_mongodb import DBConnection
+# the repository root for utils, and this directory for population, wherever the script is run from
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+for _path in [os.path.join(DATA_DIR, "..", ".."), DATA_DIR]:
+    if _path not in sys.path:
+        sys.path.insert(1, _path)
 
 import pandas as pd
 import numpy as np
 from datetime import datetime,timedelta
 
-def preprocess_data(df, population):
-    # calculate N3
-    r0_values = dict({
-        "inf_10": [],
-        "inf_5": [],
-        "inf_2": [],
-        "inf_-10": [],
-        "inf_-5": [],
-        "inf_-2": [],
-        "inf_10_R0": [],
-        "inf_-10_R0": [],
-        "inf_5_R0": [],
-        "inf_-5_R0": [],
-        "inf_2_R0": [],
-        "inf_-2_R0": [],
-        "inf_10_R0_lin": [],
-        "inf_-10_R0_lin": [],
-        "inf_5_R0_lin": [],
-        "inf_-5_R0_lin": [],
-        "inf_2_R0_lin": [],
-        "inf_-2_R0_lin": [],
-    })
-    for index, row in df.iterrows():
-
-        cur_df = df[df['area1'] == row['area1']]
-        cur_df = cur_df[cur_df['area2'] == row['area2']]
-
-        for time in [-10, -5, -2, 2, 5, 10]:
-            if time > 0:
-                cur_df = cur_df[cur_df['date'] >= row['date'] + time]
-            else:
-                cur_df = cur_df[cur_df['date'] <= row['date'] + time]
-            if cur_df.empty:
-                r0_values["inf_" + str(time)].append(np.NaN)
-                r0_values["inf_" + str(time) + "_R0"].append(np.NaN)
-                r0_values["inf_" + str(time) + "_R0_lin"].append(np.NaN)
-                continue
-            r0_values["inf_" + str(time)].append(cur_df.sort_values(by=['date']).iloc[0]['infected'])
-
-            if str(row['infected']) == 'nan' or str(row['infected']) == '' or int(row['infected']) == 0 or \
-                    cur_df.sort_values(by=['date']).iloc[0]['infected'] == 'nan' or \
-                    cur_df.sort_values(by=['date']).iloc[0]['infected'] == '' or \
-                    int(cur_df.sort_values(by=['date']).iloc[0]['infected'] )== 0:
-                r0_values["inf_" + str(time) + "_R0"].append(np.NaN)
-                r0_values["inf_" + str(time) + "_R0_lin"].append(np.NaN)
+from population import load_population, lookup, map_countries
+
+LAGS = [10, 5, 2, -10, -5, -2]
+
+def lag_features(df):
+    """
+    Infected numbers of the same region (area1, area2) some days before or after each row, and the
+    growth rates derived from them.
+
+    For a lag of -x days the last record at or before date - x is used, for +x days the first record
+    at or after date + x. The growth rate _R0 is later / earlier infected and _R0_lin is the increase
+    per 10 days. Both are NaN if one of the two infected numbers is missing or zero.
+
+    Returns
+    -------
+    DataFrame with the same index as df and the columns inf_<lag>, inf_<lag>_R0 and inf_<lag>_R0_lin
+    """
+    infected = pd.to_numeric(df['infected'], errors='coerce').to_numpy(dtype=float)
+    region = df.groupby(['area1', 'area2'], sort=False, dropna=False).ngroup().to_numpy()
+    date = df['date'].to_numpy(dtype=float)
+
+    records = pd.DataFrame({'region': region, 'date': date, 'infected_lag': infected})
+    records = records[np.isfinite(date)].sort_values('date', kind='mergesort')
+
+    queries = pd.DataFrame({'region': region, 'row': np.arange(len(df))})
+    lagged = {}
+    for time in LAGS:
+        queries['date'] = date + time
+        valid = queries[np.isfinite(queries['date'])].sort_values('date', kind='mergesort')
+        merged = pd.merge_asof(valid, records, on='date', by='region',
+                               direction='forward' if time > 0 else 'backward')
+        values = np.full(len(df), np.nan)
+        values[merged['row'].to_numpy()] = merged['infected_lag'].to_numpy()
+        lagged[time] = values
+
+    current = np.where(infected == 0, np.nan, infected)
+    res = {}
+    for time in LAGS:
+        res['inf_' + str(time)] = lagged[time]
+    for suffix in ['_R0', '_R0_lin']:
+        for time in [10, -10, 5, -5, 2, -2]:
+            other = np.where(lagged[time] == 0, np.nan, lagged[time])
+            later, earlier = (other, current) if time > 0 else (current, other)
+            if suffix == '_R0':
+                res['inf_' + str(time) + suffix] = later / earlier
             else:
-                inf_cur = int(row['infected'])
-                inf_n_days = int(cur_df.sort_values(by=['date']).iloc[0]['infected'])
-                if time > 0:
-                    r0_values["inf_" + str(time) + "_R0"].append(inf_n_days / inf_cur)
-                    r0_values["inf_" + str(time) + "_R0_lin"].append((inf_n_days - inf_cur) / abs(time) * 10)
-                else:
-                    r0_values["inf_" + str(time) + "_R0"].append(inf_cur / inf_n_days)
-                    r0_values["inf_" + str(time) + "_R0_lin"].append((inf_cur - inf_n_days) / abs(time) * 10)
-
-    dict_db = pd.DataFrame.from_dict(r0_values, orient='index').transpose()
-    df = pd.concat([df, dict_db], axis=1)
-
-    print(dict_db)
-    print(df)
-
-    population_list = []
-    for area in df["area2"].values:
-        if str(area) == 'nan':
-                population_list.append(np.NaN)
-                continue
-        if population[population["Country Name"] == str(area)].empty:
-            population_list.append(np.NaN)
-            continue
-        else:
-            population_list.append(population[population["Country Name"] == str(area)][2018.0].values[0])
-    df["population"] = population_list
+                res['inf_' + str(time) + suffix] = (later - earlier) / abs(time) * 10
+    return pd.DataFrame(res, index=df.index)
+
+def preprocess_data(df, population):
+    df = pd.concat([df, lag_features(df)], axis=1)
+
+    df["population"] = lookup(df["area2"], population)
 
     return df
 
-def con_db():
-    # get data from mongodb
-    conn = DBConnection()
-    statsdb = conn.getStatisticDB()
-    collections = ['cases', 'mesures']
-    cases, measures = [pd.DataFrame(list(statsdb[col].find({}))) for col in collections]
+def get_cases(date_from=None):
+    from utils.get_data_from_mongodb import load_cases
+
+    # get data from mongodb, all fields of the JHU documents from date_from on
+    cases = load_cases(source="JHU", date_from=date_from, fields=None)
+    return convert_cases(cases) if len(cases) else cases
 
+def convert_cases(cases):
     # Convert Time into days in numbers from 2020-01-01
     cases['date'] = pd.to_datetime(cases['date'], unit='s')
     FMT = '%Y-%m-%d %H:%M:%S'
     date = cases['date']
     cases['date'] = date.map(lambda x: (datetime.strptime(str(x), FMT) - datetime.strptime("2020-01-01 00:00:00", FMT)).days)
 
-    # get population data
-    population = pd.read_excel("http://api.worldbank.org/v2/en/indicator/SP.POP.TOTL?downloadformat=excel", header=None)
-    population = population.iloc[3:]
-    headers = population.iloc[0]
-    population = pd.DataFrame(population.values[1:], columns=headers)
-
     # convert array to str for now
     area1_list = []
     area2_list = []
     for value in cases.area.values.tolist():
         if str(value) == 'nan':
-            area1_list.append(np.NaN)
-            area2_list.append(np.NaN)
+            area1_list.append(np.nan)
+            area2_list.append(np.nan)
         else:
             area1_list.append(value[0])
             area2_list.append(value[1])
@@ -116,10 +98,16 @@ def con_db():
     del cases['area']
 
     # Get country mapping
-    map_country = pd.read_csv("country_mapping.csv", sep=";")
-    for index, row in map_country.iterrows():
-        cases.loc[cases['area2'] == row['cases'], 'area2'] = row['world_bank']
+    cases['area2'] = map_countries(cases['area2'])
+
+    return cases
 
+def get_population():
+    return load_population()
+
+def con_db():
+    cases = get_cases()
+    population = get_population()
     return cases[cases['source'] == 'JHU'], population
 
 def get_data():
@@ -131,4 +119,127 @@ def save_data():
     df = get_data()
     df.to_csv("db_data_ml.csv")
 
-save_data()
+# Incremental feature store: one directory per region (area1, area2) with one Parquet file per month.
+# state.json holds the last ingested date of every region.
+MAX_LAG = max(abs(time) for time in LAGS)
+STATE_FILE = "state.json"
+
+def _region_key(area1, area2):
+    return "{}|{}".format("" if pd.isna(area1) else area1, "" if pd.isna(area2) else area2)
+
+def _region_dir(store_dir, key):
+    return os.path.join(store_dir, "".join(c if c.isalnum() else "_" for c in key) + "_" +
+                        hashlib.md5(key.encode()).hexdigest()[:8])
+
+def _month(date):
+    return (pd.Timestamp("2020-01-01") + pd.to_timedelta(date, unit="D")).strftime("%Y-%m")
+
+def load_feature_store(store_dir="feature_store", regions=None, date_from=None):
+    """Read the feature store into one frame, optionally only some region keys and dates >= date_from"""
+    state = _load_state(store_dir)
+    frames = []
+    for key in (state if regions is None else regions):
+        frames.append(_read_region(store_dir, key, date_from))
+    frames = [frame for frame in frames if len(frame)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def _load_state(store_dir):
+    path = os.path.join(store_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def _read_region(store_dir, key, date_from=None):
+    directory = _region_dir(store_dir, key)
+    if not os.path.isdir(directory):
+        return pd.DataFrame()
+    months = sorted(name[:-len(".parquet")] for name in os.listdir(directory) if name.endswith(".parquet"))
+    if date_from is not None:
+        months = [month for month in months if month >= _month(date_from)]
+    frames = [pd.read_parquet(os.path.join(directory, month + ".parquet")) for month in months]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if date_from is not None and len(df):
+        df = df[df["date"] >= date_from]
+    return df
+
+def _write_region(store_dir, key, df):
+    directory = _region_dir(store_dir, key)
+    os.makedirs(directory, exist_ok=True)
+    for month, part in df.groupby(df["date"].map(_month)):
+        path = os.path.join(directory, month + ".parquet")
+        if os.path.exists(path):
+            old = pd.read_parquet(path)
+            part = pd.concat([old[~old["date"].isin(part["date"])], part], ignore_index=True)
+        part.sort_values("date").to_parquet(path, index=False)
+
+def update_feature_store(store_dir="feature_store", cases=None, population=None):
+    """
+    Add the cases that are newer than the last ingested date of the store and recompute the features
+    of the trailing window they affect.
+
+    For a region that was last ingested on day d, only rows from d - 3 * MAX_LAG on are read back from
+    the store, and only rows from d - MAX_LAG on are rewritten, since their positive lags may now hit
+    the new rows. Older history is never touched.
+
+    Parameters
+    ----------
+    cases
+        New case rows as returned by get_cases(). By default everything after the oldest last ingested
+        date of all regions is fetched from the database
+    population
+        Population table of population.load_population(), loaded from its cache by default
+
+    Returns
+    -------
+    Number of new rows
+    """
+    state = _load_state(store_dir)
+
+    if cases is None:
+        since = None
+        if state:
+            since = pd.Timestamp("2020-01-01") + pd.to_timedelta(min(state.values()) + 1, unit="D")
+        cases = get_cases(since)
+    if len(cases) == 0:
+        return 0
+    cases = cases[cases['source'] == 'JHU']
+    if "_id" in cases:
+        cases = cases.assign(_id=cases["_id"].astype(str))
+    if population is None:
+        population = get_population()
+
+    added = 0
+    keys = [_region_key(area1, area2) for area1, area2 in zip(cases["area1"], cases["area2"])]
+    for key, new in cases.groupby(np.array(keys)):
+        last = state.get(key)
+        if last is not None:
+            new = new[new["date"] > last]
+        if len(new) == 0:
+            continue
+
+        # positive lags of rows after last - MAX_LAG may now hit one of the new rows
+        boundary = (new["date"].min() if last is None else last) - MAX_LAG
+        # a margin of 2 * MAX_LAG before the rewritten rows, so that negative lags also find records across gaps
+        history = _read_region(store_dir, key, date_from=boundary - 2 * MAX_LAG)
+        if len(history):
+            history = history[[column for column in history.columns if column in cases.columns]]
+        df = pd.concat([history, new], ignore_index=True)
+        df = preprocess_data(df, population)
+
+        _write_region(store_dir, key, df[df["date"] >= boundary])
+        state[key] = int(df["date"].max())
+        added += len(new)
+
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, STATE_FILE), "w") as f:
+        json.dump(state, f)
+
+    return added
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--incremental":
+        print("{} new rows".format(update_feature_store(*sys.argv[2:3])))
+    else:
+        save_data()
@@ -0,0 +1,58 @@
+"""
+Population lookup based on the World Bank indicator SP.POP.TOTL
+
+The workbook is downloaded and parsed only once into a long table (country, year, population) that
+is cached as Parquet next to this file. Lookups are hash joins on that table, and the country names
+of the cases are translated with country_mapping.csv in one vectorized replace.
+"""
+import os
+
+import pandas as pd
+
+WORLD_BANK_URL = "http://api.worldbank.org/v2/en/indicator/SP.POP.TOTL?downloadformat=excel"
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_FILE = os.path.join(DATA_DIR, "population.parquet")
+MAPPING_FILE = os.path.join(DATA_DIR, "country_mapping.csv")
+
+
+def parse_workbook(source=WORLD_BANK_URL):
+    """Long table with the columns country, year and population from the World Bank workbook"""
+    raw = pd.read_excel(source, header=None)
+    raw = raw.iloc[3:]
+    wide = pd.DataFrame(raw.values[1:], columns=raw.iloc[0])
+
+    years = [column for column in wide.columns if isinstance(column, (int, float)) and not pd.isna(column)]
+    long = wide.melt(id_vars=["Country Name"], value_vars=years, var_name="year", value_name="population")
+    long = long.rename(columns={"Country Name": "country"}).dropna(subset=["country", "population"])
+    long["year"] = long["year"].astype(int)
+    long["population"] = long["population"].astype(float)
+    return long.drop_duplicates(["country", "year"]).reset_index(drop=True)
+
+
+def load_population(cache_file=CACHE_FILE, refresh=False, source=WORLD_BANK_URL):
+    """Cached population table, the workbook is only downloaded if there is no cache or on refresh"""
+    if not refresh and os.path.exists(cache_file):
+        return pd.read_parquet(cache_file)
+    population = parse_workbook(source)
+    population.to_parquet(cache_file, index=False)
+    return population
+
+
+def country_mapping(path=MAPPING_FILE):
+    """Dict from the country names of the cases to the World Bank names"""
+    mapping = pd.read_csv(path, sep=";")
+    return dict(zip(mapping["cases"], mapping["world_bank"]))
+
+
+def map_countries(countries, mapping=None):
+    return countries.replace(country_mapping() if mapping is None else mapping)
+
+
+def lookup(countries, population, year=2018):
+    """Population of every entry of the series countries in the given year, NaN if unknown"""
+    table = population[population["year"] == year].set_index("country")["population"]
+    return countries.map(table).astype(float)
+
+
+if __name__ == '__main__':
+    print(load_population(refresh=True))
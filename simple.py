@@ -7,42 +7,56 @@ Created on Sat Mar 21 10:46:58 2020
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
+
+from deterministic_models.model import generate_model
+from stochastic_models.chain_binomial import SIR, SIR_REMOVAL_RATE, ChainBinomialModel
 
 N = 83e6
 
 m = 13.3
 p  = 0.33/(97000/7290)
 
-I = [10]
-S = [N-I[0]]
-R = [0]
+I0 = 10
 
-L = np.log(2)/5/10 # the median of an exp(L) is ln(2)/L and we have 5 days median
+L = SIR_REMOVAL_RATE
 
 
 
 time_length = 300
-time_span=range(time_length)
+runs = 10000
+
+# N*m/2 contacts per day, each one infects with probability S*I*p/N**2
+sir = SIR
+
+
+def build_engine():
+    model = generate_model(sir)
+    model.set_parameters({"N": N, "beta": m*p/2, "L": L})
+    return ChainBinomialModel(model)
+
 
+def main():
+    import matplotlib.pyplot as plt
 
+    engine = build_engine()
+    y0 = [N-I0, I0, 0]
+    S, I, R = engine.trajectories(y0, time_length, runs=1, seed=0)[0]
+    bands = engine.quantiles(y0, time_length, runs=runs, q=(0.05, 0.5, 0.95), seed=0)
 
-for t in time_span:
-    A = np.random.binomial(N*m/2, S[-1]*I[-1]*p/(N**2))
-    B = np.random.binomial(I[-1], 1-np.exp(-L))
 
-    S.append(S[-1]-A)
-    I.append(I[-1]+A-B)
-    R.append(R[-1]+B)    
+    plt.figure()
+    plt.title("Very simple model, 13.3 contacts per day, p = {}".format(p))
+    plt.xlabel("Days since outbreak")
+    plt.ylabel("Number of cases")
+    plt.plot(S,'b-',label="susceptible")
+    plt.plot(I,'r-',label="infected")
+    plt.plot(R,'k-',label="removed")
+    for compartment, color in [("S", "b"), ("I", "r"), ("R", "k")]:
+        plt.fill_between(bands["t"], bands[compartment][0], bands[compartment][2], color=color, alpha=0.2)
+    plt.legend()
 
+    plt.savefig("very-simple.png")
 
-plt.figure()
-plt.title("Very simple model, 13.3 contacts per day, p = {}".format(p))
-plt.xlabel("Days since outbreak")
-plt.ylabel("Number of cases")
-plt.plot(S,'b-',label="susceptible")
-plt.plot(I,'r-',label="infected")
-plt.plot(R,'k-',label="removed")
-plt.legend()
 
-plt.savefig("very-simple.png")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
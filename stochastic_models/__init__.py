@@ -0,0 +1 @@
+"""Stochastic counterparts of the compartment models: chain binomial and Gillespie simulation"""
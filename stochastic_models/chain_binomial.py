@@ -0,0 +1,155 @@
+"""
+Chain binomial simulation of the compartment structures built by generate_model()
+
+The runs are split into blocks of a fixed size. All trajectories of a block are advanced together with
+array valued binomial draws from the random stream of the block, so the results do not depend on the
+chunk size, and only the state of the current step is kept per run. Quantiles over runs are accumulated
+in per day histograms, so memory depends on the chunk size and the horizon, but not on the number of
+runs.
+"""
+import numpy as np
+
+# SIR structure of simple.py: N*m/2 contacts per day, each one infects with probability S*I*p/N**2
+SIR = {"name": "very simple",
+       "compartments": ["S", "I", "R"],
+       "connections": [
+           {"source": "S", "target": "I", "inhibitor": "I", "parameter": "beta"},
+           {"source": "I", "target": "R", "parameter": "L"}
+       ]}
+
+# removal rate L of SIR, the median of an exp(L) is ln(2)/L and we have 5 days median
+SIR_REMOVAL_RATE = np.log(2) / 5 / 10
+
+
+class ChainBinomialModel:
+    """
+    Stochastic counterpart of a CompartmentModel
+
+    Per step of length dt a compartment with total outflow hazard H loses Binomial(n, 1 - exp(-H dt))
+    individuals, which are split among its transitions in proportion to their hazards. The hazard of
+    an L transition is its rate, the hazard of a Q transition is rate * inhibitor / N.
+
+    Parameters
+    ----------
+    model
+        CompartmentModel with the parameters set, e.g. from generate_model()
+    steps_per_day
+        Number of binomial steps per day, the output is daily
+    block_size
+        Runs per random stream, see trajectories()
+    """
+    def __init__(self, model, steps_per_day=1, block_size=256):
+        self.compartments = list(model.compartments)
+        self.N = float(model.parameters["N"])
+        self.dt = 1. / steps_per_day
+        self.steps_per_day = steps_per_day
+        self.block_size = block_size
+
+        config = list(model.param_config.items())
+        self.rates = np.array([model.parameters[name] for name, _ in config], dtype=float)
+        self.source = np.array([param['source'] for _, param in config], dtype=int)
+        self.target = np.array([param['target'] for _, param in config], dtype=int)
+        self.inhibitor = np.array([param.get('inhibitor', -1) for _, param in config], dtype=int)
+
+        # transitions grouped by their source compartment
+        self.outflows = [(i, np.flatnonzero(self.source == i)) for i in np.unique(self.source)]
+
+    def step(self, state, rng):
+        """Advance the states of shape (runs, compartments) in place by one step"""
+        hazard = np.broadcast_to(self.rates, (state.shape[0], len(self.rates))).copy()
+        quadratic = self.inhibitor >= 0
+        hazard[:, quadratic] *= state[:, self.inhibitor[quadratic]] / self.N
+
+        flows = np.zeros(hazard.shape, dtype=np.int64)
+        for i, transitions in self.outflows:
+            total = hazard[:, transitions].sum(axis=1)
+            remaining = rng.binomial(state[:, i], -np.expm1(-total * self.dt))
+            for r in transitions[:-1]:
+                share = np.divide(hazard[:, r], total, out=np.zeros_like(total), where=total > 0)
+                flows[:, r] = rng.binomial(remaining, np.minimum(share, 1.))
+                remaining -= flows[:, r]
+                total = total - hazard[:, r]
+            flows[:, transitions[-1]] = remaining
+
+        for r in range(len(self.rates)):
+            state[:, self.source[r]] -= flows[:, r]
+            state[:, self.target[r]] += flows[:, r]
+
+    def _rng(self, seed, block):
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence(entropy=seed, spawn_key=(block,))))
+
+    def trajectories(self, initial_value, days, runs, seed=None, first_block=0, out=None):
+        """
+        Daily states of runs, simulated in blocks of block_size runs from block first_block on
+
+        Every block has its own random stream derived from (seed, block), so whatever the chunk size, run
+        i of quantiles() is trajectories(..., runs=block_size, seed=seed, first_block=b)[i % block_size]
+        with b = i // block_size, as long as its block is complete.
+
+        Returns
+        -------
+        Integer array of shape (runs, compartments, days + 1), written into out if given
+        """
+        n = len(self.compartments)
+        if out is None:
+            out = np.empty(shape=(runs, n, days + 1), dtype=np.int64)
+
+        for block, start in enumerate(range(0, runs, self.block_size), start=first_block):
+            rng = self._rng(seed, block)
+            paths = out[start:start + self.block_size]
+            state = np.empty(shape=(len(paths), n), dtype=np.int64)
+            state[:] = np.asarray(initial_value, dtype=np.int64)
+            paths[:, :, 0] = state
+            for day in range(1, days + 1):
+                for _ in range(self.steps_per_day):
+                    self.step(state, rng)
+                paths[:, :, day] = state
+        return out
+
+    def quantiles(self, initial_value, days, runs, q=(0.05, 0.5, 0.95), seed=None, chunk_size=1000, bins=2000):
+        """
+        Quantiles and mean over runs of every compartment and day
+
+        The runs are simulated in chunks of chunk_size, rounded up to whole blocks, and counted in histograms with bins logarithmic
+        bins between 0 and N (all integers below 100 get their own bin), so the quantiles are exact up
+        to about log(N / 100) / bins relative to the value.
+
+        Returns
+        -------
+        Dict with the days as 't', the quantile levels as 'q', per compartment an array of shape
+        (len(q), days + 1) and per compartment the mean under 'mean'
+        """
+        n = len(self.compartments)
+        edges = np.unique(np.concatenate([np.arange(0, 101), np.geomspace(100, max(self.N, 101), bins)]).astype(np.int64))
+        edges = np.append(edges, edges[-1] + 1)
+        nbins = len(edges) - 1
+
+        histogram = np.zeros(shape=(n, days + 1, nbins), dtype=np.int64)
+        total = np.zeros(shape=(n, days + 1))
+        chunk_size = -(-chunk_size // self.block_size) * self.block_size
+        buffer = np.empty(shape=(min(chunk_size, runs), n, days + 1), dtype=np.int64)
+        offsets = (np.arange(n)[:, None] * (days + 1) + np.arange(days + 1)) * nbins
+
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        for start in range(0, runs, chunk_size):
+            size = min(chunk_size, runs - start)
+            paths = self.trajectories(initial_value, days, size, seed=seed, first_block=start // self.block_size,
+                                      out=buffer[:size])
+            index = np.searchsorted(edges, paths, side='right') - 1
+            histogram += np.bincount((offsets + index).ravel(), minlength=histogram.size).reshape(histogram.shape)
+            total += paths.sum(axis=0)
+
+        res = {'t': np.arange(days + 1), 'q': np.asarray(q), 'mean': {}}
+        cumulative = np.cumsum(histogram, axis=2)
+        for i, compartment in enumerate(self.compartments):
+            values = np.empty(shape=(len(q), days + 1))
+            for k, level in enumerate(q):
+                rank = level * runs
+                b = np.argmax(cumulative[i] >= rank, axis=1)
+                below = np.take_along_axis(cumulative[i], b[:, None], axis=1)[:, 0] - histogram[i, np.arange(days + 1), b]
+                within = (rank - below) / np.maximum(histogram[i, np.arange(days + 1), b], 1)
+                values[k] = edges[b] + np.clip(within, 0., 1.) * (edges[b + 1] - 1 - edges[b])
+            res[compartment] = values
+            res['mean'][compartment] = total[i] / runs
+        return res
@@ -0,0 +1,222 @@
+"""
+Exact and approximate event driven simulation of the compartment structures built by generate_model()
+
+Small counts are simulated event by event with the Gillespie direct method. As soon as every
+compartment with a nonzero outflow holds at least tau_threshold individuals, the simulator switches
+to tau-leaping with the step size selection of Cao, Gillespie and Petzold (2006), and back to exact
+events once counts get small again. This keeps extinction of small outbreaks exact, while large
+outbreaks do not cost one Python iteration per event.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class GillespieSimulator:
+    """
+    Parameters
+    ----------
+    model
+        CompartmentModel with the parameters set, e.g. from generate_model(). The propensity of an
+        L transition is rate * source, that of a Q transition rate * source * inhibitor / N
+    tau_threshold
+        Minimum count of all compartments with outflow for a tau-leap, use np.inf for exact simulation
+    epsilon
+        Bound on the relative change of the propensities within one leap
+    """
+    def __init__(self, model, tau_threshold=100, epsilon=0.03):
+        self.compartments = list(model.compartments)
+        self.N = float(model.parameters["N"])
+        self.tau_threshold = tau_threshold
+        self.epsilon = epsilon
+
+        config = list(model.param_config.items())
+        n = len(self.compartments)
+        self.rates = np.array([model.parameters[name] for name, _ in config], dtype=float)
+        self.source = np.array([param['source'] for _, param in config], dtype=int)
+        self.target = np.array([param['target'] for _, param in config], dtype=int)
+        self.inhibitor = np.array([param.get('inhibitor', -1) for _, param in config], dtype=int)
+        self.quadratic = self.inhibitor >= 0
+
+        self.stoichiometry = np.zeros(shape=(len(config), n), dtype=np.int64)
+        self.stoichiometry[np.arange(len(config)), self.source] -= 1
+        self.stoichiometry[np.arange(len(config)), self.target] += 1
+
+        # highest order of a reaction a compartment takes part in, for the leap size selection
+        self.order = np.ones(n)
+        self.order[self.source[self.quadratic]] = 2
+        self.order[self.inhibitor[self.quadratic]] = 2
+
+        # compartments that are infectious or can still become infectious without a new infection
+        self.active = np.zeros(n, dtype=bool)
+        self.active[self.inhibitor[self.quadratic]] = True
+        linear = ~self.quadratic
+        changed = True
+        while changed:
+            upstream = self.source[linear & self.active[self.target]]
+            changed = not self.active[upstream].all()
+            self.active[upstream] = True
+
+    def propensities(self, x):
+        a = self.rates * x[self.source]
+        a[self.quadratic] *= x[self.inhibitor[self.quadratic]] / self.N
+        return a
+
+    def _leap(self, x, a, rng):
+        """Number of events per transition within one tau-leap, or None if the leap is too short"""
+        mu = a @ self.stoichiometry
+        sigma2 = a @ self.stoichiometry ** 2
+        reactants = np.unique(self.source[a > 0])
+
+        bound = np.maximum(self.epsilon * x[reactants] / self.order[reactants], 1.)
+        with np.errstate(divide='ignore'):
+            tau = min(np.min(bound / np.abs(mu[reactants])), np.min(bound ** 2 / sigma2[reactants]))
+
+        # a leap that covers only a few events is not worth it
+        if tau * a.sum() < 10:
+            return None, None
+        while True:
+            events = rng.poisson(a * tau)
+            if (x + events @ self.stoichiometry >= 0).all():
+                return tau, events
+            tau /= 2
+
+    def run(self, initial_value, t_end, t_eval=None, rng=None, stop_size=None):
+        """
+        Simulate one realization until t_end or until no event is possible anymore
+
+        Parameters
+        ----------
+        t_eval
+            Output times, daily by default
+        stop_size
+            Stop early once this many individuals have left the first compartment, e.g. to classify a
+            major outbreak without simulating it to the end
+
+        Returns
+        -------
+        Dict with the states at t_eval of shape (compartments, len(t_eval)), the number of events,
+        whether the outbreak went extinct and the time of the last event
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        t_eval = np.arange(0., t_end + 1.) if t_eval is None else np.asarray(t_eval, dtype=float)
+        times = t_eval.tolist()
+
+        # the exact steps work on Python scalars, which is much faster than numpy for a few compartments
+        x = [int(v) for v in initial_value]
+        x0 = x[0]
+        rates = self.rates.tolist()
+        source = self.source.tolist()
+        target = self.target.tolist()
+        inhibitor = self.inhibitor.tolist()
+        active = np.flatnonzero(self.active).tolist()
+        last = len(rates) - 1
+        inv_N = 1. / self.N
+
+        block = 4096
+        uniforms = rng.random(block)
+        exponentials = rng.standard_exponential(block)
+        pos = 0
+
+        out = np.empty(shape=(len(x), len(times)), dtype=np.int64)
+        t = 0.
+        k = 0
+        events = 0
+        extinct = False
+
+        while t < t_end:
+            if not any(x[i] for i in active):
+                extinct = True
+                break
+            if stop_size is not None and x0 - x[0] >= stop_size:
+                break
+
+            a = [r * x[s] * (x[i] * inv_N if i >= 0 else 1.) for r, s, i in zip(rates, source, inhibitor)]
+            a0 = sum(a)
+            if a0 <= 0:
+                break
+
+            tau = None
+            if min(x[s] for s, a_r in zip(source, a) if a_r > 0) >= self.tau_threshold:
+                tau, leap = self._leap(np.array(x), np.array(a), rng)
+
+            if tau is None:
+                if pos == block:
+                    uniforms = rng.random(block)
+                    exponentials = rng.standard_exponential(block)
+                    pos = 0
+                tau = exponentials[pos] / a0
+                u = uniforms[pos] * a0
+                pos += 1
+
+                r = 0
+                cumulative = a[0]
+                while cumulative <= u and r < last:
+                    r += 1
+                    cumulative += a[r]
+                change = None
+                n_events = 1
+            else:
+                change = (leap @ self.stoichiometry).tolist()
+                n_events = int(leap.sum())
+
+            # the state before the event holds until the event time
+            while k < len(times) and times[k] < t + tau:
+                out[:, k] = x
+                k += 1
+            t += tau
+            if change is None:
+                x[source[r]] -= 1
+                x[target[r]] += 1
+            else:
+                x = [x_i + c_i for x_i, c_i in zip(x, change)]
+            events += n_events
+
+        out[:, k:] = np.array(x)[:, None]
+        return {'y': out, 't': t_eval, 'events': events, 'extinct': extinct, 't_last': min(t, t_end)}
+
+
+def _run_seeds(simulator, initial_value, t_end, t_eval, stop_size, seeds):
+    return [simulator.run(initial_value, t_end, t_eval, np.random.default_rng(seed), stop_size) for seed in seeds]
+
+
+def simulate_batch(simulator, initial_value, t_end, runs, seed=None, t_eval=None, stop_size=None, workers=None,
+                   chunk_size=50):
+    """
+    Run many realizations in a process pool
+
+    Run i uses the i-th child of SeedSequence(seed), so its result does not depend on the number of
+    workers or on the chunk size.
+
+    Returns
+    -------
+    Dict with the states of shape (runs, compartments, len(t_eval)), the extinction flags and event
+    counts per run, and the wall time in seconds
+    """
+    start = time.perf_counter()
+    seeds = np.random.SeedSequence(seed).spawn(runs)
+    chunks = [seeds[i:i + chunk_size] for i in range(0, runs, chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = [result for chunk in pool.map(_run_seeds, *zip(*[
+            (simulator, initial_value, t_end, t_eval, stop_size, chunk) for chunk in chunks])) for result in chunk]
+
+    return {'y': np.stack([result['y'] for result in results]),
+            't': results[0]['t'],
+            'extinct': np.array([result['extinct'] for result in results]),
+            'events': np.array([result['events'] for result in results]),
+            'seconds': time.perf_counter() - start}
+
+
+def extinction_probability(simulator, initial_value, t_end, runs, seed=None, stop_size=1000, workers=None):
+    """
+    Share of realizations that go extinct before t_end, with the binomial standard error
+
+    Realizations in which stop_size individuals got infected are counted as major outbreaks and are
+    not simulated further.
+    """
+    res = simulate_batch(simulator, initial_value, t_end, runs, seed=seed, t_eval=[0.], stop_size=stop_size,
+                         workers=workers)
+    p = res['extinct'].mean()
+    return p, np.sqrt(p * (1 - p) / runs)
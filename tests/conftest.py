@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the packages are imported from the repository root, the data scripts and benchmarks are plain modules
+for path in [ROOT, os.path.join(ROOT, "resources", "data"), os.path.join(ROOT, "benchmarks")]:
+    if path not in sys.path:
+        sys.path.insert(1, path)
@@ -0,0 +1,160 @@
+"""APIClient of utils/get_data_from_api.py against a local http.server stand-in for the REST API"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from utils.get_data_from_api import APIClient
+
+LAST_MODIFIED = "Wed, 01 Apr 2020 00:00:00 GMT"
+
+
+class Handler(BaseHTTPRequestHandler):
+    """cases has an ETag, measures only a Last-Modified date, the body of both is the current version"""
+    def do_GET(self):
+        server = self.server
+        endpoint = self.path.rsplit("/", 1)[-1]
+        server.requests.append((endpoint, dict(self.headers)))
+        body = json.dumps([{"endpoint": endpoint, "version": server.version}]).encode()
+
+        if endpoint == "cases":
+            etag = '"v{}"'.format(server.version)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            headers = {"ETag": etag}
+        elif endpoint == "measures":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED and server.version == 1:
+                self.send_response(304)
+                self.end_headers()
+                return
+            headers = {"Last-Modified": LAST_MODIFIED}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        for name, value in dict(headers, **{"Content-Type": "application/json",
+                                            "Content-Length": str(len(body))}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.requests = []
+    httpd.version = 1
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:{}/api/".format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def client(server, tmp_path, **options):
+    return APIClient(base_url=server.url, cache_dir=str(tmp_path), timeout=5, **options)
+
+
+def version(body):
+    return json.loads(body)[0]["version"]
+
+
+def test_fresh_cache_is_served_without_request(server, tmp_path):
+    api = client(server, tmp_path)
+    assert version(api.fetch("cases")) == 1
+    assert version(api.fetch("cases")) == 1
+    assert len(server.requests) == 1
+    assert api.get("cases")["endpoint"].tolist() == ["cases"]
+
+
+def test_etag_revalidation(server, tmp_path):
+    api = client(server, tmp_path, ttl=0)
+    api.fetch("cases")
+    assert version(api.fetch("cases")) == 1
+    assert server.requests[1][1]["If-None-Match"] == '"v1"'
+
+    server.version = 2
+    assert version(api.fetch("cases")) == 2
+    assert server.requests[2][1]["If-None-Match"] == '"v1"'
+    # the new ETag is stored
+    api.fetch("cases")
+    assert server.requests[3][1]["If-None-Match"] == '"v2"'
+
+
+def test_last_modified_revalidation(server, tmp_path):
+    api = client(server, tmp_path, ttl=0)
+    api.fetch("measures")
+    assert version(api.fetch("measures")) == 1
+    assert server.requests[1][1]["If-Modified-Since"] == LAST_MODIFIED
+    assert "If-None-Match" not in server.requests[1][1]
+
+
+def test_304_refreshes_the_entry(server, tmp_path):
+    api = client(server, tmp_path, ttl=0)
+    api.fetch("cases")
+    _, meta_path = api._paths("cases")
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta["fetched"] -= 100
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    api.fetch("cases")
+    with open(meta_path) as f:
+        assert json.load(f)["fetched"] > meta["fetched"] + 50
+    api.ttl = 3600
+    api.fetch("cases")
+    assert len(server.requests) == 2
+
+
+def test_offline(server, tmp_path):
+    client(server, tmp_path).fetch("cases")
+    server.version = 2
+    api = client(server, tmp_path, ttl=0, offline=True)
+    assert version(api.fetch("cases")) == 1
+    assert len(server.requests) == 1
+    with pytest.raises(LookupError):
+        api.fetch("measures")
+
+
+def test_stale_fallback(server, tmp_path):
+    client(server, tmp_path).fetch("cases")
+    server.shutdown()
+    server.server_close()
+
+    api = client(server, tmp_path, ttl=0)
+    assert version(api.fetch("cases")) == 1
+    with pytest.raises(requests.ConnectionError):
+        api.fetch("measures")
+
+
+def test_http_errors_are_raised(server, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        client(server, tmp_path).fetch("source")
+
+
+def test_old_entries_are_evicted_on_write(server, tmp_path):
+    api = client(server, tmp_path, max_age=60)
+    api.fetch("cases")
+    body_path, meta_path = api._paths("cases")
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta["fetched"] = time.time() - 120
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    api.fetch("measures")
+    assert not os.path.exists(body_path) and not os.path.exists(meta_path)
+    assert all(os.path.exists(path) for path in api._paths("measures"))
@@ -0,0 +1,56 @@
+"""update_feature_store() of generate_ml_data.py against a full recompute of all cases"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from generate_ml_data import MAX_LAG, load_feature_store, preprocess_data, update_feature_store
+
+POPULATION = pd.DataFrame({"country": ["X", "Y"], "year": 2018, "population": [1e6, 2e6]})
+
+
+def cases(days):
+    """Rows as returned by get_cases() for a country X and a region a of Y, with a few missing days"""
+    days = [day for day in days if day % 7 != 3]
+    return pd.DataFrame({
+        "area1": [np.nan] * len(days) + ["a"] * len(days),
+        "area2": ["X"] * len(days) + ["Y"] * len(days),
+        "date": days * 2,
+        "infected": [10. + day ** 1.5 for day in days] + [5. + 2 * day for day in days],
+        "dead": [day / 10. for day in days] * 2,
+        "source": "JHU",
+    })
+
+
+def full_recompute(df):
+    return normalize(preprocess_data(df.reset_index(drop=True), POPULATION))
+
+
+def normalize(df):
+    df = df.sort_values(["area2", "date"]).reset_index(drop=True)
+    df["area1"] = df["area1"].where(df["area1"].notna(), np.nan)
+    df["date"] = df["date"].astype(np.int64)
+    return df[sorted(df.columns)]
+
+
+@pytest.mark.parametrize("first, second", [
+    (range(30), range(30, 45)),
+    # a gap longer than MAX_LAG between the two updates
+    (range(30), range(30 + MAX_LAG + 6, 60)),
+])
+def test_incremental_update(tmp_path, first, second):
+    store = str(tmp_path)
+    assert update_feature_store(store, cases(first), POPULATION) == len(cases(first))
+    pd.testing.assert_frame_equal(normalize(load_feature_store(store)), full_recompute(cases(first)))
+
+    everything = cases(list(first) + list(second))
+    # the rows of the first update are not ingested again
+    assert update_feature_store(store, everything, POPULATION) == len(cases(second))
+    pd.testing.assert_frame_equal(normalize(load_feature_store(store)), full_recompute(everything))
+
+
+def test_nothing_new(tmp_path):
+    store = str(tmp_path)
+    update_feature_store(store, cases(range(20)), POPULATION)
+    assert update_feature_store(store, cases(range(20)), POPULATION) == 0
+    assert update_feature_store(store, cases(range(0)), POPULATION) == 0
+    pd.testing.assert_frame_equal(normalize(load_feature_store(store)), full_recompute(cases(range(20))))
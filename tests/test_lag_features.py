@@ -0,0 +1,152 @@
+"""
+lag_features() of generate_ml_data.py against hand computed values, and the intended differences from
+the per row loop that preprocess_data() used before
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from generate_ml_data import LAGS, lag_features
+
+
+def old_lag_features(df):
+    """The lag loop of the former preprocess_data(), without its string comparisons and returning its table"""
+    r0_values = {}
+    for time in [10, 5, 2, -10, -5, -2]:
+        r0_values["inf_" + str(time)] = []
+    for suffix in ["_R0", "_R0_lin"]:
+        for time in [10, -10, 5, -5, 2, -2]:
+            r0_values["inf_" + str(time) + suffix] = []
+
+    for index, row in df.iterrows():
+        cur_df = df[df['area1'] == row['area1']]
+        cur_df = cur_df[cur_df['area2'] == row['area2']]
+
+        for time in [-10, -5, -2, 2, 5, 10]:
+            if time > 0:
+                cur_df = cur_df[cur_df['date'] >= row['date'] + time]
+            else:
+                cur_df = cur_df[cur_df['date'] <= row['date'] + time]
+            if cur_df.empty:
+                r0_values["inf_" + str(time)].append(np.nan)
+                r0_values["inf_" + str(time) + "_R0"].append(np.nan)
+                r0_values["inf_" + str(time) + "_R0_lin"].append(np.nan)
+                continue
+            r0_values["inf_" + str(time)].append(cur_df.sort_values(by=['date']).iloc[0]['infected'])
+
+            if str(row['infected']) == 'nan' or int(row['infected']) == 0 or \
+                    int(cur_df.sort_values(by=['date']).iloc[0]['infected']) == 0:
+                r0_values["inf_" + str(time) + "_R0"].append(np.nan)
+                r0_values["inf_" + str(time) + "_R0_lin"].append(np.nan)
+            else:
+                inf_cur = int(row['infected'])
+                inf_n_days = int(cur_df.sort_values(by=['date']).iloc[0]['infected'])
+                if time > 0:
+                    r0_values["inf_" + str(time) + "_R0"].append(inf_n_days / inf_cur)
+                    r0_values["inf_" + str(time) + "_R0_lin"].append((inf_n_days - inf_cur) / abs(time) * 10)
+                else:
+                    r0_values["inf_" + str(time) + "_R0"].append(inf_cur / inf_n_days)
+                    r0_values["inf_" + str(time) + "_R0_lin"].append((inf_cur - inf_n_days) / abs(time) * 10)
+
+    return pd.DataFrame.from_dict(r0_values, orient='index').transpose()
+
+
+@pytest.fixture
+def cases():
+    """Two regions with gaps between the dates, a zero count, and a region without area1"""
+    df = pd.DataFrame({
+        "area1": ["a"] * 6 + [None] * 3,
+        "area2": ["X"] * 6 + ["Y"] * 3,
+        "date": [0, 1, 3, 6, 10, 12, 0, 5, 10],
+        "infected": [1., 2., 4., 8., 0., 20., 3., 6., 12.],
+    })
+    # shuffled, with an index that is not a range
+    return df.sample(frac=1., random_state=0).set_index(np.arange(100, 109))
+
+
+def row(result, cases, area2, date):
+    return result.loc[cases.index[(cases["area2"] == area2) & (cases["date"] == date)][0]]
+
+
+def test_columns_and_index(cases):
+    result = lag_features(cases)
+    assert result.index.equals(cases.index)
+    assert set(result.columns) == set(old_lag_features(cases.reset_index(drop=True)).columns)
+    assert set(result.columns) == {"inf_{}{}".format(time, suffix) for time in LAGS for suffix in ["", "_R0", "_R0_lin"]}
+
+
+def test_backward_lags(cases):
+    res = row(lag_features(cases), cases, "X", 12)
+    # the last record at or before 12 - 2, 12 - 5 and 12 - 10
+    assert res["inf_-2"] == 0. and np.isnan(res["inf_-2_R0"]) and np.isnan(res["inf_-2_R0_lin"])
+    assert (res["inf_-5"], res["inf_-5_R0"], res["inf_-5_R0_lin"]) == (8., 2.5, 24.)
+    assert (res["inf_-10"], res["inf_-10_R0"], res["inf_-10_R0_lin"]) == (2., 10., 18.)
+    # nothing after day 12
+    assert np.isnan(res[["inf_2", "inf_5", "inf_10", "inf_2_R0", "inf_10_R0_lin"]].to_numpy(dtype=float)).all()
+
+
+def test_forward_lags(cases):
+    res = row(lag_features(cases), cases, "X", 1)
+    # the first record at or after 1 + 2, 1 + 5 and 1 + 10
+    assert (res["inf_2"], res["inf_2_R0"], res["inf_2_R0_lin"]) == (4., 2., 10.)
+    assert (res["inf_5"], res["inf_5_R0"], res["inf_5_R0_lin"]) == (8., 4., 12.)
+    assert (res["inf_10"], res["inf_10_R0"], res["inf_10_R0_lin"]) == (20., 10., 18.)
+    assert np.isnan(res["inf_-2"])
+
+
+def test_zero_cases_give_no_growth(cases):
+    res = row(lag_features(cases), cases, "X", 10)
+    assert (res["inf_-5"], res["inf_2"]) == (4., 20.)
+    assert np.isnan(res[["inf_-5_R0", "inf_-5_R0_lin", "inf_2_R0", "inf_2_R0_lin"]].to_numpy(dtype=float)).all()
+
+
+def test_lags_are_independent(cases):
+    # the old loop narrowed the records of a row lag by lag, so after -10 it only saw days <= date - 10
+    old = old_lag_features(cases.reset_index(drop=True))
+    position = np.flatnonzero((cases["area2"] == "X").to_numpy() & (cases["date"] == 1).to_numpy())[0]
+    assert np.isnan(old["inf_2"][position])
+    assert row(lag_features(cases), cases, "X", 1)["inf_2"] == 4.
+
+
+def test_backward_lags_use_the_closest_record(cases):
+    # the old loop took the earliest record of the region for every backward lag
+    old = old_lag_features(cases.reset_index(drop=True))
+    position = np.flatnonzero((cases["area2"] == "X").to_numpy() & (cases["date"] == 12).to_numpy())[0]
+    assert old["inf_-10"][position] == 1.
+    assert row(lag_features(cases), cases, "X", 12)["inf_-10"] == 2.
+
+
+def test_missing_area1_is_a_region(cases):
+    # NaN == NaN is False, so the old loop found no records for rows without area1
+    old = old_lag_features(cases.reset_index(drop=True))
+    assert old.loc[(cases["area2"] == "Y").to_numpy()].isna().all().all()
+    res = row(lag_features(cases), cases, "Y", 10)
+    assert (res["inf_-5"], res["inf_-5_R0"], res["inf_-5_R0_lin"]) == (6., 2., 12.)
+
+
+def test_aligned_with_the_index(cases):
+    # the old table had a range index, so concatenating it with df by index added rows
+    assert len(pd.concat([cases, old_lag_features(cases)], axis=1)) == 2 * len(cases)
+    assert len(pd.concat([cases, lag_features(cases)], axis=1)) == len(cases)
+
+
+def test_counts_are_not_truncated():
+    df = pd.DataFrame({"area1": "a", "area2": "X", "date": [0, 12], "infected": [2.5, 5.5]})
+    assert lag_features(df)["inf_-10_R0"][1] == 5.5 / 2.5
+    assert old_lag_features(df)["inf_-10_R0"][1] == 5 / 2
+
+
+def test_missing_counts():
+    df = pd.DataFrame({"area1": "a", "area2": "X", "date": [0, 12, 24], "infected": [np.nan, 4., 8.]})
+    res = lag_features(df)
+    assert np.isnan(res["inf_-10"][1]) and np.isnan(res["inf_-10_R0"][1])
+    assert res["inf_10"][0] == 4. and np.isnan(res["inf_10_R0"][0])
+    assert res["inf_-10_R0"][2] == 2.
+    # int(nan) in the old loop
+    with pytest.raises(ValueError):
+        old_lag_features(df)
+
+
+def test_matches_the_per_row_reference():
+    from bench_preprocess_data import check
+    check(rows=300)
@@ -0,0 +1,70 @@
+"""Chunked loading of utils/get_data_from_mongodb.py against an in-memory mongomock database"""
+import mongomock
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.get_data_from_mongodb import CASES_FIELDS, cases_query, iter_collection, load_cases, load_collection
+
+DAY = 86400.
+
+
+@pytest.fixture
+def db():
+    """Cases of 10 days for two sources, with an extra field that the loader must not transfer"""
+    database = mongomock.MongoClient()["jhu"]
+    database["cases"].insert_many([
+        {"date": 1585699200. + day * DAY, "area": ["", "Country{}".format(day % 3)], "infected": 10 * day,
+         "dead": day, "recovered": 2 * day, "source": source, "comment": "not loaded"}
+        for day in range(10) for source in ["JHU", "RKI"]])
+    return database
+
+
+def test_query():
+    assert cases_query() == {"source": "JHU"}
+    assert cases_query(None, date_from="2020-04-01", date_to=1585872000.) == \
+        {"date": {"$gte": 1585699200., "$lt": 1585872000.}}
+
+
+def test_projection_and_dtypes(db):
+    cases = load_cases(db=db)
+    assert list(cases.columns) == CASES_FIELDS
+    assert "_id" not in cases and "comment" not in cases
+    assert len(cases) == 10
+    assert cases["source"].dtype == "category" and list(cases["source"].cat.categories) == ["JHU"]
+    for column in ["date", "infected", "dead", "recovered"]:
+        assert cases[column].dtype == np.float64
+    assert cases["area"].iloc[1] == ["", "Country1"]
+
+
+def test_source_and_date_filter(db):
+    cases = load_cases(source="RKI", date_from="2020-04-03", date_to="2020-04-06", db=db)
+    assert (cases["source"] == "RKI").all()
+    np.testing.assert_array_equal(np.sort(cases["date"].to_numpy()), 1585699200. + np.arange(2, 5) * DAY)
+
+    every_source = load_cases(source=None, date_from="2020-04-09", db=db)
+    assert sorted(every_source["source"].astype(str)) == ["JHU", "JHU", "RKI", "RKI"]
+    assert set(every_source["source"].cat.categories) == {"JHU", "RKI"}
+
+
+def test_chunk_boundaries(db):
+    chunks = list(iter_collection(db["cases"], {"source": "JHU"}, fields=["date", "infected"], chunk_size=3,
+                                  batch_size=2))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    assert all(list(chunk.columns) == ["date", "infected"] for chunk in chunks)
+
+    whole = load_cases(db=db)
+    for chunk_size in [1, 3, 10, 11]:
+        pd.testing.assert_frame_equal(load_cases(db=db, chunk_size=chunk_size, batch_size=2), whole)
+
+
+def test_categories_of_chunks_are_merged(db):
+    # every chunk of 2 documents holds one source only, so their categories differ
+    df = load_collection(db["cases"], {"date": {"$lt": 1585699200. + DAY}}, fields=["source"],
+                         dtypes={"source": "category"}, chunk_size=1)
+    assert df["source"].dtype == "category" and set(df["source"].cat.categories) == {"JHU", "RKI"}
+
+
+def test_empty_result(db):
+    cases = load_cases(source="none", db=db)
+    assert len(cases) == 0 and list(cases.columns) == CASES_FIELDS
@@ -0,0 +1,44 @@
+"""Nightly pipeline of deterministic_models/pipeline.py on synthetic countries"""
+import numpy as np
+import pandas as pd
+
+from deterministic_models.pipeline import run
+
+
+def synthetic_cases(countries):
+    """Exponentially growing cases over 40 days per (country, growth rate, population)"""
+    rows = []
+    for country, growth, population in countries:
+        for day in range(40):
+            infected = 50 * np.exp(growth * day)
+            rows.append({"area1": np.nan, "area2": country, "date": float(day), "infected": infected,
+                         "dead": .02 * infected if day > 5 else np.nan, "population": population})
+    return pd.DataFrame(rows)
+
+
+def test_forecasts(tmp_path):
+    output = str(tmp_path / "forecast.parquet")
+    stats = run(synthetic_cases([("A", .1, 1e7), ("B", .05, 5e6)]), output, workers=2, horizon=10)
+
+    assert stats["success"].all()
+    forecast = pd.read_parquet(output)
+    assert list(forecast.columns) == ["area2", "date", "S", "E", "I", "R", "D"]
+    assert forecast.groupby("area2").size().to_dict() == {"A": 50, "B": 50}
+    # compartments add up to the population
+    a = forecast[forecast["area2"] == "A"]
+    np.testing.assert_allclose(a[["S", "E", "I", "R", "D"]].sum(axis=1), 1e7, rtol=1e-6)
+
+
+def test_failing_country(tmp_path):
+    # a corrupt warm start makes FitResult.load() raise in the worker
+    fit_dir = tmp_path / "fits"
+    fit_dir.mkdir()
+    (fit_dir / "bad.json").write_text("{")
+    output = str(tmp_path / "forecast.parquet")
+    stats = run(synthetic_cases([("A", .1, 1e7), ("bad", .1, 1e6), ("B", .05, 5e6)]), output,
+                fit_dir=str(fit_dir), workers=2, horizon=10).set_index("area2")
+
+    assert stats.loc[["A", "B"], "success"].all()
+    assert not stats.loc["bad", "success"]
+    assert stats.loc["bad", "message"].startswith("JSONDecodeError")
+    assert set(pd.read_parquet(output)["area2"]) == {"A", "B"}
@@ -0,0 +1,53 @@
+"""Grid.interpolate() of precompute_grid.py on a small grid against predict()"""
+import os
+
+import numpy as np
+import pytest
+
+from deterministic_models import precompute_grid
+from deterministic_models.precompute_grid import CURVES, Grid, check, write_grid
+
+AXES = {"R0": [2.5, 2.75], "InterventionTime": [20., 30.], "InterventionDuration": [40., 60.],
+        "InterventionR0": [0.75, 1.]}
+
+
+@pytest.fixture(scope="module")
+def grid(tmp_path_factory):
+    # 120 instead of 730 days keeps the simulations short
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setitem(precompute_grid.SIMULATION_PARAMETERS, "t_final", 120.)
+        path = str(tmp_path_factory.mktemp("grid"))
+        write_grid(path, axes=AXES, every=1)
+    return Grid(path)
+
+
+def test_layout(grid):
+    assert grid.header["simulation_parameters"]["t_final"] == 120.
+    assert grid.shape == (2, 2, 2, len(CURVES), 120)
+    assert os.path.getsize(os.path.join(grid.path, "chunk_001.bin")) == 4 * (1 + 8) * len(CURVES) * 120
+
+
+def test_exact_at_the_grid_points(grid):
+    points = np.stack(np.meshgrid(*AXES.values(), indexing="ij")).reshape(4, -1)
+    header = grid.header
+    fixed = header["fixed"]
+    exact = precompute_grid.predict(dict(header["model_parameters"], R0=points[0]), header["simulation_parameters"],
+                                    {"N": fixed["N"], "I0": fixed["I0"]}, points[1], points[2], points[3],
+                                    fixed["AfterInterventionR0"])
+    for k in range(points.shape[1]):
+        _, interpolated = grid.interpolate(*points[:, k])
+        for c, curve in enumerate(CURVES):
+            # float32 storage of log(1 + x)
+            np.testing.assert_allclose(interpolated[c], exact[curve][k], rtol=1e-6, atol=1e-3)
+
+
+def test_interpolation_error(grid):
+    errors = check(grid, 50, seed=0)
+    assert errors.shape == (50, len(CURVES))
+    assert np.median(errors) < 5e-3
+    assert errors.max() < 2e-2
+
+
+def test_outside_of_the_grid(grid):
+    assert grid.interpolate(3., 20., 40., 0.75) is None
+    assert grid.interpolate(2.5, 20., 40., 0.5) is None
@@ -0,0 +1,32 @@
+"""Triggers of simulate_extended_seir() in deterministic_models/seir.py"""
+import numpy as np
+import pytest
+
+from deterministic_models.seir import Trigger, simulate_extended_seir
+
+N = 1e6
+PARAMETERS = {"N": N, "R0": 3., "a": 1 / 5.5, "gamma": 1 / 10., "m": 1e-4, "theta_M": .8, "theta_E": .0033,
+              "theta_I": .033}
+Y0 = [N - 100., 100., 0., 0., 0., 0., 0., 0.]
+
+
+def test_trigger_fires_once_the_threshold_is_crossed():
+    t_eval = np.linspace(0., 200., 201)
+    result = simulate_extended_seir(y0=Y0, t_eval=t_eval, triggers=[Trigger("IU", 1e4, R0=.5)], **PARAMETERS)
+
+    (t_fired, name), = result["events"]
+    assert name == "IU > 10000.0"
+    infected = result["y"][2]
+    assert infected[t_eval < t_fired].max() < 1e4
+    np.testing.assert_allclose(np.interp(t_fired, t_eval, infected), 1e4, rtol=1e-2)
+    # R0 below 1 from then on
+    assert infected[-1] < infected[t_eval > t_fired].max()
+
+
+def test_triggers_need_a_single_sample():
+    y0 = np.repeat(Y0, 2)
+    trigger = Trigger("IU", 1e4, R0=.5)
+    with pytest.raises(ValueError, match="single sample"):
+        simulate_extended_seir(y0=y0, t_eval=[0., 10.], triggers=[trigger], **PARAMETERS)
+    # without triggers the samples are integrated together
+    assert simulate_extended_seir(y0=y0, t_eval=[0., 10.], **PARAMETERS)["y"].shape == (16, 2)
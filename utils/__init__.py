@@ -0,0 +1 @@
+"""Loaders of the cases and measures from the MongoDB and the REST API"""
@@ -1,18 +1,155 @@
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+import requests
+
+BASE_URL = "http://bene.gridpiloten.de:4711/api/"
+ENDPOINTS = ["cases", "measures", "mesures", "source"]
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "challenge1757", "api")
+
+
+class APIClient:
+    """
+    Client for the REST API with a keep-alive session and an on-disk cache
+
+    A cached response younger than ttl seconds is served without a request. Older responses are
+    revalidated with If-None-Match / If-Modified-Since, so an unchanged endpoint only costs a 304.
+    Entries that have not been refreshed for max_age seconds are removed by evict(), which runs after
+    every write to the cache. In offline mode
+    only the cache is used, and if the server cannot be reached the last cached response is served.
+    """
+    def __init__(self, base_url=BASE_URL, cache_dir=CACHE_DIR, ttl=3600, max_age=7 * 86400, offline=False,
+                 timeout=60):
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_age = max_age
+        self.offline = offline
+        self.timeout = timeout
+
+        # requests decompresses gzip transparently
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def _paths(self, endpoint):
+        name = "".join(c if c.isalnum() else "_" for c in self.base_url + endpoint)
+        return os.path.join(self.cache_dir, name + ".json"), os.path.join(self.cache_dir, name + ".meta.json")
+
+    def _read_cache(self, endpoint):
+        body_path, meta_path = self._paths(endpoint)
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+            return None, None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            return f.read(), meta
+
+    def _write_cache(self, endpoint, body, meta):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path, meta_path = self._paths(endpoint)
+        if body is not None:
+            with open(body_path + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(body_path + ".tmp", body_path)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        self.evict()
+
+    def fetch(self, endpoint):
+        """Raw JSON body of an endpoint, from the cache if possible"""
+        body, meta = self._read_cache(endpoint)
+
+        if self.offline:
+            if body is None:
+                raise LookupError("{} is not cached and the client is offline".format(endpoint))
+            return body
+        if body is not None and time.time() - meta["fetched"] < self.ttl:
+            return body
+
+        headers = {}
+        if body is not None and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if body is not None and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            response = self.session.get(self.base_url + endpoint, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            if body is None:
+                raise
+            return body
+
+        if response.status_code == 304 and body is not None:
+            meta["fetched"] = time.time()
+            self._write_cache(endpoint, None, meta)
+            return body
+
+        response.raise_for_status()
+        self._write_cache(endpoint, response.content, {
+            "fetched": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        })
+        return response.content
+
+    def get(self, endpoint):
+        return pd.read_json(io.StringIO(self.fetch(endpoint).decode("utf-8")))
+
+    def get_all(self, endpoints=ENDPOINTS):
+        """Fetch several endpoints concurrently, returns a dict endpoint -> DataFrame"""
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as pool:
+            return dict(zip(endpoints, pool.map(self.get, endpoints)))
+
+    def evict(self):
+        """Remove cache entries that were not refreshed for max_age seconds"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".meta.json"):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            body_path = meta_path[:-len(".meta.json")] + ".json"
+            # get_all() writes from several threads, another one may have removed the entry already
+            try:
+                with open(meta_path) as f:
+                    fetched = json.load(f)["fetched"]
+                if time.time() - fetched > self.max_age:
+                    os.remove(meta_path)
+                    os.remove(body_path)
+            except FileNotFoundError:
+                pass
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = APIClient(offline=os.environ.get("CHALLENGE1757_OFFLINE", "") not in ("", "0"))
+    return _client
 
 def get_cases():
-    return pd.read_json("http://bene.gridpiloten.de:4711/api/cases")
+    return get_client().get("cases")
 
 def get_measures():
-    return pd.read_json("http://bene.gridpiloten.de:4711/api/measures")
+    return get_client().get("measures")
 
 def get_mesures():
-    return pd.read_json("http://bene.gridpiloten.de:4711/api/mesures")
+    return get_client().get("mesures")
 
 def get_source():
-    return pd.read_json("http://bene.gridpiloten.de:4711/api/source")
+    return get_client().get("source")
+
+def get_all():
+    return get_client().get_all()
 
 # print(get_cases())
 # print(get_measures())
 # print(get_mesures())
-# print(get_source())
\ No newline at end of file
+# print(get_source())
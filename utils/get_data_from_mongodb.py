@@ -2,34 +2,118 @@
 
 #!pip3 install pymongo pandas
 
+import itertools
+import threading
+
 import pandas as pd
-import pymongo
 
 
 class DBConnection:
   USER_NAME = "root"
   PASSWORD = "challenge1757"
+  HOST = "bene.gridpiloten.de:27017"
+
+  # MongoClient keeps its own thread-safe connection pool, so one client is shared by all callers
+  _client = None
+  _lock = threading.Lock()
 
   @staticmethod
   def getConnection():
-    return pymongo.MongoClient("mongodb://" + DBConnection.USER_NAME + ":" + DBConnection.PASSWORD + "@bene.gridpiloten.de:27017/")
+    with DBConnection._lock:
+      if DBConnection._client is None:
+        # pymongo is only needed once a connection is opened, not by callers that pass their own db
+        import pymongo
+        DBConnection._client = pymongo.MongoClient("mongodb://" + DBConnection.USER_NAME + ":" + DBConnection.PASSWORD + "@" + DBConnection.HOST + "/")
+    return DBConnection._client
 
   @staticmethod
   def getStatisticDB():
     return DBConnection.getConnection()["jhu"]
 
+  @staticmethod
+  def close():
+    with DBConnection._lock:
+      if DBConnection._client is not None:
+        DBConnection._client.close()
+        DBConnection._client = None
+
+
+CASES_FIELDS = ["date", "area", "infected", "dead", "recovered", "source"]
+CASES_DTYPES = {"date": "float64", "infected": "float64", "dead": "float64", "recovered": "float64",
+                "source": "category"}
+
+
+def _timestamp(value):
+  # dates are stored as seconds since the epoch
+  if isinstance(value, (int, float)):
+    return value
+  return pd.Timestamp(value).timestamp()
+
+
+def cases_query(source="JHU", date_from=None, date_to=None):
+  """Server side filter on the source and on dates in [date_from, date_to)"""
+  query = {}
+  if source is not None:
+    query["source"] = source
+  if date_from is not None or date_to is not None:
+    query["date"] = {}
+    if date_from is not None:
+      query["date"]["$gte"] = _timestamp(date_from)
+    if date_to is not None:
+      query["date"]["$lt"] = _timestamp(date_to)
+  return query
+
+
+def iter_collection(collection, query=None, fields=None, dtypes=None, chunk_size=50000, batch_size=5000):
+  """
+  Generator of DataFrames with at most chunk_size documents each
+
+  Only the given fields are transferred (all of them if fields is None) and the cursor fetches
+  batch_size documents per round trip, so no more than one chunk of documents is held in memory.
+  dtypes are applied to every chunk.
+  """
+  projection = None
+  if fields is not None:
+    projection = {field: 1 for field in fields}
+    if "_id" not in fields:
+      projection["_id"] = 0
+
+  cursor = collection.find(query or {}, projection=projection, batch_size=batch_size)
+  try:
+    while True:
+      documents = list(itertools.islice(cursor, chunk_size))
+      if not documents:
+        break
+      chunk = pd.DataFrame.from_records(documents, columns=fields)
+      del documents
+      yield chunk.astype({column: dtype for column, dtype in (dtypes or {}).items() if column in chunk})
+  finally:
+    cursor.close()
+
+
+def load_collection(collection, query=None, fields=None, dtypes=None, chunk_size=50000, batch_size=5000):
+  chunks = list(iter_collection(collection, query, fields, dtypes, chunk_size, batch_size))
+  if not chunks:
+    return pd.DataFrame(columns=fields)
+  df = pd.concat(chunks, ignore_index=True)
+  # categories of the chunks may differ, which turns them into objects
+  return df.astype({column: dtype for column, dtype in (dtypes or {}).items() if column in df})
+
+
+def load_cases(source="JHU", date_from=None, date_to=None, fields=CASES_FIELDS, chunk_size=50000,
+               batch_size=5000, db=None):
+  """Cases of one source (all sources if None) in [date_from, date_to), only with the given fields"""
+  db = DBConnection.getStatisticDB() if db is None else db
+  return load_collection(db["cases"], cases_query(source, date_from, date_to), fields, CASES_DTYPES,
+                         chunk_size, batch_size)
+
+
+def main():
+  cases = load_cases()
+  measures = load_collection(DBConnection.getStatisticDB()['mesures'])
+  print(cases)
+  # cases.to_csv('cases.csv', index=False)
+
 
-collections = [
-    'cases',
-    'mesures'
-]
-conn = DBConnection()
-statsdb = conn.getStatisticDB()
-
-data = [
-    pd.DataFrame(list(statsdb[col].find({})))
-    for col in collections
-]
-cases, measures = data
-print(cases)
-# cases.to_csv('cases.csv', index=False)
\ No newline at end of file
+if __name__ == '__main__':
+  main()